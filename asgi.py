@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Асинхронный (ASGI) фронтенд сервиса диаризации
+
+Flask-приложение синхронное: при запуске через app.run() или gthread-воркеры
+Gunicorn медленная загрузка с мобильного клиента занимает поток на всё
+время передачи. Здесь весь сетевой ввод-вывод выполняется в цикле asyncio:
+
+- токен проверяется по заголовкам до чтения тела (401 без приёма файла);
+- лимит тела проверяется по Content-Length и по мере приёма (413);
+- тело читается в буфер (SpooledTemporaryFile: в памяти до SPOOL_SIZE,
+  больше - на диске) без участия потоков;
+- у загрузок аудио сигнатура файла проверяется по первым принятым байтам
+  поля file (неизвестный формат - 415, не дожидаясь конца загрузки);
+- ответ отправляется клиенту тоже из цикла, потоковые ответы (NDJSON
+  /diarize/stream) - по частям.
+
+Только полностью принятый запрос передаётся во Flask-приложение в пул
+потоков. Эндпоинты, которые ждут результата инференса (/diarize,
+/diarize/stream, аудио сессии, регистрация спикера), идут в отдельный пул
+размером с число воркеров очереди плюс её длину: больше запросов очередь
+задач всё равно не примет, поэтому лёгкие запросы (/health, опрос /jobs)
+не ждут за ними. Сам инференс по-прежнему выполняют воркеры очереди задач,
+владеющие pipeline. Тысячи медленных или простаивающих соединений стоят
+только корутин.
+
+Запуск:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+    python serve.py --asgi --workers 2
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import HTTPException, UnsupportedMediaType
+from werkzeug.http import parse_options_header
+
+import diarization_service as service
+
+# Потоки для лёгких запросов (статус, задачи, сессии, спикеры)
+ASGI_THREADS = int(os.getenv('DIARIZATION_ASGI_THREADS', 8))
+
+# Эндпоинты, которые держат поток до окончания инференса
+INFERENCE_ENDPOINTS = {'diarize', 'diarize_stream', 'append_session_audio', 'enroll_speaker'}
+
+# Тело запроса до этого размера держится в памяти, больше - во временном
+# файле: тысячи одновременных загрузок не должны занимать по файлу в памяти
+SPOOL_SIZE = 1024 * 1024
+
+# Начало поля file ищется не дальше этого числа байт тела
+SNIFF_LIMIT = 64 * 1024
+
+
+def multipart_file_header(head, boundary, size):
+    """Первые size байт поля file из начала multipart-тела или None, если они ещё не приняты"""
+    delimiter = b'--' + boundary
+    position = head.find(delimiter)
+    while position != -1:
+        headers_end = head.find(b'\r\n\r\n', position)
+        if headers_end == -1:
+            return None
+        data = headers_end + 4
+        if b'name="file"' in head[position:data]:
+            return head[data:data + size] if len(head) >= data + size else None
+        position = head.find(delimiter, data)
+    return None
+
+
+class AsyncFrontend:
+    """ASGI-приложение, которое выполняет ввод-вывод в asyncio и вызывает WSGI-приложение в пулах потоков"""
+
+    def __init__(self, wsgi_app, startup=True, threads=ASGI_THREADS):
+        self.wsgi_app = wsgi_app
+        # startup=False - загрузку модели и очередь запускает внешний код (serve.py)
+        self.startup = startup
+        self.light_executor = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix='asgi-light')
+        self.inference_executor = None
+
+    def inference_threads(self):
+        # Выполняемые и ожидающие в очереди задачи; остальным очередь ответит 429
+        return service.WORKERS * service.replica_count() + service.QUEUE_SIZE
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.startup:
+                    # Загрузка и прогрев модели в фоне, как при запуске diarization_service.py
+                    service.start_warmup()
+                    service.job_queue.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.light_executor.shutdown(wait=False)
+                if self.inference_executor is not None:
+                    self.inference_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def executor_for(self, endpoint):
+        if endpoint not in INFERENCE_ENDPOINTS:
+            return self.light_executor
+        if self.inference_executor is None:
+            self.inference_executor = ThreadPoolExecutor(
+                max_workers=self.inference_threads(), thread_name_prefix='asgi-inference'
+            )
+        return self.inference_executor
+
+    def match(self, scope):
+        """Эндпоинт Flask для запроса или None (404/405 вернёт само приложение)"""
+        adapter = self.wsgi_app.url_map.bind('localhost')
+        try:
+            endpoint, _ = adapter.match(scope['path'], method=scope['method'])
+        except HTTPException:
+            return None
+        return endpoint
+
+    async def handle(self, scope, receive, send):
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        endpoint = self.match(scope)
+
+        view = self.wsgi_app.view_functions.get(endpoint)
+        if getattr(view, 'requires_token', False):
+            error = service.token_error(headers.get('authorization'))
+            if error:
+                return await self.send_json(send, 401, {'error': error})
+
+        limit = service.max_body_size(endpoint)
+        try:
+            content_length = int(headers['content-length']) if 'content-length' in headers else None
+        except ValueError:
+            return await self.send_json(send, 400, {'error': 'Invalid Content-Length'})
+        if content_length is not None and content_length > limit:
+            return await self.send_too_large(send, limit)
+
+        # Сигнатура аудио проверяется по первым байтам поля file тем же
+        # StreamingUpload, что и во Flask, пока остальной файл ещё передаётся
+        boundary, probe, head = None, None, b''
+        if endpoint in INFERENCE_ENDPOINTS:
+            mimetype, options = parse_options_header(headers.get('content-type', ''))
+            if mimetype == 'multipart/form-data' and options.get('boundary'):
+                boundary = options['boundary'].encode('latin-1')
+                probe = service.StreamingUpload(decode=False)
+
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        try:
+            received = 0
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                chunk = message.get('body', b'')
+                received += len(chunk)
+                if received > limit:
+                    return await self.send_too_large(send, limit)
+                body.write(chunk)
+                if boundary is not None:
+                    head += chunk
+                    header = multipart_file_header(head, boundary, probe.sniff_bytes)
+                    if header is not None or len(head) > SNIFF_LIMIT:
+                        boundary, head = None, b''
+                    if header is not None:
+                        try:
+                            probe.write(header)
+                        except UnsupportedMediaType as e:
+                            return await self.send_json(send, 415, {'error': e.description})
+                if not message.get('more_body', False):
+                    break
+            body.seek(0)
+
+            environ = self.environ(scope, headers.get('content-type', ''), body, received)
+            await self.run_wsgi(environ, self.executor_for(endpoint), send)
+        finally:
+            body.close()
+            if probe is not None:
+                probe.close()
+
+    def environ(self, scope, content_type, body, length):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            # Тело принято целиком: длина известна и для chunked-запросов
+            'CONTENT_LENGTH': str(length),
+            'CONTENT_TYPE': content_type,
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name, value = name.decode('latin-1').lower(), value.decode('latin-1')
+            if name in ('content-type', 'content-length'):
+                continue
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    async def run_wsgi(self, environ, executor, send):
+        loop = asyncio.get_running_loop()
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+
+        def call():
+            iterable = self.wsgi_app(environ, start_response)
+            iterator = iter(iterable)
+            # Первая часть ответа вычисляется в том же потоке: обычные
+            # (не потоковые) ответы Flask после вызова уже готовы целиком
+            return iterable, iterator, next(iterator, None)
+
+        iterable, iterator, chunk = await loop.run_in_executor(executor, call)
+        try:
+            await send({'type': 'http.response.start', 'status': response['status'],
+                        'headers': response['headers']})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                # Следующая часть потокового ответа (NDJSON) может ждать инференса
+                chunk = await loop.run_in_executor(executor, next, iterator, None)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(iterable, 'close'):
+                await loop.run_in_executor(executor, iterable.close)
+
+    async def send_json(self, send, status, data):
+        body = json.dumps(data).encode()
+        await send({'type': 'http.response.start', 'status': status, 'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+        ]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def send_too_large(self, send, limit):
+        file_limit = limit - service.MULTIPART_OVERHEAD
+        await self.send_json(send, 413, {'error': f'File too large. Max size: {file_limit / 1024 / 1024} MB'})
+
+
+app = AsyncFrontend(service.app)
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Декодирование аудио в память для pipeline
+
+Загруженные байты декодируются напрямую в тензор формы (1, samples)
+с частотой 16 кГц - в таком виде pipeline принимает вход
+{"waveform": ..., "sample_rate": ...} без повторного чтения с диска.
+Временный файл используется только для кодеков, которые нельзя
+декодировать из памяти (например, m4a с индексом в конце файла).
+
+StreamingDecoder декодирует загрузку по мере поступления байтов в фоновом
+потоке, чтобы декодирование шло параллельно с загрузкой: WAV (PCM и float)
+разбирается напрямую, остальные потоковые контейнеры - через FFmpeg.
+"""
+
+import abc
+import io
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+
+import numpy as np
+import soundfile as sf
+import torch
+import torchaudio
+
+SAMPLE_RATE = 16000
+
+# Форматы, которые libsndfile декодирует из памяти
+SOUNDFILE_EXTENSIONS = {'wav', 'flac', 'ogg', 'mp3'}
+
+
+def prepare_waveform(data, sample_rate):
+    """
+    Приведение массива (samples, channels) к моно-тензору 16 кГц
+
+    Ресемплинг выполняется ровно один раз, здесь.
+    """
+    if data.ndim == 2:
+        data = data.mean(axis=1)
+    waveform = torch.from_numpy(np.ascontiguousarray(data, dtype=np.float32))[None]
+    if sample_rate != SAMPLE_RATE:
+        waveform = torchaudio.functional.resample(waveform, sample_rate, SAMPLE_RATE)
+    return waveform
+
+
+def decode_with_ffmpeg(path):
+    """Декодирование файла FFmpeg сразу в моно float32 PCM 16 кГц"""
+    result = subprocess.run(
+        ['ffmpeg', '-nostdin', '-v', 'error', '-i', path,
+         '-ac', '1', '-ar', str(SAMPLE_RATE), '-f', 'f32le', 'pipe:1'],
+        check=True, capture_output=True
+    )
+    data = np.frombuffer(result.stdout, dtype=np.float32)
+    return torch.from_numpy(data.copy())[None]
+
+
+def decode_file(path):
+    """Декодирование временного файла: FFmpeg, если есть, иначе torchaudio"""
+    if shutil.which('ffmpeg') is not None:
+        try:
+            return decode_with_ffmpeg(path)
+        except subprocess.CalledProcessError as e:
+            raise Exception(f"FFmpeg could not decode audio: {e.stderr.decode(errors='ignore').strip()}")
+
+    waveform, sample_rate = torchaudio.load(path)
+    return prepare_waveform(waveform.numpy().T, sample_rate)
+
+
+def decode_audio(data, filename=''):
+    """
+    Декодирование байтов аудиофайла
+
+    Возвращает словарь {"waveform": (1, samples) tensor, "sample_rate": 16000}
+    """
+    extension = os.path.splitext(filename)[1].lower().lstrip('.')
+
+    if extension in SOUNDFILE_EXTENSIONS or not extension:
+        try:
+            samples, sample_rate = sf.read(io.BytesIO(data), dtype='float32', always_2d=True)
+            return {'waveform': prepare_waveform(samples, sample_rate), 'sample_rate': SAMPLE_RATE}
+        except Exception as e:
+            print(f"⚠ In-memory decoding failed for {filename or 'upload'}, using temp file: {e}")
+
+    # Запасной путь: кодек требует файла с произвольным доступом
+    fd, temp_file = tempfile.mkstemp(suffix=f'.{extension}' if extension else '')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        waveform = decode_file(temp_file)
+    finally:
+        try:
+            os.unlink(temp_file)
+        except OSError:
+            pass
+
+    return {'waveform': waveform, 'sample_rate': SAMPLE_RATE}
+
+
+def waveform_duration(audio):
+    """Длительность декодированного аудио в секундах"""
+    return audio['waveform'].shape[-1] / audio['sample_rate']
+
+
+# Сигнатуры контейнеров в первых байтах файла
+SNIFF_BYTES = 16
+ASF_GUID = bytes.fromhex('3026b2758e66cf11a6d900aa0062ce6c')
+
+
+def sniff_format(header):
+    """Контейнер по первым байтам файла: wav, flac, ogg, mp3, m4a, wma или None"""
+    if header[:4] in (b'RIFF', b'RF64') and header[8:12] == b'WAVE':
+        return 'wav'
+    if header[:4] == b'fLaC':
+        return 'flac'
+    if header[:4] == b'OggS':
+        return 'ogg'
+    if header[:3] == b'ID3' or (len(header) > 1 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0):
+        # MPEG audio (MP3) и ADTS AAC начинаются с кадровой синхронизации
+        return 'mp3'
+    if header[4:8] == b'ftyp':
+        return 'm4a'
+    if header[:16] == ASF_GUID:
+        return 'wma'
+    return None
+
+
+class StreamingDecoder(abc.ABC):
+    """
+    Декодирование байтов, поступающих порциями, в фоновом потоке
+
+    feed(chunk) передаёт очередную порцию, finish() дожидается конца
+    декодирования и возвращает {"waveform", "sample_rate"} или None, если
+    поток декодировать не удалось (тогда файл декодируется целиком обычным
+    путём). abort() прекращает декодирование.
+    """
+
+    def __init__(self):
+        self._chunks = queue.Queue()
+        self._result = None
+        self._aborted = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run_safe, name='upload-decoder', daemon=True)
+        self._thread.start()
+
+    def feed(self, chunk):
+        if not self._aborted:
+            self._chunks.put(chunk)
+
+    def finish(self):
+        self._chunks.put(None)
+        self._thread.join()
+        return self._result
+
+    def abort(self):
+        self._aborted = True
+        self._chunks.put(None)
+
+    def _iter_chunks(self):
+        while not self._closed:
+            chunk = self._chunks.get()
+            if chunk is None:
+                self._closed = True
+            if chunk is None or self._aborted:
+                return
+            yield chunk
+
+    def _run_safe(self):
+        try:
+            self._result = self._run()
+        except Exception as e:
+            print(f"⚠ Streaming decode failed, decoding after upload: {e}")
+            self._result = None
+        # Дочитываем очередь до конца загрузки, чтобы не копить порции после ошибки
+        while not self._closed:
+            if self._chunks.get() is None:
+                self._closed = True
+
+    @abc.abstractmethod
+    def _run(self):
+        """Декодирование порций из _iter_chunks(): результат finish() или None"""
+
+
+class WavStreamDecoder(StreamingDecoder):
+    """WAV (PCM 8/16/24/32 бит, float32/64): отсчёты переводятся во float по мере загрузки"""
+
+    # (формат, бит) -> тип отсчёта; 24 бита собираются из байтов отдельно
+    DTYPES = {(1, 8): 'u1', (1, 16): '<i2', (1, 24): None, (1, 32): '<i4', (3, 32): '<f4', (3, 64): '<f8'}
+
+    def _read_until(self, chunks, buffer, size):
+        while len(buffer) < size:
+            chunk = next(chunks, None)
+            if chunk is None:
+                return None
+            buffer += chunk
+        return buffer
+
+    def _run(self):
+        chunks = self._iter_chunks()
+        buffer = b''
+        fmt = None
+        # Чанки RIFF до начала данных
+        offset = 12
+        while True:
+            buffer = self._read_until(chunks, buffer, offset + 8)
+            if buffer is None:
+                return None
+            chunk_id = buffer[offset:offset + 4]
+            chunk_size = struct.unpack('<I', buffer[offset + 4:offset + 8])[0]
+            if chunk_id == b'data':
+                break
+            buffer = self._read_until(chunks, buffer, offset + 8 + chunk_size)
+            if buffer is None:
+                return None
+            if chunk_id == b'fmt ':
+                fmt = buffer[offset + 8:offset + 8 + chunk_size]
+            offset += 8 + chunk_size + (chunk_size & 1)
+
+        if fmt is None or len(fmt) < 16:
+            return None
+        format_tag, channels, sample_rate = struct.unpack('<HHI', fmt[:8])
+        bits = struct.unpack('<H', fmt[14:16])[0]
+        if format_tag == 0xFFFE and len(fmt) >= 26:
+            # WAVE_FORMAT_EXTENSIBLE: настоящий формат - в начале GUID подформата
+            format_tag = struct.unpack('<H', fmt[24:26])[0]
+        if (format_tag, bits) not in self.DTYPES or not channels:
+            return None
+        dtype = self.DTYPES[(format_tag, bits)]
+        frame_bytes = channels * bits // 8
+
+        # Размер 0 или 0xFFFFFFFF - запись шла потоком, данные до конца файла
+        remaining = chunk_size if chunk_size not in (0, 0xFFFFFFFF) else None
+        pending = buffer[offset + 8:]
+        parts = []
+        data_chunks = chunks if not pending else _prepend(pending, chunks)
+        pending = b''
+        for chunk in data_chunks:
+            if remaining is not None:
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+            pending += chunk
+            usable = len(pending) - len(pending) % frame_bytes
+            if usable:
+                parts.append(self._convert(pending[:usable], dtype, channels))
+                pending = pending[usable:]
+            if remaining == 0:
+                break
+
+        samples = np.concatenate(parts) if parts else np.zeros((0, channels), dtype=np.float32)
+        return {'waveform': prepare_waveform(samples, sample_rate), 'sample_rate': SAMPLE_RATE}
+
+    @staticmethod
+    def _convert(data, dtype, channels):
+        """Байты целых кадров -> float32 (кадры, каналы), как при чтении soundfile"""
+        if dtype is None:
+            raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+            samples = ((raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)) << 8 >> 8) / float(1 << 23)
+        else:
+            samples = np.frombuffer(data, dtype=dtype)
+            if dtype == 'u1':
+                samples = (samples.astype(np.float32) - 128.0) / 128.0
+            elif dtype == '<i2':
+                samples = samples / 32768.0
+            elif dtype == '<i4':
+                samples = samples / float(1 << 31)
+        return np.asarray(samples, dtype=np.float32).reshape(-1, channels)
+
+
+class FFmpegStreamDecoder(StreamingDecoder):
+    """Потоковые контейнеры (flac, ogg, mp3, wma): байты идут в stdin FFmpeg"""
+
+    def _run(self):
+        process = subprocess.Popen(
+            ['ffmpeg', '-nostdin', '-v', 'error', '-i', 'pipe:0',
+             '-ac', '1', '-ar', str(SAMPLE_RATE), '-f', 'f32le', 'pipe:1'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        output = {}
+
+        def read_output(name, stream):
+            output[name] = stream.read()
+
+        # stdout и stderr читаются каждый в своём потоке параллельно с записью:
+        # FFmpeg не блокируется, какой бы из каналов ни заполнился первым
+        readers = [
+            threading.Thread(target=read_output, args=(name, stream), name=f'upload-decoder-{name}', daemon=True)
+            for name, stream in (('stdout', process.stdout), ('stderr', process.stderr))
+        ]
+        for reader in readers:
+            reader.start()
+        try:
+            for chunk in self._iter_chunks():
+                process.stdin.write(chunk)
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        for reader in readers:
+            reader.join()
+        process.wait()
+
+        if self._aborted or process.returncode != 0:
+            if not self._aborted:
+                print(f"⚠ FFmpeg stream decoding failed: {output.get('stderr', b'').decode(errors='ignore').strip()}")
+            return None
+        data = np.frombuffer(output['stdout'], dtype=np.float32)
+        return {'waveform': torch.from_numpy(data.copy())[None], 'sample_rate': SAMPLE_RATE}
+
+
+def _prepend(first, chunks):
+    yield first
+    yield from chunks
+
+
+# m4a не декодируется потоком: индекс (moov) часто записан в конце файла
+FFMPEG_STREAM_FORMATS = {'flac', 'ogg', 'mp3', 'wma'}
+
+
+def streaming_decoder(container):
+    """Потоковый декодер для контейнера или None, если декодировать можно только целиком"""
+    if container == 'wav':
+        return WavStreamDecoder()
+    if container in FFMPEG_STREAM_FORMATS and shutil.which('ffmpeg') is not None:
+        return FFmpegStreamDecoder()
+    return None
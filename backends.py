@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Бэкенды инференса моделей pipeline на CPU
+
+- torch: исходные fp32 модели (по умолчанию)
+- int8: динамическая int8 квантизация torch. Квантуются Linear и LSTM -
+  это основная часть модели сегментации; свёртки ResNet34 эмбеддингов
+  динамической квантизации не поддаются, в ней квантуется только
+  выходной линейный слой.
+- onnx: модель сегментации и свёрточная часть модели эмбеддингов
+  экспортируются в ONNX и выполняются ONNX Runtime. Fbank-признаки и
+  взвешенный statistics pooling (маски спикеров) остаются в torch.
+
+Бэкенд подменяет только прямой проход моделей (forward), поэтому Inference,
+батчинг и остальной pipeline работают без изменений. Перед включением
+бэкенда сравните DER с эталоном: python benchmark.py --backend int8
+"""
+
+import hashlib
+import inspect
+import os
+import tempfile
+import threading
+
+import torch
+import torch.nn.functional as F
+
+BACKENDS = ('torch', 'int8', 'onnx')
+ONNX_OPSET = 17
+
+
+def model_fingerprint(model):
+    """Хэш весов модели: имя файла ONNX в кэше"""
+    digest = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        digest.update(name.encode())
+        if torch.is_tensor(tensor):
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def export_onnx(module, example, path, input_name, output_name, dynamic_axes):
+    """Экспорт модуля в ONNX (через временный файл, чтобы не оставить битый кэш)"""
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # Новые версии torch по умолчанию используют dynamo-экспорт
+        kwargs['dynamo'] = False
+
+    tmp_path = path + '.tmp'
+    with torch.no_grad():
+        torch.onnx.export(
+            module, (example,), tmp_path,
+            input_names=[input_name], output_names=[output_name],
+            dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET, **kwargs
+        )
+    os.replace(tmp_path, path)
+
+
+class OnnxSession:
+    """
+    Сессия ONNX Runtime, создаваемая при первом вызове в процессе
+
+    serve.py загружает pipeline в родителе до fork, а число потоков
+    torch задаёт каждому воркеру после fork. Сессия, созданная в родителе,
+    получила бы пул потоков родителя (все ядра), поэтому она создаётся
+    лениво в процессе, который её использует, с его torch.get_num_threads().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def run(self, output_names, feeds):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._session = self._create()
+                    self._pid = os.getpid()
+        return self._session.run(output_names, feeds)
+
+    def _create(self):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        # Бюджет потоков процесса для torch (в воркерах serve.py - его доля CPU)
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return ort.InferenceSession(self.path, options, providers=['CPUExecutionProvider'])
+
+
+class _ResNetTrunk(torch.nn.Module):
+    """Свёрточная часть WeSpeaker ResNet: fbank -> карта признаков до pooling"""
+
+    def __init__(self, resnet):
+        super().__init__()
+        self.resnet = resnet
+
+    def forward(self, fbank):
+        x = fbank.permute(0, 2, 1).unsqueeze(1)
+        out = F.relu(self.resnet.bn1(self.resnet.conv1(x)))
+        out = self.resnet.layer1(out)
+        out = self.resnet.layer2(out)
+        out = self.resnet.layer3(out)
+        return self.resnet.layer4(out)
+
+
+def segmentation_to_onnx(model, cache_dir, num_samples):
+    path = os.path.join(cache_dir, f'segmentation-{model_fingerprint(model)}.onnx')
+    if not os.path.exists(path):
+        example = torch.zeros(1, 1, num_samples)
+        export_onnx(model, example, path, 'waveforms', 'output',
+                    {'waveforms': {0: 'batch', 2: 'samples'}, 'output': {0: 'batch', 1: 'frames'}})
+        model.eval()
+    session = OnnxSession(path)
+
+    def forward(waveforms):
+        output = session.run(None, {'waveforms': waveforms.detach().cpu().numpy()})[0]
+        return torch.from_numpy(output)
+
+    model.forward = forward
+
+
+def embedding_to_onnx(model, cache_dir, num_samples):
+    resnet = model.resnet
+    path = os.path.join(cache_dir, f'embedding-{model_fingerprint(model)}.onnx')
+    if not os.path.exists(path):
+        example = model.compute_fbank(torch.zeros(1, 1, num_samples))
+        export_onnx(_ResNetTrunk(resnet), example, path, 'fbank', 'features',
+                    {'fbank': {0: 'batch', 1: 'frames'}, 'features': {0: 'batch', 3: 'frames'}})
+        model.eval()
+    session = OnnxSession(path)
+
+    def forward(waveforms, weights=None):
+        fbank = model.compute_fbank(waveforms)
+        features = torch.from_numpy(session.run(None, {'fbank': fbank.detach().cpu().numpy()})[0])
+        # Взвешенный pooling и выходные слои - как в ResNet.forward
+        embed_a = resnet.seg_1(resnet.pool(features, weights=weights))
+        if resnet.two_emb_layer:
+            return resnet.seg_2(resnet.seg_bn_1(F.relu(embed_a)))
+        return embed_a
+
+    model.forward = forward
+
+
+def quantize_int8(model):
+    torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8, inplace=True
+    )
+
+
+def apply_backend(pipeline, backend, cache_dir=None):
+    """
+    Перевод моделей pipeline на выбранный бэкенд (на месте)
+
+    Возвращает имя фактически применённого бэкенда: на GPU и для моделей,
+    которые не удалось перевести, остаётся 'torch'.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}', expected one of {', '.join(BACKENDS)}")
+    if backend == 'torch':
+        return backend
+
+    segmentation = pipeline._segmentation.model
+    embedding = pipeline._embedding.model_
+    if pipeline._segmentation.device.type != 'cpu':
+        print(f"⚠ Warning: Inference backend '{backend}' is CPU-only, using torch on {pipeline._segmentation.device}")
+        return 'torch'
+
+    if backend == 'int8':
+        quantize_int8(segmentation)
+        quantize_int8(embedding)
+        print("✓ Inference backend: dynamic int8 quantization (Linear, LSTM)")
+        return backend
+
+    try:
+        import onnxruntime  # noqa: F401
+    except ImportError:
+        print("⚠ Warning: onnxruntime is not installed (pip install onnxruntime), using torch")
+        return 'torch'
+
+    cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), 'diarization-onnx')
+    os.makedirs(cache_dir, exist_ok=True)
+    # Pipeline всегда подаёт чанки фиксированной длины (окно сегментации)
+    num_samples = segmentation.audio.get_num_samples(pipeline._segmentation.duration)
+
+    segmentation_to_onnx(segmentation, cache_dir, num_samples)
+    if hasattr(embedding, 'resnet') and hasattr(embedding, 'compute_fbank'):
+        embedding_to_onnx(embedding, cache_dir, num_samples)
+        print(f"✓ Inference backend: ONNX Runtime (models cached in {cache_dir})")
+    else:
+        print(f"✓ Inference backend: ONNX Runtime for segmentation, "
+              f"torch for {type(embedding).__name__} embeddings")
+    return backend
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Динамический батчинг инференса между параллельными запросами
+
+Pipeline сам формирует батчи (segmentation_batch_size, embedding_batch_size)
+только в пределах одного файла, и на коротких записях они остаются
+полупустыми. DynamicBatcher собирает вызовы модели из нескольких потоков
+в общий прямой проход: ждёт не дольше max_wait, склеивает входы по первой
+оси, выполняет модель один раз и раздаёт каждому вызову его часть выхода.
+Дальше каждый запрос продолжает свой pipeline (кластеризацию и т.д.) как обычно.
+"""
+
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+from pyannote.audio.core.inference import BaseInference
+
+
+class _BatchRequest:
+    def __init__(self, args, kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.size = args[0].shape[0]
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def signature(self):
+        """Запросы с одинаковой сигнатурой можно склеить в один батч"""
+        shapes = tuple(tuple(arg.shape[1:]) for arg in self.args)
+        kwargs = tuple(
+            (name, tuple(value.shape[1:]) if torch.is_tensor(value) else value is None)
+            for name, value in sorted(self.kwargs.items())
+        )
+        return shapes, kwargs
+
+
+def _split(output, sizes):
+    """Разбиение выхода модели (массив или кортеж массивов) по размерам запросов"""
+    if isinstance(output, tuple):
+        parts = [_split(item, sizes) for item in output]
+        return [tuple(part[i] for part in parts) for i in range(len(sizes))]
+    return np.split(output, np.cumsum(sizes)[:-1])
+
+
+class DynamicBatcher:
+    """
+    Объединение вызовов fn(*tensors, **tensors) из разных потоков
+
+    Все тензорные аргументы должны иметь общую первую (батчевую) ось,
+    fn должна возвращать np.ndarray (или кортеж) с той же первой осью.
+    """
+
+    def __init__(self, fn, max_batch_size=64, max_wait=0.01, name='batcher'):
+        self.fn = fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait))
+        self.name = name
+
+        self._queue = queue.Queue()
+        self._carry = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._requests = 0
+
+    def __call__(self, *args, **kwargs):
+        self._ensure_started()
+        request = _BatchRequest(args, kwargs)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self._batches,
+                'items': self._items,
+                'requests': self._requests,
+                'avg_batch_size': round(self._items / self._batches, 2) if self._batches else None,
+                'avg_requests_per_batch': round(self._requests / self._batches, 2) if self._batches else None,
+            }
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        """Сбор запросов для одного прохода: до max_batch_size или max_wait"""
+        first = self._carry if self._carry is not None else self._queue.get()
+        self._carry = None
+        batch = [first]
+        size = first.size
+        deadline = time.monotonic() + self.max_wait
+
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if size + request.size > self.max_batch_size:
+                # Не помещается - уйдёт первым в следующий батч
+                self._carry = request
+                break
+            batch.append(request)
+            size += request.size
+
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.signature(), []).append(request)
+
+            for group in groups.values():
+                self._run(group)
+
+    def _run(self, group):
+        try:
+            if len(group) == 1:
+                request = group[0]
+                outputs = [self.fn(*request.args, **request.kwargs)]
+            else:
+                args = [torch.cat([r.args[i] for r in group]) for i in range(len(group[0].args))]
+                kwargs = {
+                    name: torch.cat([r.kwargs[name] for r in group]) if torch.is_tensor(value) else value
+                    for name, value in group[0].kwargs.items()
+                }
+                outputs = _split(self.fn(*args, **kwargs), [r.size for r in group])
+
+            for request, output in zip(group, outputs):
+                request.result = output
+        except Exception as e:
+            for request in group:
+                request.error = e
+        finally:
+            with self._lock:
+                self._batches += 1
+                self._items += sum(r.size for r in group)
+                self._requests += len(group)
+            for request in group:
+                request.done.set()
+
+
+class BatchedEmbedding(BaseInference):
+    """
+    Обёртка над моделью эмбеддингов pipeline с общим батчером
+
+    Наследуется от BaseInference, чтобы Pipeline.to() и прочие механизмы
+    pyannote видели её так же, как исходную модель.
+    """
+
+    def __init__(self, embedding, batcher):
+        self._wrapped = embedding
+        self._batcher = batcher
+
+    def __getattr__(self, name):
+        # До __init__ (copy, pickle) _wrapped ещё нет: нужен AttributeError
+        wrapped = self.__dict__.get('_wrapped')
+        if wrapped is None:
+            raise AttributeError(name)
+        return getattr(wrapped, name)
+
+    def to(self, device):
+        self._wrapped.to(device)
+        return self
+
+    def __call__(self, waveforms, masks=None):
+        return self._batcher(waveforms, masks=masks)
+
+
+def enable_dynamic_batching(pipeline, max_batch_size=64, max_wait=0.01):
+    """
+    Установка батчеров на модели сегментации и эмбеддингов pipeline
+
+    Возвращает словарь батчеров {'segmentation': ..., 'embedding': ...}.
+    Pipeline после этого можно вызывать из нескольких потоков одновременно.
+    """
+    segmentation = pipeline._segmentation
+    segmentation_batcher = DynamicBatcher(
+        segmentation.infer, max_batch_size=max_batch_size,
+        max_wait=max_wait, name='segmentation-batcher'
+    )
+    segmentation.infer = segmentation_batcher
+
+    embedding = pipeline._embedding
+    embedding_batcher = DynamicBatcher(
+        embedding.__call__, max_batch_size=max_batch_size,
+        max_wait=max_wait, name='embedding-batcher'
+    )
+    pipeline._embedding = BatchedEmbedding(embedding, embedding_batcher)
+
+    print(f"✓ Dynamic batching enabled: max batch {max_batch_size}, max wait {max_wait * 1000:.0f} ms")
+    return {'segmentation': segmentation_batcher, 'embedding': embedding_batcher}
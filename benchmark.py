@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк pipeline сервиса на эталонных RTTM из reproducible_research
+
+Для каждого эталонного файла (AMI, VoxConverse, DIHARD, ...) ищется аудио
+<audio-dir>/<uri>.<ext>, запускается тот же pipeline, что использует сервис,
+и считаются real-time factor, латентность p50/p95, пиковый RSS (отдельно
+для каждого прогона) и DER относительно эталонной разметки. Если корпусов
+нет, используется синтетическое аудио с известной разметкой. Отчёт
+сохраняется в JSON.
+
+С --backend прогоняются два pipeline - исходный (torch fp32) и выбранный
+бэкенд инференса (int8/onnx), и проверяется порог точности: если DER
+бэкенда выше исходного больше чем на --max-der-increase процентных
+пунктов, скрипт завершается с кодом 1.
+
+С --clustering fast так же сравниваются движки кластеризации: исходный
+AgglomerativeClustering и fast (fast_clustering.py) на одних и тех же
+файлах. Для каждого файла отдельно замеряются время кластеризации и пик
+памяти numpy-массивов в ней; --synthetic-speakers задаёт число спикеров
+в синтетических записях.
+
+Пример:
+    python benchmark.py --audio-dir /data/ami --datasets AMI --output report.json
+    python benchmark.py --synthetic 5
+    python benchmark.py --audio-dir /data/ami --backend onnx --max-der-increase 0.5
+    python benchmark.py --audio-dir /data/ami --clustering fast
+    python benchmark.py --synthetic 2 --synthetic-duration 1800 --synthetic-speakers 20 --clustering fast
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+DEFAULT_RTTM_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'models', 'pyannote', 'speaker-diarization-3', 'reproducible_research'
+)
+AUDIO_EXTENSIONS = ('wav', 'flac', 'mp3', 'ogg', 'm4a', 'sph')
+SYNTHETIC_SAMPLE_RATE = 16000
+
+
+def load_rttm(path):
+    """Чтение RTTM в словарь {uri: Annotation}"""
+    from pyannote.core import Annotation, Segment
+
+    annotations = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 8 or fields[0] != 'SPEAKER':
+                continue
+            uri, start, duration, speaker = fields[1], float(fields[3]), float(fields[4]), fields[7]
+            annotation = annotations.setdefault(uri, Annotation(uri=uri))
+            annotation[Segment(start, start + duration), len(annotation)] = speaker
+    return annotations
+
+
+def load_published_der(path):
+    """DER из .eval файла (опубликованный результат pipeline) в виде {uri: DER %}"""
+    published = {}
+    if not os.path.exists(path):
+        return published
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f.readlines()[3:]:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            try:
+                published[fields[0]] = float(fields[1])
+            except ValueError:
+                continue
+    return published
+
+
+def find_audio(audio_dir, uri):
+    for extension in AUDIO_EXTENSIONS:
+        matches = glob.glob(os.path.join(audio_dir, '**', f'{uri}.{extension}'), recursive=True)
+        if matches:
+            return matches[0]
+    return None
+
+
+def collect_items(rttm_dir, audio_dir, datasets=None, limit=None):
+    """Пары (эталон, аудио) для наборов данных, аудио которых есть локально"""
+    items = []
+    for rttm_path in sorted(glob.glob(os.path.join(rttm_dir, '*.rttm'))):
+        dataset = os.path.basename(rttm_path).split('.')[0]
+        if datasets and dataset not in datasets:
+            continue
+        published = load_published_der(rttm_path[:-len('.rttm')] + '.eval')
+        found = 0
+        for uri, reference in load_rttm(rttm_path).items():
+            if limit and found >= limit:
+                break
+            audio_path = find_audio(audio_dir, uri) if audio_dir else None
+            if audio_path is None:
+                continue
+            items.append({
+                'dataset': dataset,
+                'uri': uri,
+                'audio_path': audio_path,
+                'reference': reference,
+                'published_der': published.get(uri),
+            })
+            found += 1
+    return items
+
+
+def synthetic_speech(duration, num_speakers=3, rng=None, sample_rate=SYNTHETIC_SAMPLE_RATE, gap=(-0.3, 1.5)):
+    """
+    Синтетическая запись: waveform (float32) и реплики [(start, end, speaker)]
+
+    Каждый "спикер" - гармонический сигнал со своей основной частотой и
+    амплитудной модуляцией. Между репликами пауза из диапазона gap секунд;
+    отрицательная нижняя граница даёт короткие перекрытия.
+    """
+    rng = rng if rng is not None else np.random.default_rng(0)
+    samples = int(duration * sample_rate)
+    waveform = 0.005 * rng.standard_normal(samples).astype(np.float32)
+    f0 = rng.uniform(90, 260, size=num_speakers)
+    turns = []
+
+    t = rng.uniform(0.2, 1.0)
+    while t < duration - 1.0:
+        speaker = int(rng.integers(num_speakers))
+        turn = min(rng.uniform(1.0, 6.0), duration - t)
+        start, end = int(t * sample_rate), min(samples, int((t + turn) * sample_rate))
+        time_axis = np.arange(end - start) / sample_rate
+        voice = sum(np.sin(2 * np.pi * f0[speaker] * k * time_axis) / k for k in range(1, 6))
+        envelope = 0.5 + 0.5 * np.sin(2 * np.pi * rng.uniform(3, 6) * time_axis)
+        waveform[start:end] += (0.1 * voice * envelope).astype(np.float32)
+        turns.append((t, t + turn, speaker))
+        t += turn + rng.uniform(*gap)
+
+    return waveform, turns
+
+
+def synthetic_items(count, duration=60.0, num_speakers=3, seed=0):
+    """Синтетические записи (synthetic_speech) с известной разметкой"""
+    import torch
+    from pyannote.core import Annotation, Segment
+
+    rng = np.random.default_rng(seed)
+    items = []
+    for index in range(count):
+        waveform, turns = synthetic_speech(duration, num_speakers, rng)
+        reference = Annotation(uri=f'synthetic_{index:03d}')
+        for start, end, speaker in turns:
+            reference[Segment(start, end), len(reference)] = f'spk{speaker}'
+
+        items.append({
+            'dataset': 'synthetic',
+            'uri': reference.uri,
+            'audio': {'waveform': torch.from_numpy(waveform)[None], 'sample_rate': SYNTHETIC_SAMPLE_RATE},
+            'reference': reference,
+            'published_der': None,
+        })
+    return items
+
+
+def current_rss_bytes():
+    """Текущий RSS процесса в байтах"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except Exception:
+        return None
+
+
+class RssSampler:
+    """
+    Пиковый RSS за время одного прогона
+
+    ru_maxrss - пик за всю жизнь процесса: при двух прогонах в одном
+    процессе пик второго был бы не меньше пика первого. Поэтому текущий
+    RSS опрашивается фоновым потоком с interval, и пик считается заново
+    для каждого прогона.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_bytes = None
+        self._stop = None
+        self._thread = None
+
+    def _sample(self):
+        rss = current_rss_bytes()
+        if rss is not None:
+            self.peak_bytes = max(self.peak_bytes or 0, rss)
+        return rss is not None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        import threading
+
+        self.peak_bytes = None
+        self._stop = threading.Event()
+        if self._sample():
+            self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._sample()
+
+    @property
+    def peak_mb(self):
+        return round(self.peak_bytes / 1024 / 1024, 1) if self.peak_bytes is not None else None
+
+
+class ClusteringTimer:
+    """
+    Обёртка под-pipeline кластеризации: время и пик памяти последнего вызова
+
+    Время замеряется без tracemalloc: трассировка выделений замедляет код
+    на numpy и исказила бы задержку и RTF. С trace_memory аргументы вызова
+    сохраняются, и measure_memory() повторяет кластеризацию под tracemalloc
+    отдельным проходом - уже после замера времени всего pipeline. В пик
+    входят массивы numpy (матрицы расстояний, дендрограмма), но не буферы
+    внутри BLAS.
+    """
+
+    def __init__(self, clustering, trace_memory=False):
+        self.clustering = clustering
+        self.trace_memory = trace_memory
+        self.seconds = 0.0
+        self.peak_bytes = None
+        self._last_call = None
+
+    def __getattr__(self, name):
+        return getattr(self.clustering, name)
+
+    def __call__(self, *args, **kwargs):
+        if self.trace_memory:
+            self._last_call = (args, kwargs)
+        start = time.perf_counter()
+        try:
+            return self.clustering(*args, **kwargs)
+        finally:
+            self.seconds = time.perf_counter() - start
+
+    def measure_memory(self):
+        """Пик памяти повторной кластеризации с аргументами последнего вызова"""
+        import tracemalloc
+
+        self.peak_bytes = None
+        if self._last_call is None:
+            return None
+        args, kwargs = self._last_call
+        self._last_call = None
+        tracemalloc.start()
+        try:
+            self.clustering(*args, **kwargs)
+            self.peak_bytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return self.peak_bytes
+
+
+def percentile(values, q):
+    return round(float(np.percentile(values, q)), 3) if values else None
+
+
+def run_benchmark(model, items, collar=0.0, skip_overlap=False, pipeline_kwargs=None, label='pipeline',
+                  trace_memory=False):
+    """
+    Прогон pipeline по items, возвращает отчёт (словарь)
+
+    trace_memory - отдельным проходом замерить пик памяти кластеризации
+    (на время и RTF не влияет)
+    """
+    from pyannote.metrics.diarization import DiarizationErrorRate
+
+    metric = DiarizationErrorRate(collar=collar, skip_overlap=skip_overlap)
+    files = []
+    latencies = []
+    total_audio = 0.0
+    total_processing = 0.0
+    total_clustering = 0.0
+    clustering_peak = None
+
+    timer = ClusteringTimer(model._pipelines['clustering'], trace_memory=trace_memory)
+    model._pipelines['clustering'] = timer
+    try:
+        with RssSampler() as rss:
+            for item in items:
+                report = benchmark_item(model, item, metric, pipeline_kwargs)
+                latencies.append(report.pop('elapsed'))
+                total_audio += report['duration_seconds']
+                total_processing += latencies[-1]
+                total_clustering += timer.seconds
+                report['clustering_seconds'] = round(timer.seconds, 3)
+                if trace_memory and timer.measure_memory() is not None:
+                    clustering_peak = max(clustering_peak or 0, timer.peak_bytes)
+                    report['clustering_peak_mb'] = round(timer.peak_bytes / 1024 / 1024, 1)
+                files.append(report)
+                print(f"  {report['dataset']}/{report['uri']}: {report['duration_seconds']:.1f}s audio in "
+                      f"{latencies[-1]:.2f}s (RTF {report['rtf']}), clustering {timer.seconds:.2f}s, "
+                      f"DER {report['der']:.2f}%")
+    finally:
+        model._pipelines['clustering'] = timer.clustering
+
+    return {
+        'label': label,
+        'files': files,
+        'summary': {
+            'files': len(files),
+            'audio_seconds': round(total_audio, 2),
+            'processing_seconds': round(total_processing, 2),
+            'rtf': round(total_processing / total_audio, 4) if total_audio else None,
+            'latency_p50_seconds': percentile(latencies, 50),
+            'latency_p95_seconds': percentile(latencies, 95),
+            'clustering_seconds': round(total_clustering, 3),
+            'clustering_peak_mb': round(clustering_peak / 1024 / 1024, 1) if clustering_peak is not None else None,
+            'peak_rss_mb': rss.peak_mb,
+            'der': round(100 * abs(metric), 2) if files else None,
+        },
+    }
+
+
+def benchmark_item(model, item, metric, pipeline_kwargs=None):
+    """Диаризация одного файла и его DER (metric накапливает итог)"""
+    from pyannote.core import Segment, Timeline
+
+    from audio_io import decode_audio, waveform_duration
+
+    if 'audio' in item:
+        audio = item['audio']
+    else:
+        with open(item['audio_path'], 'rb') as f:
+            audio = decode_audio(f.read(), item['audio_path'])
+    duration = waveform_duration(audio)
+
+    start = time.perf_counter()
+    hypothesis = model(audio, **(pipeline_kwargs or {}))
+    elapsed = time.perf_counter() - start
+
+    uem = Timeline([Segment(0.0, duration)])
+    der = metric(item['reference'], hypothesis, uem=uem)
+    return {
+        'dataset': item['dataset'],
+        'uri': item['uri'],
+        'duration_seconds': round(duration, 2),
+        'processing_time_seconds': round(elapsed, 3),
+        'rtf': round(elapsed / duration, 4) if duration else None,
+        'der': round(100 * der, 2),
+        'published_der': item['published_der'],
+        'speakers': len(hypothesis.labels()),
+        'reference_speakers': len(item['reference'].labels()),
+        'elapsed': elapsed,
+    }
+
+
+def accuracy_gate(baseline, candidate, max_der_increase):
+    """Сравнение итогов двух прогонов: прирост DER и ускорение"""
+    der_increase = None
+    if baseline['der'] is not None and candidate['der'] is not None:
+        der_increase = round(candidate['der'] - baseline['der'], 2)
+    speedup = None
+    if baseline['processing_seconds'] and candidate['processing_seconds']:
+        speedup = round(baseline['processing_seconds'] / candidate['processing_seconds'], 2)
+    return {
+        'max_der_increase': max_der_increase,
+        'der_increase': der_increase,
+        'speedup': speedup,
+        'passed': der_increase is not None and der_increase <= max_der_increase,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the diarization pipeline against reference RTTMs')
+    parser.add_argument('--audio-dir', help='Directory with audio files named <uri>.<ext>')
+    parser.add_argument('--rttm-dir', default=DEFAULT_RTTM_DIR, help='Directory with reference .rttm/.eval files')
+    parser.add_argument('--datasets', nargs='*', help='Datasets to use, e.g. AMI VoxConverse (default: all)')
+    parser.add_argument('--limit', type=int, default=None, help='Max files per dataset')
+    parser.add_argument('--synthetic', type=int, default=3,
+                        help='Number of synthetic files when no corpus audio is found (default: 3)')
+    parser.add_argument('--synthetic-duration', type=float, default=60.0, help='Synthetic file duration, seconds')
+    parser.add_argument('--synthetic-speakers', type=int, default=3, help='Speakers per synthetic file (default: 3)')
+    parser.add_argument('--collar', type=float, default=0.0, help='DER collar, seconds')
+    parser.add_argument('--skip-overlap', action='store_true', help='Ignore overlapping speech in DER')
+    parser.add_argument('--backend', choices=('int8', 'onnx'), default=None,
+                        help='Compare this inference backend against torch fp32 and apply the accuracy gate')
+    parser.add_argument('--clustering', choices=('fast',), default=None,
+                        help='Compare this clustering engine against AgglomerativeClustering and apply the accuracy gate')
+    parser.add_argument('--max-der-increase', type=float, default=1.0,
+                        help='Accuracy gate: max allowed DER increase of --backend or --clustering, '
+                             'percentage points (default: 1.0)')
+    parser.add_argument('--output', default='benchmark_report.json', help='JSON report path')
+    args = parser.parse_args()
+    if args.backend and args.clustering:
+        parser.error('--backend and --clustering cannot be combined')
+    return args
+
+
+def main():
+    args = parse_args()
+
+    items = collect_items(args.rttm_dir, args.audio_dir, datasets=args.datasets, limit=args.limit)
+    if items:
+        print(f"Found {len(items)} reference file(s) with local audio")
+    else:
+        print(f"⚠ No corpus audio found for reference RTTMs, using {args.synthetic} synthetic file(s)")
+        items = synthetic_items(args.synthetic, duration=args.synthetic_duration,
+                                num_speakers=args.synthetic_speakers)
+
+    import diarization_service
+    device = diarization_service.get_device()
+
+    baseline = None
+    if args.backend:
+        model = diarization_service.create_pipeline(device, backend='torch')
+        print(f"Running baseline (torch) on {device}...")
+        baseline = run_benchmark(model, items, collar=args.collar, skip_overlap=args.skip_overlap, label='torch')
+        del model
+        model = diarization_service.create_pipeline(device, backend=args.backend)
+        label = diarization_service.inference_backend
+    elif args.clustering:
+        # Модели общие, копии pipeline отличаются только под-pipeline кластеризации
+        from pipeline_params import instantiate_variant
+        base = diarization_service.load_pipeline()
+        options = {'max_groups': diarization_service.CLUSTERING_MAX_GROUPS}
+        model = instantiate_variant(base, {'clustering': 'agglomerative'}, options)
+        print(f"Running baseline (agglomerative clustering) on {device}...")
+        baseline = run_benchmark(model, items, collar=args.collar, skip_overlap=args.skip_overlap,
+                                 label='agglomerative', trace_memory=True)
+        model = instantiate_variant(base, {'clustering': args.clustering}, options)
+        label = f'{args.clustering} clustering'
+    else:
+        model = diarization_service.load_pipeline()
+        label = 'pipeline'
+
+    print(f"Running benchmark ({label}) on {device}...")
+    report = run_benchmark(model, items, collar=args.collar, skip_overlap=args.skip_overlap, label=label,
+                           trace_memory=bool(args.clustering))
+    report.update({
+        'device': str(device),
+        'model': diarization_service.MODEL_PATH,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    })
+    if baseline is not None:
+        report['baseline'] = baseline
+        report['gate'] = accuracy_gate(baseline['summary'], report['summary'], args.max_der_increase)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    summary = report['summary']
+    print(f"\n{'='*60}")
+    print(f"Files: {summary['files']}, audio: {summary['audio_seconds']}s")
+    print(f"RTF: {summary['rtf']}  p50: {summary['latency_p50_seconds']}s  p95: {summary['latency_p95_seconds']}s")
+    print(f"Peak RSS: {summary['peak_rss_mb']} MB  DER: {summary['der']}%")
+    if summary['clustering_peak_mb'] is not None:
+        print(f"Clustering: {summary['clustering_seconds']}s, peak {summary['clustering_peak_mb']} MB")
+    else:
+        print(f"Clustering: {summary['clustering_seconds']}s")
+    if baseline is not None:
+        gate = report['gate']
+        base = baseline['summary']
+        peak = f", peak {base['clustering_peak_mb']} MB" if base['clustering_peak_mb'] is not None else ''
+        print(f"Baseline ({baseline['label']}) RTF: {base['rtf']}  DER: {base['der']}%  "
+              f"clustering: {base['clustering_seconds']}s{peak}")
+        print(f"Speedup: {gate['speedup']}x  DER increase: {gate['der_increase']} pp "
+              f"(max {gate['max_der_increase']}) -> {'PASSED' if gate['passed'] else 'FAILED'}")
+    print(f"Report saved to {args.output}")
+    print(f"{'='*60}")
+
+    if baseline is not None and not report['gate']['passed']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
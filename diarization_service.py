@@ -4,14 +4,33 @@ Flask сервис для диаризации аудио
 Запускается как отдельный микросервис с авторизацией по Bearer token
 """
 
+import hashlib
+import io
 import os
+import sys
 import json
+import queue
 import tempfile
-import torch
-from flask import Flask, request, jsonify
+import threading
+import time
+from flask import Flask, Request, request, jsonify, Response, g, send_file
+from werkzeug.exceptions import UnsupportedMediaType
 from werkzeug.utils import secure_filename
 from functools import wraps
-from pyannote.audio import Pipeline
+
+# torch, pyannote.audio и модули, которые их используют (audio_io, longform,
+# batching, snapshot), импортируются лениво: /health отвечает сразу после
+# старта процесса, а модель загружается и прогревается в фоне
+from job_queue import JobQueue, QueueFullError, JOB_DONE, JOB_RUNNING
+from result_cache import ResultCache, cache_key, copy_and_hash, hash_bytes
+from metrics import Registry, StageTimer, process_rss_bytes
+from speaker_store import SpeakerStore
+from formats import FORMATS, FormatUnavailable, SegmentTable, negotiate, render
+from pipeline_params import PipelineVariants, parse_params
+from postprocess import apply_postprocess, parse_postprocess
+from sessions import SessionStore
+from memory_budget import MB, DeviceMemory
+from profiling import ProfileStore
 
 # Загрузка переменных окружения из .env файла
 from dotenv import load_dotenv
@@ -69,20 +88,276 @@ def setup_proxy():
 
 setup_proxy()
 
-app = Flask(__name__)
-
 # Конфигурация
 BEARER_TOKEN = os.getenv('DIARIZATION_TOKEN', 'your-secret-token-here')
 MODEL_PATH = os.getenv('PYANNOTE_MODEL_PATH', './models/pyannote-speaker-diarization-3.1')
-MAX_FILE_SIZE = 100 * 1024 * 1024  # 100 MB
+# Снимок pipeline (создаётся download_model.py), по умолчанию рядом с моделью
+SNAPSHOT_PATH = os.getenv('PYANNOTE_SNAPSHOT_PATH') or os.path.join(MODEL_PATH, 'pipeline_snapshot.pt')
+MAX_FILE_SIZE = int(os.getenv('MAX_CONTENT_LENGTH', 100 * 1024 * 1024))  # 100 MB
+# Запас на заголовки multipart и поля формы сверх размера файла
+MULTIPART_OVERHEAD = 64 * 1024
 ALLOWED_EXTENSIONS = {'mp3', 'wav', 'ogg', 'm4a', 'flac', 'wma'}
 
+# Режим длинных записей: обработка окнами с потоковой выдачей (NDJSON)
+LONGFORM_MAX_FILE_SIZE = int(os.getenv('LONGFORM_MAX_FILE_SIZE', 2 * 1024 * 1024 * 1024))  # 2 GB
+LONGFORM_WINDOW = float(os.getenv('LONGFORM_WINDOW', 300))  # секунды
+LONGFORM_OVERLAP = float(os.getenv('LONGFORM_OVERLAP', 30))  # секунды
+
+# Очередь задач: количество воркеров, владеющих pipeline, и размер очереди
+WORKERS = int(os.getenv('DIARIZATION_WORKERS', 1))
+QUEUE_SIZE = int(os.getenv('DIARIZATION_QUEUE_SIZE', 16))
+JOB_RESULT_TTL = int(os.getenv('DIARIZATION_JOB_TTL', 3600))  # секунды
+SYNC_TIMEOUT = int(os.getenv('DIARIZATION_SYNC_TIMEOUT', 3600))  # секунды
+# Предвыборка: столько задач из очереди декодируется заранее, пока воркеры
+# заняты инференсом (0 - декодирование в воркере, как раньше)
+PREFETCH = int(os.getenv('DIARIZATION_PREFETCH', 2))
+
+# Динамический батчинг: воркеры делят один pipeline, а чанки разных запросов
+# объединяются в общие прямые проходы сегментации и эмбеддингов
+BATCHING = os.getenv('DIARIZATION_BATCHING', '0').lower() in ('1', 'true', 'yes')
+BATCH_MAX_SIZE = int(os.getenv('DIARIZATION_BATCH_MAX_SIZE', 64))
+BATCH_MAX_WAIT_MS = float(os.getenv('DIARIZATION_BATCH_MAX_WAIT_MS', 10))
+
+# Допуск задач по памяти устройства: бюджет на GPU - доля памяти за вычетом
+# весов моделей; DIARIZATION_MEMORY_BUDGET_MB задаёт бюджет явно (в том числе
+# на CPU, где по умолчанию ограничения нет). Коэффициенты оценки пика - в MB
+MEMORY_BUDGET_MB = float(os.getenv('DIARIZATION_MEMORY_BUDGET_MB', 0))
+MEMORY_FRACTION = float(os.getenv('DIARIZATION_MEMORY_FRACTION', 0.9))
+MEMORY_PER_AUDIO_SECOND_MB = float(os.getenv('DIARIZATION_MEMORY_PER_AUDIO_SECOND_MB', 0.1))
+MEMORY_PER_SEGMENTATION_ITEM_MB = float(os.getenv('DIARIZATION_MEMORY_PER_SEGMENTATION_ITEM_MB', 8))
+MEMORY_PER_EMBEDDING_ITEM_MB = float(os.getenv('DIARIZATION_MEMORY_PER_EMBEDDING_ITEM_MB', 48))
+OOM_RETRIES = int(os.getenv('DIARIZATION_OOM_RETRIES', 3))
+
+# Хранилище эмбеддингов известных спикеров и порог косинусного сходства
+# (по умолчанию выводится из порога кластеризации в config.yaml)
+SPEAKER_STORE_DIR = os.getenv('SPEAKER_STORE_DIR', './speakers')
+SPEAKER_MATCH_THRESHOLD = os.getenv('SPEAKER_MATCH_THRESHOLD')
+
+# Бэкенд инференса на CPU: torch (fp32), int8 (динамическая квантизация)
+# или onnx (ONNX Runtime, модели экспортируются в DIARIZATION_ONNX_DIR)
+INFERENCE_BACKEND = os.getenv('DIARIZATION_BACKEND', 'torch').lower()
+ONNX_CACHE_DIR = os.getenv('DIARIZATION_ONNX_DIR') or (
+    os.path.join(MODEL_PATH, 'onnx') if os.path.isdir(MODEL_PATH) else None
+)
+
+# Энергетический VAD: паузы длиннее VAD_MIN_SILENCE секунд вырезаются
+# до запуска pipeline (включается по умолчанию или полем vad=1 в запросе)
+VAD = os.getenv('DIARIZATION_VAD', '0').lower() in ('1', 'true', 'yes')
+VAD_MIN_SILENCE = float(os.getenv('DIARIZATION_VAD_MIN_SILENCE', 2.0))
+
+# Реплики pipeline по устройствам: список (cuda:0,cuda:1 или cpu,cpu для
+# нескольких реплик на CPU) или auto - все видимые видеокарты. У каждой
+# реплики DIARIZATION_WORKERS воркеров, задача уходит в наименее загруженную.
+# Пусто - одна реплика на автоматически выбранном устройстве
+DEVICES = os.getenv('DIARIZATION_DEVICES', '').strip()
+
+# Гиперпараметры в запросе (clustering_threshold, min_cluster_size,
+# min_duration_off): число закэшированных копий pipeline с такими параметрами
+PARAM_CACHE_SIZE = int(os.getenv('DIARIZATION_PARAM_CACHE_SIZE', 8))
+
+# Движок кластеризации: agglomerative (pyannote) или fast (блочные float32
+# расстояния и предварительная группировка больше CLUSTERING_MAX_GROUPS
+# эмбеддингов); в запросе - поле clustering
+CLUSTERING = os.getenv('DIARIZATION_CLUSTERING', 'agglomerative').lower()
+CLUSTERING_MAX_GROUPS = int(os.getenv('DIARIZATION_CLUSTERING_MAX_GROUPS', 2000))
+
+# Сессии инкрементальной диаризации растущих записей (/sessions):
+# неактивная дольше SESSION_TTL секунд сессия удаляется
+SESSION_TTL = int(os.getenv('DIARIZATION_SESSION_TTL', 3600))
+MAX_SESSIONS = int(os.getenv('DIARIZATION_MAX_SESSIONS', 32))
+
+# Прогрев модели после загрузки: прогон pipeline на WARMUP_SECONDS шума,
+# чтобы первый запрос не платил за инициализацию ядер и аллокаторов
+WARMUP = os.getenv('DIARIZATION_WARMUP', '1').lower() in ('1', 'true', 'yes')
+WARMUP_SECONDS = float(os.getenv('DIARIZATION_WARMUP_SECONDS', 10))
+
+# Локальная модель не требует сети: huggingface_hub читает HF_HUB_OFFLINE
+# при импорте, поэтому переменная выставляется до импорта pyannote
+if os.path.exists(SNAPSHOT_PATH) or os.path.exists(MODEL_PATH):
+    os.environ.setdefault('HF_HUB_OFFLINE', '1')
+
+# Кэш результатов: LRU в памяти и необязательный дисковый уровень
+CACHE_SIZE = int(os.getenv('DIARIZATION_CACHE_SIZE', 256))  # записей, 0 - отключить
+CACHE_DIR = os.getenv('DIARIZATION_CACHE_DIR', '')  # пусто - без дискового уровня
+CACHE_DISK_MAX_MB = int(os.getenv('DIARIZATION_CACHE_DISK_MAX_MB', 1024))
+
+# Профилирование запросов (/diarize с profile=1): трасса torch profiler и
+# стеки Python, не больше PROFILE_MAX профилей не дольше PROFILE_TTL секунд
+PROFILE_DIR = os.getenv('DIARIZATION_PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'diarization-profiles')
+PROFILE_MAX = int(os.getenv('DIARIZATION_PROFILE_MAX', 20))  # 0 - отключить
+PROFILE_TTL = int(os.getenv('DIARIZATION_PROFILE_TTL', 86400))  # секунды
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv('DIARIZATION_PROFILE_SAMPLE_INTERVAL_MS', 5))
+
+
+
+def max_body_size(endpoint):
+    """Лимит тела запроса для эндпоинта (файл плюс запас на multipart)"""
+    limit = LONGFORM_MAX_FILE_SIZE if endpoint == 'diarize_stream' else MAX_FILE_SIZE
+    return limit + MULTIPART_OVERHEAD
+
+
+class StreamingUpload(io.BytesIO):
+    """
+    Буфер загружаемого файла, который обрабатывает байты по мере поступления
+    
+    Multipart-парсер пишет файл порциями; на каждой порции обновляется
+    хэш содержимого, по первым байтам определяется контейнер (неизвестная
+    сигнатура - 415 сразу, не дожидаясь конца загрузки), а сами байты
+    передаются потоковому декодеру, который переводит их в PCM в фоновом
+    потоке параллельно с загрузкой.
+    """
+    
+    def __init__(self, decode=True):
+        from audio_io import SNIFF_BYTES
+        
+        super().__init__()
+        self.sniff_bytes = SNIFF_BYTES
+        self.digest = hashlib.sha256()
+        self.container = None
+        self.decoder = None
+        self._decode = decode
+        self._header = b''
+    
+    def write(self, data):
+        if self.container is None:
+            self._header += bytes(data[:self.sniff_bytes - len(self._header)])
+            if len(self._header) >= self.sniff_bytes:
+                self.detect()
+        self.digest.update(data)
+        if self.decoder is not None:
+            self.decoder.feed(bytes(data))
+        return super().write(data)
+    
+    def detect(self):
+        """Определение контейнера по первым байтам и запуск декодера"""
+        from audio_io import sniff_format, streaming_decoder
+        
+        if self.container is not None:
+            return self.container
+        self.container = sniff_format(self._header)
+        if self.container is None:
+            raise UnsupportedMediaType('Unrecognized audio format: file header does not match '
+                                       f'any of {", ".join(sorted(ALLOWED_EXTENSIONS))}')
+        if self._decode:
+            self.decoder = streaming_decoder(self.container)
+            if self.decoder is not None:
+                # Байты, полученные до определения формата
+                self.decoder.feed(self.getvalue())
+        return self.container
+    
+    def hexdigest(self):
+        return self.digest.hexdigest()
+    
+    def close(self):
+        # Werkzeug закрывает файлы запроса после ответа: декодер, не
+        # переданный в задачу (ошибка, 413 посреди загрузки), больше не нужен
+        if self.decoder is not None:
+            self.decoder.abort()
+            self.decoder = None
+        super().close()
+
+
+class UploadRequest(Request):
+    """
+    Запрос, который держит обычные загрузки в памяти
+    
+    По умолчанию Werkzeug сбрасывает файлы больше 500KB во временный файл;
+    загрузки до MAX_FILE_SIZE читаются в StreamingUpload и декодируются
+    по мере поступления. Более крупные (режим длинных записей) по-прежнему
+    идут во временный файл.
+    
+    Лимит тела запроса зависит от эндпоинта и проверяется Werkzeug по мере
+    чтения: слишком большой Content-Length отклоняется сразу, тело без
+    него (chunked) - как только превысит лимит (413).
+    """
+    
+    @property
+    def max_content_length(self):
+        return max_body_size(self.endpoint)
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        longform = self.endpoint == 'diarize_stream'
+        if not longform or (total_content_length is not None
+                            and total_content_length <= MAX_FILE_SIZE + MULTIPART_OVERHEAD):
+            # Длинные записи читаются с диска окнами, их декодирует не этот буфер
+            return StreamingUpload(decode=not longform)
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+
+app = Flask(__name__)
+app.request_class = UploadRequest
+
+
+@app.errorhandler(413)
+def request_too_large(e):
+    limit = request.max_content_length - MULTIPART_OVERHEAD
+    return jsonify({'error': f'File too large. Max size: {limit / 1024 / 1024} MB'}), 413
+
+
+@app.errorhandler(415)
+def unsupported_media_type(e):
+    return jsonify({'error': e.description}), 415
+
+# Метрики для /metrics (формат Prometheus)
+metrics = Registry()
+HTTP_REQUESTS = metrics.counter(
+    'diarization_http_requests_total', 'HTTP requests by endpoint and status code',
+    ('endpoint', 'method', 'status'))
+HTTP_LATENCY = metrics.histogram(
+    'diarization_http_request_duration_seconds', 'HTTP request latency', ('endpoint',))
+STAGE_LATENCY = metrics.histogram(
+    'diarization_stage_duration_seconds',
+    'Processing time per stage (upload, queue_wait, decode, vad, segmentation, speaker_counting, '
+    'embeddings, clustering, postprocessing)', ('stage',))
+AUDIO_SECONDS = metrics.counter(
+    'diarization_audio_seconds_total', 'Seconds of audio processed by the pipeline')
+JOBS_TOTAL = metrics.counter(
+    'diarization_jobs_total', 'Finished jobs by status',
+    ('status',), collect=lambda: {
+        ('done',): job_queue.stats()['completed'],
+        ('failed',): job_queue.stats()['failed'],
+        ('rejected',): job_queue.stats()['rejected'],
+    })
+metrics.gauge(
+    'diarization_queue_depth', 'Jobs waiting in the queue',
+    collect=lambda: job_queue.stats()['queued'])
+metrics.gauge(
+    'diarization_jobs_in_flight', 'Jobs currently being processed',
+    collect=lambda: job_queue.stats()['running'])
+metrics.gauge(
+    'diarization_workers', 'Pipeline workers', collect=lambda: job_queue.workers)
+metrics.gauge(
+    'process_resident_memory_bytes', 'Resident memory of the service process',
+    collect=process_rss_bytes)
+metrics.counter(
+    'diarization_cache_lookups_total', 'Result cache lookups by outcome',
+    ('result',), collect=lambda: {
+        ('memory_hit',): result_cache.stats()['memory_hits'],
+        ('disk_hit',): result_cache.stats()['disk_hits'],
+        ('miss',): result_cache.stats()['misses'],
+    })
+
 # Глобальная переменная для хранения загруженной модели
 pipeline = None
+pipeline_lock = threading.Lock()
+pipeline_config = None
+batchers = {}
+speaker_store = None
+speaker_store_lock = threading.Lock()
+device = None
+devices = None
+replicas = {}
+replicas_lock = threading.Lock()
+device_memory = {}
+device_memory_lock = threading.Lock()
+inference_backend = None
+readiness = {'status': 'starting', 'error': None, 'load_time_seconds': None, 'warmup_time_seconds': None}
 
 # Определение устройства для вычислений
-def get_device():
+def detect_device():
     """Определяет наилучшее доступное устройство для вычислений"""
+    import torch
+    
     if torch.cuda.is_available():
         device = torch.device('cuda')
         gpu_name = torch.cuda.get_device_name(0)
@@ -103,20 +378,116 @@ def get_device():
         print("⚡ CUDA not available, using CPU")
         return torch.device('cpu')
 
-DEVICE = get_device()
 
+def get_device():
+    """Устройство для вычислений (определяется при первом обращении)"""
+    global device
+    
+    if device is None:
+        device = replica_devices()[0] if DEVICES else detect_device()
+    return device
+
+
+def replica_devices():
+    """Устройства реплик pipeline из DIARIZATION_DEVICES"""
+    global devices
+    
+    if devices is None:
+        if not DEVICES:
+            devices = [get_device()]
+        else:
+            import torch
+            
+            if DEVICES.lower() == 'auto':
+                names = [f'cuda:{i}' for i in range(torch.cuda.device_count())] or ['cpu']
+            else:
+                names = [name.strip() for name in DEVICES.split(',') if name.strip()]
+            resolved = [torch.device(name) for name in names]
+            for replica, replica_device in enumerate(resolved):
+                if replica_device.type == 'cuda':
+                    name = torch.cuda.get_device_name(replica_device)
+                    print(f"🚀 Replica {replica}: {replica_device} ({name})")
+                else:
+                    print(f"⚡ Replica {replica}: {replica_device}")
+            devices = resolved
+    return devices
 
-def load_pipeline():
-    """Загрузка модели при старте сервиса"""
-    global pipeline
+
+def replica_count():
+    return len(replica_devices())
+
+
+def replica_load(replica):
+    """Доля памяти устройства реплики, зарезервированной аллокатором torch"""
+    torch = sys.modules.get('torch')
+    if torch is None or devices is None or replica >= len(devices) or devices[replica].type != 'cuda':
+        return 0.0
+    index = devices[replica].index or 0
+    return torch.cuda.memory_reserved(index) / torch.cuda.get_device_properties(index).total_memory
+
+
+def pipeline_device(model):
+    """Устройство, на котором работает pipeline воркера"""
+    segmentation = getattr(model, '_segmentation', None)
+    return segmentation.device if segmentation is not None else get_device()
+
+
+def get_device_memory(model):
+    """Бюджет памяти устройства, на котором работает pipeline"""
+    model_device = pipeline_device(model)
+    key = str(model_device)
+    if key not in device_memory:
+        with device_memory_lock:
+            if key not in device_memory:
+                budget = MEMORY_BUDGET_MB * MB or None
+                if budget is None and model_device.type == 'cuda':
+                    import torch
+                    # Создаётся при первой задаче, когда веса уже загружены
+                    total = torch.cuda.get_device_properties(model_device).total_memory
+                    budget = max(0, total * MEMORY_FRACTION - torch.cuda.memory_allocated(model_device)) or None
+                device_memory[key] = DeviceMemory(
+                    model_device, budget,
+                    per_audio_second=MEMORY_PER_AUDIO_SECOND_MB * MB,
+                    per_segmentation_item=MEMORY_PER_SEGMENTATION_ITEM_MB * MB,
+                    per_embedding_item=MEMORY_PER_EMBEDDING_ITEM_MB * MB,
+                    max_retries=OOM_RETRIES,
+                )
+                if budget:
+                    print(f"✓ Memory budget for {key}: {budget / MB:.0f} MB")
+    return device_memory[key]
+
+
+def create_pipeline(device, backend=None):
+    """Создание нового экземпляра pipeline на указанном устройстве и бэкенде инференса"""
+    from backends import apply_backend
+    global inference_backend
     
-    if pipeline is not None:
-        return pipeline
+    new_pipeline = load_model(device)
+    inference_backend = apply_backend(new_pipeline, backend or INFERENCE_BACKEND, ONNX_CACHE_DIR)
+    if CLUSTERING != 'agglomerative':
+        from fast_clustering import set_clustering_engine
+        set_clustering_engine(new_pipeline, CLUSTERING, max_groups=CLUSTERING_MAX_GROUPS)
+    return new_pipeline
+
+
+def load_model(device):
+    """Загрузка pipeline из снимка, локальной модели или HuggingFace"""
+    from pyannote.audio import Pipeline
     
     model_path = MODEL_PATH
     print(f"Loading diarization model...")
     print(f"Local path configured: {model_path}")
     
+    if SNAPSHOT_PATH and os.path.exists(SNAPSHOT_PATH):
+        from snapshot import load_snapshot
+        try:
+            started = time.time()
+            new_pipeline = load_snapshot(SNAPSHOT_PATH, device)
+            print(f"✓ Model loaded from snapshot {SNAPSHOT_PATH} in {time.time() - started:.2f}s on {device}")
+            return new_pipeline
+        except Exception as e:
+            print(f"⚠ Warning: Could not load snapshot, falling back to model files: {e}")
+    
     try:
         # Сначала пробуем загрузить из локального пути
         if model_path and os.path.exists(model_path):
@@ -139,9 +510,9 @@ def load_pipeline():
                 
                 print("Found config.yaml and pytorch_model.bin")
                 
-            pipeline = Pipeline.from_pretrained(abs_model_path)
-            pipeline = pipeline.to(DEVICE)
-            print(f"✓ Model loaded from local path and moved to {DEVICE}")
+            new_pipeline = Pipeline.from_pretrained(abs_model_path)
+            new_pipeline = new_pipeline.to(device)
+            print(f"✓ Model loaded from local path and moved to {device}")
         else:
             # Загружаем из HuggingFace (используется кэш если модель уже скачана)
             hf_token = os.getenv('HF_TOKEN')
@@ -157,39 +528,147 @@ def load_pipeline():
             os.environ['HF_HUB_DOWNLOAD_TIMEOUT'] = '600'
             
             # Загружаем без явной передачи токена - будет использован из env или кэша
-            pipeline = Pipeline.from_pretrained("pyannote/speaker-diarization-3.1")
-            pipeline = pipeline.to(DEVICE)
-            print(f"✓ Model loaded from HuggingFace cache and moved to {DEVICE}")
+            new_pipeline = Pipeline.from_pretrained("pyannote/speaker-diarization-3.1")
+            new_pipeline = new_pipeline.to(device)
+            print(f"✓ Model loaded from HuggingFace cache and moved to {device}")
         
-        return pipeline
+        return new_pipeline
     
     except Exception as e:
         print(f"✗ Error loading model: {str(e)}")
         raise
 
 
+def load_pipeline():
+    """Загрузка модели при старте сервиса"""
+    global pipeline
+    
+    if pipeline is not None:
+        return pipeline
+    
+    with pipeline_lock:
+        if pipeline is None:
+            new_pipeline = create_pipeline(get_device())
+            if BATCHING:
+                from batching import enable_dynamic_batching
+                batchers.update(enable_dynamic_batching(
+                    new_pipeline,
+                    max_batch_size=BATCH_MAX_SIZE,
+                    max_wait=BATCH_MAX_WAIT_MS / 1000
+                ))
+            pipeline = new_pipeline
+    
+    return pipeline
+
+
+def read_config_params():
+    """
+    Гиперпараметры из config.yaml модели без загрузки pipeline
+
+    Берётся локальная модель, иначе config.yaml из кэша HuggingFace (без
+    обращения к сети). Если файла нет, возвращается пустой словарь.
+    """
+    config_file = None
+    if MODEL_PATH and os.path.exists(MODEL_PATH):
+        config_file = os.path.join(MODEL_PATH, 'config.yaml')
+    else:
+        try:
+            from huggingface_hub import try_to_load_from_cache
+            cached = try_to_load_from_cache('pyannote/speaker-diarization-3.1', 'config.yaml')
+            config_file = cached if isinstance(cached, str) else None
+        except Exception:
+            pass
+    if not config_file or not os.path.exists(config_file):
+        return {}
+    
+    try:
+        import yaml
+        with open(config_file, 'r', encoding='utf-8') as f:
+            return (yaml.safe_load(f) or {}).get('params', {}) or {}
+    except Exception as e:
+        print(f"⚠ Warning: Could not read {config_file}: {e}")
+        return {}
+
+
+def get_pipeline_config():
+    """
+    Конфигурация pipeline (гиперпараметры из config.yaml) для ключа кэша
+    
+    Собирается из настроек и config.yaml, а не из загруженной модели: ключ
+    кэша считается в потоке запроса, который не должен ждать загрузки.
+    """
+    global pipeline_config
+    
+    if pipeline_config is None:
+        pipeline_config = {
+            'model': MODEL_PATH if MODEL_PATH and os.path.exists(MODEL_PATH) else 'pyannote/speaker-diarization-3.1',
+            'params': read_config_params(),
+            'backend': INFERENCE_BACKEND,
+            'clustering': CLUSTERING,
+        }
+    
+    return pipeline_config
+
+
+def get_speaker_store():
+    """Хранилище известных спикеров (открывается при первом обращении)"""
+    global speaker_store
+    
+    if speaker_store is None:
+        with speaker_store_lock:
+            if speaker_store is None:
+                speaker_store = SpeakerStore(SPEAKER_STORE_DIR)
+    
+    return speaker_store
+
+
+def speaker_match_threshold():
+    """
+    Порог косинусного сходства для сопоставления со спикерами из хранилища
+    
+    Кластеризация сравнивает евклидово расстояние d между нормированными
+    эмбеддингами с порогом из config.yaml; для единичных векторов
+    cos = 1 - d^2 / 2, поэтому по умолчанию используется тот же порог.
+    """
+    if SPEAKER_MATCH_THRESHOLD:
+        return float(SPEAKER_MATCH_THRESHOLD)
+    threshold = get_pipeline_config()['params'].get('clustering', {}).get('threshold', 0.7)
+    return 1.0 - threshold ** 2 / 2
+
+
+def parse_bool(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+
+def token_error(auth_header):
+    """Проверка заголовка Authorization: текст ошибки или None, если токен верный"""
+    if not auth_header:
+        return 'No authorization header'
+    
+    try:
+        scheme, token = auth_header.split()
+    except ValueError:
+        return 'Invalid authorization header format'
+    
+    if scheme.lower() != 'bearer':
+        return 'Invalid authorization scheme'
+    if token != BEARER_TOKEN:
+        return 'Invalid token'
+    return None
+
+
 def require_token(f):
     """Декоратор для проверки Bearer token"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        auth_header = request.headers.get('Authorization')
-        
-        if not auth_header:
-            return jsonify({'error': 'No authorization header'}), 401
-        
-        try:
-            scheme, token = auth_header.split()
-            if scheme.lower() != 'bearer':
-                return jsonify({'error': 'Invalid authorization scheme'}), 401
-            
-            if token != BEARER_TOKEN:
-                return jsonify({'error': 'Invalid token'}), 401
-        
-        except ValueError:
-            return jsonify({'error': 'Invalid authorization header format'}), 401
+        error = token_error(request.headers.get('Authorization'))
+        if error:
+            return jsonify({'error': error}), 401
         
         return f(*args, **kwargs)
     
+    # ASGI-фронтенд проверяет токен до чтения тела запроса
+    decorated_function.requires_token = True
     return decorated_function
 
 
@@ -199,19 +678,43 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unknown'
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    if 'request_started' in g:
+        HTTP_LATENCY.observe(time.perf_counter() - g.request_started, endpoint=endpoint)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """Проверка здоровья сервиса"""
     try:
         model_status = "loaded" if pipeline is not None else "not loaded"
         
+        # torch ещё может быть не импортирован (модель загружается в фоне):
+        # /health не должен ждать его импорта
+        torch = sys.modules.get('torch')
+        
         # Информация о CUDA
         cuda_info = {
-            'available': torch.cuda.is_available(),
-            'current_device': str(DEVICE),
+            'available': torch.cuda.is_available() if torch else None,
+            'current_device': str(device) if device is not None else None,
         }
         
-        if torch.cuda.is_available():
+        if torch and torch.cuda.is_available():
             cuda_info.update({
                 'device_count': torch.cuda.device_count(),
                 'device_name': torch.cuda.get_device_name(0),
@@ -224,7 +727,16 @@ def health():
             'status': 'healthy',
             'model': model_status,
             'device': cuda_info,
-            'torch_version': torch.__version__
+            'queue': job_queue.stats(),
+            'cache': result_cache.stats(),
+            'batching': {name: batcher.stats() for name, batcher in batchers.items()} if BATCHING else None,
+            'param_variants': pipeline_variants.stats(),
+            'sessions': session_store.stats(),
+            'profiles': profile_store.count() if profile_store.enabled else None,
+            'memory': {key: memory.stats() for key, memory in device_memory.items()},
+            'backend': inference_backend,
+            'readiness': readiness['status'],
+            'torch_version': torch.__version__ if torch else None
         }), 200
     except Exception as e:
         return jsonify({
@@ -233,14 +745,23 @@ def health():
         }), 500
 
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Готовность к приёму трафика: модель загружена и прогрета"""
+    is_ready = readiness['status'] == 'ready'
+    return jsonify({'ready': is_ready, **readiness}), 200 if is_ready else 503
+
+
 @app.route('/system', methods=['GET'])
 def system_info():
     """Детальная информация о системе и CUDA"""
+    import torch
+    
     try:
         system_info = {
             'python_version': f"{os.sys.version_info.major}.{os.sys.version_info.minor}.{os.sys.version_info.micro}",
             'torch_version': torch.__version__,
-            'device': str(DEVICE),
+            'device': str(get_device()),
             'cuda': {
                 'available': torch.cuda.is_available(),
                 'version': torch.version.cuda if torch.cuda.is_available() else None,
@@ -265,16 +786,25 @@ def system_info():
                     'multiprocessor_count': device_props.multi_processor_count
                 }
                 
-                # Только для текущего устройства получаем использование памяти
-                if i == torch.cuda.current_device():
-                    device_info.update({
-                        'memory_allocated_gb': round(torch.cuda.memory_allocated(i) / (1024**3), 2),
-                        'memory_cached_gb': round(torch.cuda.memory_reserved(i) / (1024**3), 2),
-                        'memory_free_gb': round((device_props.total_memory - torch.cuda.memory_reserved(i)) / (1024**3), 2)
-                    })
+                # Реплики могут работать на любом устройстве - память по всем
+                device_info.update({
+                    'memory_allocated_gb': round(torch.cuda.memory_allocated(i) / (1024**3), 2),
+                    'memory_cached_gb': round(torch.cuda.memory_reserved(i) / (1024**3), 2),
+                    'memory_free_gb': round((device_props.total_memory - torch.cuda.memory_reserved(i)) / (1024**3), 2)
+                })
                 
                 system_info['cuda']['devices'].append(device_info)
         
+        # Загрузка реплик: задачи в очереди и в работе, доля занятой памяти
+        replica_stats = job_queue.replica_stats()
+        for stats in replica_stats:
+            replica_device = replica_devices()[stats['replica']]
+            stats['device'] = str(replica_device)
+            stats['loaded'] = stats['replica'] in replicas or (stats['replica'] == 0 and pipeline is not None)
+            if replica_device.type == 'cuda':
+                stats['memory_reserved_gb'] = round(torch.cuda.memory_reserved(replica_device) / (1024**3), 2)
+        system_info['replicas'] = replica_stats
+        
         return jsonify(system_info), 200
         
     except Exception as e:
@@ -283,107 +813,984 @@ def system_info():
         }), 500
 
 
-@app.route('/diarize', methods=['POST'])
-@require_token
-def diarize():
+def replica_pipeline(replica):
+    """Общий pipeline реплики (реплика 0 - основной pipeline сервиса)"""
+    if replica == 0:
+        return load_pipeline()
+    
+    if replica not in replicas:
+        with replicas_lock:
+            if replica not in replicas:
+                replica_device = replica_devices()[replica]
+                new_pipeline = create_pipeline(replica_device)
+                if BATCHING:
+                    from batching import enable_dynamic_batching
+                    replica_batchers = enable_dynamic_batching(
+                        new_pipeline,
+                        max_batch_size=BATCH_MAX_SIZE,
+                        max_wait=BATCH_MAX_WAIT_MS / 1000
+                    )
+                    batchers.update({f'{name}@{replica_device}': b for name, b in replica_batchers.items()})
+                replicas[replica] = new_pipeline
+    return replicas[replica]
+
+
+def worker_pipeline(index):
     """
-    Эндпоинт для диаризации аудио
+    Pipeline для воркера очереди: первый воркер реплики использует её общий
+    pipeline, остальные - свои копии на том же устройстве
     
-    Принимает:
-    - file: аудиофайл (multipart/form-data)
+    При динамическом батчинге все воркеры реплики делят общий pipeline -
+    их вызовы модели объединяются батчером.
+    """
+    replica = index // WORKERS
+    if index % WORKERS == 0 or BATCHING:
+        return replica_pipeline(replica)
+    return create_pipeline(replica_devices()[replica])
+
+
+def warm_up():
+    """
+    Загрузка модели и прогрев (выполняется в фоновом потоке при старте)
     
-    Возвращает:
-    - JSON с массивом сегментов (speaker, start, end)
+    Первый прогон pipeline заметно медленнее последующих: инициализируются
+    ядра, аллокаторы и пулы потоков. Пока прогрев не закончен, /ready
+    отвечает 503 и балансировщик не направляет сюда трафик.
+    """
+    started = time.time()
+    readiness['status'] = 'loading'
+    try:
+        model = load_pipeline()
+    except Exception as e:
+        readiness.update(status='failed', error=str(e))
+        print(f"WARNING: Could not load model at startup: {str(e)}")
+        print("Model will be loaded on first request")
+        return
+    readiness['load_time_seconds'] = round(time.time() - started, 2)
+    
+    if WARMUP:
+        import torch
+        from audio_io import SAMPLE_RATE
+        
+        readiness['status'] = 'warming_up'
+        started = time.time()
+        try:
+            generator = torch.Generator().manual_seed(0)
+            waveform = 0.01 * torch.randn(1, int(WARMUP_SECONDS * SAMPLE_RATE), generator=generator)
+            model({'waveform': waveform, 'sample_rate': SAMPLE_RATE})
+            # На тишине/шуме pipeline может не дойти до эмбеддингов
+            model._embedding(waveform[None])
+        except Exception as e:
+            print(f"⚠ Warning: Warm-up failed: {e}")
+        readiness['warmup_time_seconds'] = round(time.time() - started, 2)
+    
+    readiness['status'] = 'ready'
+    print(f"✓ Model ready: loaded in {readiness['load_time_seconds']}s, "
+          f"warm-up {readiness['warmup_time_seconds'] or 0}s")
+
+
+def start_warmup():
+    """Запуск загрузки и прогрева модели в фоне"""
+    thread = threading.Thread(target=warm_up, name='warmup', daemon=True)
+    thread.start()
+    return thread
+
+
+def run_diarization(payload, model):
+    """Выполнение диаризации загруженного файла (вызывается воркером очереди)"""
+    if payload.get('mode') == 'longform':
+        return run_longform(payload, model)
+    if payload.get('mode') == 'session':
+        return run_session(payload, model)
+    if payload.pop('profile', False):
+        return run_profiled(payload, model)
+    
+    try:
+        print(f"🎵 Processing file: {payload['filename']} ({payload['file_size'] / 1024:.2f} KB) on {pipeline_device(model)}")
+        
+        from audio_io import waveform_duration
+        
+        start_time = time.time()
+        if payload.get('received_at'):
+            STAGE_LATENCY.observe(start_time - payload['received_at'], stage='queue_wait')
+        
+        # Декодирование в waveform 16 кГц (без временного файла); при потоковом
+        # декодировании здесь остаётся только дождаться его окончания, а после
+        # предвыборки аудио уже декодировано, пока задача ждала в очереди
+        prefetched = payload.pop('decoded', None)
+        if prefetched is not None:
+            audio, decode_time = prefetched
+        else:
+            audio = decode_payload(payload)
+            decode_time = time.time() - start_time
+        payload['audio'] = None
+        STAGE_LATENCY.observe(decode_time, stage='decode')
+        audio_duration = waveform_duration(audio)
+        
+        # Вырезание пауз: pipeline обрабатывает только речь,
+        # разметка затем переносится на исходную шкалу времени
+        timeline = None
+        vad_info = None
+        if payload.get('options', {}).get('vad'):
+            from vad import strip_silence
+            vad_start = time.time()
+            audio, timeline = strip_silence(audio, min_silence=VAD_MIN_SILENCE)
+            STAGE_LATENCY.observe(time.time() - vad_start, stage='vad')
+            speech_seconds = timeline.speech_seconds if timeline is not None else audio_duration
+            vad_info = {
+                'speech_seconds': round(speech_seconds, 2),
+                'removed_seconds': round(audio_duration - speech_seconds, 2),
+            }
+        
+        if model is None:
+            model = load_pipeline()
+        options = payload.get('options', {})
+        model = pipeline_variants.get(model, options.get('params'))
+        
+        # Засекаем время диаризации, стадии pipeline замеряются через hook
+        diarization_start = time.time()
+        stage_timer = StageTimer()
+        if timeline is not None and timeline.is_empty:
+            # Речи не найдено - запускать модель незачем
+            from pyannote.core import Annotation
+            diarization, centroids = Annotation(), None
+        else:
+            # Центроиды спикеров вычисляются кластеризацией в любом случае,
+            # return_embeddings=True лишь возвращает их вместе с разметкой.
+            # Задача ждёт, пока оценка её пиковой памяти не поместится в бюджет
+            # устройства; после OOM повторяется с меньшим батчем эмбеддингов
+            diarization, centroids = get_device_memory(model).run(
+                model, waveform_duration(audio),
+                lambda: model(audio, hook=stage_timer, return_embeddings=True,
+                              **options.get('pipeline_kwargs', {}))
+            )
+            if timeline is not None:
+                diarization = timeline.restore(diarization)
+        stage_timer.stop()
+        diarization_time = time.time() - diarization_start
+        
+        stage_times = stage_timer.durations()
+        for stage, seconds in stage_times.items():
+            STAGE_LATENCY.observe(seconds, stage=stage)
+        AUDIO_SECONDS.inc(audio_duration)
+        
+        # Формирование результата: колоночная таблица прямо из Annotation,
+        # словари на каждый сегмент создаются только для JSON-ответа
+        result = SegmentTable.from_annotation(diarization)
+        
+        total_time = time.time() - start_time
+        print(f"✓ Diarization completed: {len(result)} segments in {diarization_time:.2f}s (total: {total_time:.2f}s)")
+        
+        embeddings = speaker_embeddings(diarization, centroids)
+        if payload.get('cache_key'):
+            result_cache.put(payload['cache_key'], {'segments': result.to_dict(), 'embeddings': embeddings})
+        
+        response = {
+            'segments': result,
+            'total_segments': len(result),
+            'audio_duration_seconds': round(audio_duration, 2),
+            'decode_time_seconds': round(decode_time, 2),
+            'processing_time_seconds': round(diarization_time, 2),
+            'stage_times_seconds': {stage: round(seconds, 3) for stage, seconds in stage_times.items()},
+            'total_time_seconds': round(total_time, 2),
+            'device': str(pipeline_device(model)),
+            'cached': False
+        }
+        if vad_info is not None:
+            response['vad'] = vad_info
+        # Кэш хранит сырые сегменты, склейка и фильтрация - по параметрам запроса
+        apply_postprocess(response, options.get('postprocess'))
+        return attach_speaker_info(response, embeddings, options)
+    
+    finally:
+        discard_payload(payload)
+
+
+def run_profiled(payload, model):
+    """Диаризация с записью профиля (torch profiler и стеки Python)"""
+    from profiling import capture
+    
+    profile_id, directory = profile_store.create()
+    try:
+        with capture(directory, profile_id, payload['filename'], PROFILE_SAMPLE_INTERVAL_MS / 1000) as meta:
+            result = run_diarization(payload, model)
+    except Exception:
+        profile_store.discard(profile_id)
+        raise
+    
+    print(f"✓ Profile {profile_id} captured: {meta['samples']} samples in {meta['seconds']:.2f}s")
+    result['profile'] = {
+        'id': profile_id,
+        'url': f'/profiles/{profile_id}',
+        'seconds': round(meta['seconds'], 2),
+        'samples': meta['samples'],
+    }
+    return result
+
+
+def speaker_embeddings(diarization, centroids):
+    """Центроиды эмбеддингов по меткам спикеров (строки centroids идут в порядке labels())"""
+    if centroids is None:
+        return {}
+    return {
+        label: [round(float(x), 6) for x in centroids[i]]
+        for i, label in enumerate(diarization.labels())
+    }
+
+
+def attach_speaker_info(result, embeddings, options):
     """
+    Добавление эмбеддингов спикеров и сопоставления с известными спикерами
     
+    options: return_embeddings - вернуть центроиды, identify - сопоставить
+    SPEAKER_XX с хранилищем (поле identity в сегментах и списке спикеров)
+    """
+    if not (options.get('return_embeddings') or options.get('identify')):
+        return result
+    
+    labels = sorted(embeddings)
+    speakers = [{'speaker': label} for label in labels]
+    
+    if options.get('return_embeddings'):
+        for speaker in speakers:
+            speaker['embedding'] = embeddings[speaker['speaker']]
+    
+    if options.get('identify'):
+        matches = get_speaker_store().identify(
+            [embeddings[label] for label in labels], speaker_match_threshold()
+        ) if labels else []
+        identities = {}
+        for speaker, (identity, similarity) in zip(speakers, matches):
+            speaker['identity'] = identity
+            speaker['similarity'] = similarity
+            identities[speaker['speaker']] = identity
+        # Поле identity сегментов добавляется при формировании ответа
+        result['identities'] = identities
+    
+    result['speakers'] = speakers
+    return result
+
+
+def run_longform(payload, model):
+    """Оконная диаризация длинной записи с передачей событий в поток ответа"""
+    events = payload['events']
+    cancel = payload['cancel']
+    segments_count = 0
+    speakers = set()
+    try:
+        print(f"🎵 Processing long-form file: {payload['filename']} ({payload['file_size'] / 1024:.2f} KB) on {pipeline_device(model)}")
+        start_time = time.time()
+        if model is None:
+            model = load_pipeline()
+        options = payload.get('options', {})
+        model = pipeline_variants.get(model, options.get('params'))
+        
+        from longform import LongFormDiarizer
+        diarizer = LongFormDiarizer(model, window=LONGFORM_WINDOW, overlap=LONGFORM_OVERLAP)
+        
+        def stream_events():
+            nonlocal segments_count
+            processed_seconds = 0.0
+            for event in diarizer.iter_events(payload['temp_file'], cancelled=cancel.is_set,
+                                              **options.get('pipeline_kwargs', {})):
+                if event['type'] == 'segment':
+                    segments_count += 1
+                    speakers.add(event['speaker'])
+                elif event['type'] == 'progress':
+                    AUDIO_SECONDS.inc(event['processed_seconds'] - processed_seconds)
+                    processed_seconds = event['processed_seconds']
+                events.put(event)
+        
+        # Пик памяти определяется окном; события уже отданы клиенту,
+        # поэтому после OOM вызов не повторяется
+        get_device_memory(model).run(model, LONGFORM_WINDOW, stream_events, retry=False)
+        
+        total_time = time.time() - start_time
+        print(f"✓ Long-form diarization completed: {segments_count} segments in {total_time:.2f}s")
+        
+        summary = {
+            'total_segments': segments_count,
+            'total_speakers': len(speakers),
+            'total_time_seconds': round(total_time, 2),
+            'device': str(pipeline_device(model))
+        }
+        events.put({'type': 'done', **summary})
+        return summary
+    
+    except Exception as e:
+        events.put({'type': 'error', 'error': str(e)})
+        raise
+    
+    finally:
+        events.put(None)
+        discard_payload(payload)
+
+
+def run_session(payload, model):
+    """Обновление разметки сессии после новой порции аудио"""
+    session = payload['session']
+    try:
+        print(f"🎵 Updating session {session.session_id}: {session.duration:.1f}s of audio on {pipeline_device(model)}")
+        start_time = time.time()
+        if payload.get('received_at'):
+            STAGE_LATENCY.observe(start_time - payload['received_at'], stage='queue_wait')
+        
+        if model is None:
+            model = load_pipeline()
+        options = payload.get('options', {})
+        model = pipeline_variants.get(model, options.get('params'))
+        
+        # Модели работают только на новом хвосте, кластеризация - по всей записи
+        pending_seconds = session.pending_samples / session.sample_rate
+        stage_timer = StageTimer()
+        # Пик памяти - по обрабатываемому хвосту: новое аудио плюс неполное окно
+        tail_seconds = pending_seconds + getattr(getattr(model, '_segmentation', None), 'duration', 0.0)
+        diarization, centroids = get_device_memory(model).run(
+            model, tail_seconds,
+            lambda: session.update(model, hook=stage_timer, **options.get('pipeline_kwargs', {}))
+        )
+        stage_timer.stop()
+        diarization_time = time.time() - start_time
+        
+        stage_times = stage_timer.durations()
+        for stage, seconds in stage_times.items():
+            STAGE_LATENCY.observe(seconds, stage=stage)
+        AUDIO_SECONDS.inc(pending_seconds)
+        
+        result = SegmentTable.from_annotation(diarization)
+        print(f"✓ Session {session.session_id} updated: {len(result)} segments in {diarization_time:.2f}s")
+        
+        response = {
+            **session.info(),
+            'segments': result,
+            'total_segments': len(result),
+            'audio_duration_seconds': round(session.duration, 2),
+            'processed_seconds': round(pending_seconds, 2),
+            'processing_time_seconds': round(diarization_time, 2),
+            'stage_times_seconds': {stage: round(seconds, 3) for stage, seconds in stage_times.items()},
+            'device': str(pipeline_device(model)),
+            'cached': False
+        }
+        # Состояние сессии хранит сырую разметку, постобработка - по параметрам порции
+        apply_postprocess(response, options.get('postprocess'))
+        return attach_speaker_info(response, speaker_embeddings(diarization, centroids), options)
+    
+    finally:
+        discard_payload(payload)
+
+
+def decode_payload(payload):
+    """Аудио задачи: результат потокового декодирования или декодирование байтов целиком"""
+    from audio_io import decode_audio
+    
+    decoder = payload.pop('decoder', None)
+    audio = decoder.finish() if decoder is not None else None
+    if audio is None:
+        audio = decode_audio(payload['audio'], payload['filename'])
+    return audio
+
+
+def prefetch_payload(payload):
+    """
+    Декодирование аудио задачи заранее (пул предвыборки очереди задач)
+
+    Длинные записи читаются окнами с диска, а аудио сессий дописывается к
+    состоянию сессии - их декодирует сам воркер. Профилируемый запрос тоже
+    декодируется воркером, чтобы декодирование попало в профиль.
+    """
+    if payload.get('mode') is not None or payload.get('profile'):
+        return
+    start_time = time.time()
+    audio = decode_payload(payload)
+    payload['decoded'] = (audio, time.time() - start_time)
+    payload['audio'] = None
+
+
+def discard_payload(payload):
+    """Освобождение данных задачи и удаление её временного файла"""
+    payload['audio'] = None
+    payload.pop('decoded', None)
+    decoder = payload.pop('decoder', None)
+    if decoder is not None:
+        decoder.abort()
+    temp_file = payload.get('temp_file')
+    if temp_file and os.path.exists(temp_file):
+        try:
+            os.unlink(temp_file)
+        except:
+            pass
+
+
+pipeline_variants = PipelineVariants(PARAM_CACHE_SIZE, clustering_options={'max_groups': CLUSTERING_MAX_GROUPS})
+session_store = SessionStore(ttl=SESSION_TTL, max_sessions=MAX_SESSIONS)
+profile_store = ProfileStore(PROFILE_DIR, max_profiles=PROFILE_MAX, ttl=PROFILE_TTL)
+
+result_cache = ResultCache(
+    max_items=CACHE_SIZE,
+    disk_dir=CACHE_DIR,
+    disk_max_bytes=CACHE_DISK_MAX_MB * 1024 * 1024,
+)
+
+job_queue = JobQueue(
+    run_diarization,
+    workers=WORKERS,
+    max_queue_size=QUEUE_SIZE,
+    result_ttl=JOB_RESULT_TTL,
+    worker_init=worker_pipeline,
+    discard=discard_payload,
+    replicas=replica_count,
+    replica_load=replica_load,
+    prepare=prefetch_payload,
+    prefetch=PREFETCH,
+)
+
+
+def receive_upload(max_size=MAX_FILE_SIZE, use_cache=True, to_disk=False):
+    """
+    Проверка загруженного файла
+    
+    Обычные загрузки остаются в памяти (payload['audio'] - байты файла),
+    с to_disk=True файл сохраняется во временный (payload['temp_file']),
+    например для оконного чтения длинных записей.
+    
+    Возвращает (payload, None) или (None, (response, status)) при ошибке
+    """
     # Проверка наличия файла
     if 'file' not in request.files:
-        return jsonify({'error': 'No file provided'}), 400
+        return None, (jsonify({'error': 'No file provided'}), 400)
     
     file = request.files['file']
     
     if file.filename == '':
-        return jsonify({'error': 'Empty filename'}), 400
+        return None, (jsonify({'error': 'Empty filename'}), 400)
     
     if not allowed_file(file.filename):
-        return jsonify({'error': f'File type not allowed. Allowed: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
+        return None, (jsonify({'error': f'File type not allowed. Allowed: {", ".join(ALLOWED_EXTENSIONS)}'}), 400)
     
     # Проверка размера файла
     file.seek(0, os.SEEK_END)
     file_size = file.tell()
     file.seek(0)
     
-    if file_size > MAX_FILE_SIZE:
-        return jsonify({'error': f'File too large. Max size: {MAX_FILE_SIZE / 1024 / 1024} MB'}), 400
+    if file_size > max_size:
+        return None, (jsonify({'error': f'File too large. Max size: {max_size / 1024 / 1024} MB'}), 400)
     
-    # Сохранение во временный файл
-    temp_file = None
+    # Гиперпараметры запроса: num/min/max_speakers передаются в вызов
+    # pipeline, остальные требуют копии pipeline с другими параметрами
     try:
-        # Создаём временный файл
+        pipeline_kwargs, params = parse_params(request.form)
+        postprocess_options = parse_postprocess(request.form)
+    except ValueError as e:
+        return None, (jsonify({'error': str(e)}), 400)
+    
+    payload = {
+        'audio': None,
+        'temp_file': None,
+        'filename': file.filename,
+        'file_size': file_size,
+        'cache_key': None,
+        'received_at': None,
+        'options': {
+            'return_embeddings': parse_bool(request.form.get('return_embeddings')),
+            'identify': parse_bool(request.form.get('identify')),
+            'vad': parse_bool(request.form['vad']) if 'vad' in request.form else VAD,
+            'pipeline_kwargs': pipeline_kwargs,
+            'params': params,
+            'postprocess': postprocess_options,
+        },
+    }
+    
+    if to_disk:
+        # Сохранение во временный файл с одновременным подсчётом хэша содержимого
         with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp:
-            temp_file = tmp.name
-            file.save(tmp.name)
+            payload['temp_file'] = tmp.name
+            audio_hash, _ = copy_and_hash(file.stream, tmp)
+    elif isinstance(file.stream, StreamingUpload):
+        # Хэш посчитан и декодирование начато во время загрузки;
+        # файл короче заголовка проверяется здесь
+        stream = file.stream
+        try:
+            stream.detect()
+        except UnsupportedMediaType as e:
+            return None, (jsonify({'error': e.description}), 415)
+        payload['audio'] = stream.getvalue()
+        payload['decoder'] = stream.decoder
+        stream.decoder = None
+        audio_hash = stream.hexdigest()
+    else:
+        stream = file.stream
+        payload['audio'] = stream.getvalue() if isinstance(stream, io.BytesIO) else stream.read()
+        audio_hash = hash_bytes(payload['audio'])
+    
+    if use_cache and result_cache.enabled:
+        # VAD и гиперпараметры запроса меняют результат, поэтому входят в ключ
+        overrides = {**pipeline_kwargs, **params}
+        if payload['options']['vad']:
+            overrides['vad_min_silence'] = VAD_MIN_SILENCE
+        payload['cache_key'] = cache_key(audio_hash, get_pipeline_config(), overrides or None)
+    
+    payload['received_at'] = time.time()
+    if 'request_started' in g:
+        # Разбор multipart-тела и чтение файла
+        STAGE_LATENCY.observe(time.perf_counter() - g.request_started, stage='upload')
+    
+    return payload, None
+
+
+def cached_result(payload):
+    """Готовый результат из кэша или None"""
+    if not payload.get('cache_key'):
+        return None
+    
+    cached = result_cache.get(payload['cache_key'])
+    if cached is None:
+        return None
+    
+    segments = SegmentTable.from_dict(cached['segments'])
+    print(f"⚡ Cache hit: {payload['filename']} ({len(segments)} segments)")
+    options = payload.get('options', {})
+    result = apply_postprocess({
+        'segments': segments,
+        'total_segments': len(segments),
+        'processing_time_seconds': 0.0,
+        'total_time_seconds': 0.0,
+        'device': str(get_device()),
+        'cached': True
+    }, options.get('postprocess'))
+    return attach_speaker_info(result, cached.get('embeddings', {}), options)
+
+
+def requested_format():
+    """Формат ответа из параметра format (query или form) или заголовка Accept"""
+    return negotiate(request.args.get('format') or request.form.get('format'), request.accept_mimetypes)
+
+
+def not_acceptable_response():
+    return jsonify({'error': f'Unsupported format. Supported: {", ".join(FORMATS)}'}), 406
+
+
+def result_response(result, fmt, extra=None, filename=None, status=200):
+    """Ответ с результатом диаризации в согласованном формате"""
+    uri = os.path.splitext(os.path.basename(filename or 'audio'))[0]
+    try:
+        body, mimetype = render(result, fmt, extra, uri=uri)
+    except FormatUnavailable as e:
+        return jsonify({'error': str(e)}), 406
+    
+    if isinstance(body, dict):
+        response = jsonify(body)
+        response.mimetype = mimetype
+    else:
+        response = Response(body, mimetype=mimetype)
+    return response, status
+
+
+def job_response(job, fmt, status=200):
+    """Задача с результатом: JSON-обёртка или результат в бинарном/RTTM формате"""
+    data = job.to_dict(include_result=False)
+    if job.result is None:
+        return jsonify(data), status
+    if fmt in ('json', 'columnar'):
+        data['result'] = render(job.result, fmt)[0]
+        return jsonify(data), status
+    return result_response(job.result, fmt, extra=data, filename=job.filename, status=status)
+
+
+def queue_full_response(e):
+    """Ответ 429 с заголовком Retry-After при переполненной очереди"""
+    response = jsonify({
+        'success': False,
+        'error': 'Too many requests: job queue is full',
+        'retry_after_seconds': e.retry_after
+    })
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 429
+
+
+@app.route('/diarize', methods=['POST'])
+@require_token
+def diarize():
+    """
+    Эндпоинт для диаризации аудио
+    
+    Принимает:
+    - file: аудиофайл (multipart/form-data)
+    - return_embeddings: 1 - вернуть центроиды эмбеддингов спикеров
+    - identify: 1 - сопоставить спикеров с хранилищем известных спикеров
+    - vad: 1/0 - вырезать длинные паузы перед диаризацией (по умолчанию DIARIZATION_VAD)
+    - num_speakers, min_speakers, max_speakers: известное число спикеров
+    - clustering_threshold, min_cluster_size, min_duration_off: переопределение
+      параметров config.yaml для этого запроса
+    - clustering: agglomerative или fast - движок кластеризации для этого запроса
+    - merge_gap: склеить реплики одного спикера с паузой не больше N секунд
+    - min_duration: отбросить реплики короче N секунд (после склейки)
+    - overlaps: 1 - вернуть области перекрытия речи
+    - speaker_stats: 1 - вернуть статистику по спикерам
+    - format: json (по умолчанию), columnar, rttm, msgpack или arrow;
+      вместо параметра можно использовать заголовок Accept
+    - profile: 1 - записать профиль обработки (кэш результатов не используется),
+      поле profile ответа содержит ссылку /profiles/<id>
+    
+    Возвращает:
+    - JSON с массивом сегментов (speaker, start, end) или результат в запрошенном формате
+    
+    Запрос ставится в общую очередь и ожидает завершения обработки
+    """
+    fmt = requested_format()
+    if fmt is None:
+        return not_acceptable_response()
+    
+    profile = parse_bool(request.args.get('profile') or request.form.get('profile'))
+    if profile and not profile_store.enabled:
+        return jsonify({'error': 'Profiling is disabled (DIARIZATION_PROFILE_MAX=0)'}), 400
+    
+    payload, error = receive_upload(use_cache=not profile)
+    if error:
+        return error
+    payload['profile'] = profile
+    
+    result = cached_result(payload)
+    if result is not None:
+        discard_payload(payload)
+        return result_response(result, fmt, {'success': True, 'queue_wait_seconds': 0.0}, payload['filename'])
+    
+    try:
+        job = job_queue.submit(payload, filename=payload['filename'])
+    except QueueFullError as e:
+        discard_payload(payload)
+        return queue_full_response(e)
+    
+    try:
+        if not job_queue.wait(job, timeout=SYNC_TIMEOUT):
+            job_queue.cancel(job.id)
+            return jsonify({
+                'success': False,
+                'error': 'Diarization timed out',
+                'job_id': job.id
+            }), 504
         
-        # Выполнение диаризации
-        import time
-        print(f"🎵 Processing file: {file.filename} ({file_size / 1024:.2f} KB) on {DEVICE}")
+        timing = job.to_dict(include_result=False)
+        if job.status != JOB_DONE:
+            print(f"✗ Error during diarization: {job.error}")
+            return jsonify({
+                'success': False,
+                'error': job.error or job.status
+            }), 500
         
-        # Очищаем GPU кэш перед обработкой
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+        return result_response(job.result, fmt, {
+            'success': True,
+            'queue_wait_seconds': timing['queue_wait_seconds']
+        }, payload['filename'])
+    
+    finally:
+        if job.finished:
+            job_queue.forget(job)
+
+
+@app.route('/profiles/<profile_id>', methods=['GET'])
+@require_token
+def get_profile(profile_id):
+    """Профиль запроса zip-архивом: trace.json, stacks.folded, summary.txt, meta.json"""
+    archive = profile_store.archive(profile_id)
+    if archive is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return send_file(archive, mimetype='application/zip', as_attachment=True,
+                     download_name=f'profile-{profile_id}.zip')
+
+
+@app.route('/diarize/stream', methods=['POST'])
+@require_token
+def diarize_stream():
+    """
+    Диаризация длинных записей с потоковой выдачей результатов
+    
+    Принимает:
+    - file: аудиофайл (multipart/form-data), до LONGFORM_MAX_FILE_SIZE
+    - num_speakers, max_speakers: верхняя граница числа спикеров всей записи
+      (min_speakers не поддерживается - 400)
+    
+    Возвращает:
+    - application/x-ndjson: по одному JSON-объекту на строку
+      (queued, segment, progress, done или error)
+    """
+    payload, error = receive_upload(max_size=LONGFORM_MAX_FILE_SIZE, use_cache=False, to_disk=True)
+    if error:
+        return error
+    # Окна обрабатываются и отдаются по очереди, поэтому нижнюю границу
+    # числа спикеров для всей записи обеспечить нельзя
+    if 'min_speakers' in payload['options']['pipeline_kwargs']:
+        discard_payload(payload)
+        return jsonify({'error': 'min_speakers is not supported for long-form diarization'}), 400
+    
+    events = queue.Queue()
+    cancel = threading.Event()
+    payload.update({'mode': 'longform', 'events': events, 'cancel': cancel})
+    
+    try:
+        job = job_queue.submit(payload, filename=payload['filename'])
+    except QueueFullError as e:
+        discard_payload(payload)
+        return queue_full_response(e)
+    
+    def generate():
+        try:
+            yield json.dumps({'type': 'queued', 'job_id': job.id}) + '\n'
+            while True:
+                event = events.get()
+                if event is None:
+                    break
+                yield json.dumps(event) + '\n'
+        finally:
+            # Клиент отключился или поток завершён - останавливаем обработку
+            cancel.set()
+            job_queue.cancel(job.id)
+            if job.finished:
+                job_queue.forget(job)
+    
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route('/jobs', methods=['POST'])
+@require_token
+def create_job():
+    """
+    Асинхронная диаризация: постановка файла в очередь
+    
+    Возвращает 202 с job_id, статус доступен по GET /jobs/<job_id>
+    (результат - в формате из параметра format или заголовка Accept)
+    """
+    fmt = requested_format()
+    if fmt is None:
+        return not_acceptable_response()
+    
+    payload, error = receive_upload()
+    if error:
+        return error
+    
+    result = cached_result(payload)
+    if result is not None:
+        discard_payload(payload)
+        job = job_queue.complete(result, filename=payload['filename'])
+        return job_response(job, fmt)
+    
+    try:
+        job = job_queue.submit(payload, filename=payload['filename'])
+    except QueueFullError as e:
+        discard_payload(payload)
+        return queue_full_response(e)
+    
+    response = jsonify(job.to_dict())
+    response.headers['Location'] = f'/jobs/{job.id}'
+    return response, 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@require_token
+def get_job(job_id):
+    """Статус, тайминги и результат задачи"""
+    fmt = requested_format()
+    if fmt is None:
+        return not_acceptable_response()
+    
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    return job_response(job, fmt)
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+@require_token
+def delete_job(job_id):
+    """Отмена задачи в очереди или удаление результата завершённой"""
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if job.status == JOB_RUNNING:
+        return jsonify({'error': 'Job is running and cannot be cancelled', **job.to_dict(include_result=False)}), 409
+    
+    return jsonify({'deleted': True, **job.to_dict(include_result=False)}), 200
+
+
+@app.route('/sessions', methods=['POST'])
+@require_token
+def create_session():
+    """Создание сессии инкрементальной диаризации"""
+    from audio_io import SAMPLE_RATE
+    
+    session = session_store.create(SAMPLE_RATE)
+    if session is None:
+        return jsonify({'error': f'Too many active sessions (max {MAX_SESSIONS})'}), 429
+    return jsonify(session.info()), 201
+
+
+@app.route('/sessions/<session_id>', methods=['GET'])
+@require_token
+def get_session(session_id):
+    """Состояние сессии"""
+    session = session_store.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Session not found'}), 404
+    return jsonify(session.info()), 200
+
+
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+@require_token
+def delete_session(session_id):
+    """Завершение сессии и освобождение её данных"""
+    if not session_store.delete(session_id):
+        return jsonify({'error': 'Session not found'}), 404
+    return jsonify({'session_id': session_id, 'status': 'deleted'}), 200
+
+
+@app.route('/sessions/<session_id>/audio', methods=['POST'])
+@require_token
+def append_session_audio(session_id):
+    """
+    Дописывание аудио в сессию и разметка всей записи
+    
+    Принимает:
+    - file: новая порция аудио (multipart/form-data)
+    - full: 1 - file содержит всю запись с начала (растущий файл),
+      обрабатывается только часть после уже полученного аудио
+    - параметры, постобработка и format - как у /diarize (кроме vad и profile)
+    
+    Возвращает разметку всей записи; метки спикеров сохраняются между
+    обновлениями.
+    """
+    session = session_store.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Session not found'}), 404
+    
+    fmt = requested_format()
+    if fmt is None:
+        return not_acceptable_response()
+    
+    payload, error = receive_upload(use_cache=False)
+    if error:
+        return error
+    
+    # Декодирование в потоке запроса: порции попадают в сессию в порядке прихода
+    try:
+        audio = decode_payload(payload)
+    except Exception as e:
+        discard_payload(payload)
+        return jsonify({'error': f'Could not decode audio: {e}'}), 400
+    payload['audio'] = None
+    payload.update({'mode': 'session', 'session': session})
+    full_recording = parse_bool(request.form.get('full'))
+    
+    try:
+        # Порция попадает в сессию, только если задача принята: после 429
+        # клиент может повторить запрос без дублирования аудио
+        job = job_queue.submit(payload, filename=payload['filename'],
+                               accept=lambda: session.append(audio['waveform'], full_recording=full_recording))
+    except QueueFullError as e:
+        discard_payload(payload)
+        return queue_full_response(e)
+    
+    try:
+        if not job_queue.wait(job, timeout=SYNC_TIMEOUT):
+            job_queue.cancel(job.id)
+            return jsonify({'success': False, 'error': 'Diarization timed out', 'job_id': job.id}), 504
         
-        start_time = time.time()
-        model = load_pipeline()
+        timing = job.to_dict(include_result=False)
+        if job.status != JOB_DONE:
+            print(f"✗ Error during session update: {job.error}")
+            return jsonify({'success': False, 'error': job.error or job.status}), 500
         
-        # Засекаем время диаризации
-        diarization_start = time.time()
-        diarization = model(temp_file)
-        diarization_time = time.time() - diarization_start
+        return result_response(job.result, fmt, {
+            'success': True,
+            'queue_wait_seconds': timing['queue_wait_seconds']
+        }, session_id)
+    
+    finally:
+        if job.finished:
+            job_queue.forget(job)
+
+
+@app.route('/speakers', methods=['GET'])
+@require_token
+def list_speakers():
+    """Список известных спикеров в хранилище"""
+    store = get_speaker_store()
+    return jsonify({'speakers': store.speakers(), 'total_embeddings': store.count}), 200
+
+
+@app.route('/speakers', methods=['POST'])
+@require_token
+def enroll_speaker():
+    """
+    Добавление известного спикера
+    
+    Принимает JSON {"label": ..., "embedding": [...]} или multipart/form-data
+    с полями label и file (запись с голосом спикера: берётся центроид
+    спикера, который говорит дольше всех).
+    """
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        label = data.get('label')
+        embedding = data.get('embedding')
+        if not label or not embedding:
+            return jsonify({'error': 'label and embedding are required'}), 400
+    else:
+        label = request.form.get('label')
+        if not label:
+            return jsonify({'error': 'label is required'}), 400
         
-        # Формирование результата
-        result = []
-        for turn, _, speaker in diarization.itertracks(yield_label=True):
-            result.append({
-                "start": float(turn.start),
-                "end": float(turn.end),
-                "speaker": speaker
-            })
+        payload, error = receive_upload()
+        if error:
+            return error
+        payload['options'].update(return_embeddings=True, identify=False)
         
-        total_time = time.time() - start_time
-        print(f"✓ Diarization completed: {len(result)} segments in {diarization_time:.2f}s (total: {total_time:.2f}s)")
+        result = cached_result(payload)
+        if result is None:
+            try:
+                job = job_queue.submit(payload, filename=payload['filename'])
+            except QueueFullError as e:
+                discard_payload(payload)
+                return queue_full_response(e)
+            try:
+                if not job_queue.wait(job, timeout=SYNC_TIMEOUT):
+                    job_queue.cancel(job.id)
+                    return jsonify({'error': 'Diarization timed out', 'job_id': job.id}), 504
+                if job.status != JOB_DONE:
+                    return jsonify({'error': job.error or job.status}), 500
+                result = job.result
+            finally:
+                if job.finished:
+                    job_queue.forget(job)
         
-        return jsonify({
-            'success': True,
-            'segments': result,
-            'total_segments': len(result),
-            'processing_time_seconds': round(diarization_time, 2),
-            'total_time_seconds': round(total_time, 2),
-            'device': str(DEVICE)
-        }), 200
+        embeddings = {speaker['speaker']: speaker['embedding'] for speaker in result.get('speakers', [])}
+        if not embeddings:
+            return jsonify({'error': 'No speech found in the enrollment audio'}), 400
+        
+        talk_time = result['segments'].talk_time()
+        embedding = embeddings[max(talk_time, key=talk_time.get)]
     
-    except Exception as e:
-        print(f"✗ Error during diarization: {str(e)}")
-        return jsonify({
-            'success': False,
-            'error': str(e)
-        }), 500
+    try:
+        enrollments = get_speaker_store().enroll(label, embedding)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    finally:
-        # Удаление временного файла
-        if temp_file and os.path.exists(temp_file):
-            try:
-                os.unlink(temp_file)
-            except:
-                pass
+    return jsonify({'label': label, 'enrollments': enrollments}), 201
+
+
+@app.route('/speakers/<label>', methods=['DELETE'])
+@require_token
+def delete_speaker(label):
+    """Удаление всех эмбеддингов спикера"""
+    removed = get_speaker_store().remove(label)
+    if not removed:
+        return jsonify({'error': 'Speaker not found'}), 404
+    return jsonify({'label': label, 'removed': removed}), 200
 
 
 if __name__ == '__main__':
-    # Загрузка модели при старте
-    try:
-        load_pipeline()
-    except Exception as e:
-        print(f"WARNING: Could not load model at startup: {str(e)}")
-        print("Model will be loaded on first request")
+    # Загрузка и прогрев модели в фоне: /health доступен сразу, /ready - после прогрева
+    start_warmup()
+    job_queue.start()
     
     # Запуск сервера
     port = int(os.getenv('DIARIZATION_PORT', 5000))
@@ -396,6 +1803,7 @@ if __name__ == '__main__':
     print(f"Port: {port}")
     print(f"Token: {BEARER_TOKEN[:10]}... (set via DIARIZATION_TOKEN)")
     print(f"Model: {MODEL_PATH}")
+    print(f"Workers: {WORKERS} (queue size: {QUEUE_SIZE}, prefetch: {PREFETCH})")
     print(f"{'='*60}\n")
     
-    app.run(host=host, port=port, debug=False)
+    app.run(host=host, port=port, debug=False, threaded=True)
@@ -1,46 +1,551 @@
 #!/usr/bin/env python3
 """
-Скрипт для диаризации аудиофайла с использованием pyannote.audio
-Возвращает JSON с временными метками говорящих
+Скрипт для диаризации аудиофайлов с использованием pyannote.audio
+
+Один файл (fallback для Laravel): выводит JSON с временными метками говорящих
+    python diarize.py audio.wav
+
+Пакетный режим: каталоги, glob-шаблоны или манифест (по пути на строку),
+pipeline загружается один раз в каждом процессе пула, результаты (RTTM/JSON)
+пишутся по мере готовности. Повторный запуск пропускает уже обработанные
+файлы, поэтому после сбоя достаточно запустить ту же команду. В каждом
+процессе декодирование следующих файлов, инференс и запись результатов
+идут параллельно (--prefetch, --decode-threads).
+    python diarize.py /data/calls --output-dir out --workers 4
+    python diarize.py "/data/**/*.mp3" --manifest extra.txt --output-dir out
+
+Форматы результата - см. formats.py (json, columnar, rttm, msgpack, arrow);
+в режиме одного файла --format выводит результат в этом формате в stdout.
+    python diarize.py audio.wav --format rttm
+
+Постобработка (postprocess.py) - в обоих режимах: склейка реплик одного
+спикера, отсев коротких реплик, области перекрытия и статистика по спикерам.
+    python diarize.py audio.wav --merge-gap 0.5 --min-duration 0.2 --format json --speaker-stats
 """
 
-import sys
+import argparse
+import contextlib
+import glob
 import json
-from pyannote.audio import Pipeline
+import multiprocessing
+import os
+import sys
+import time
+
+DEFAULT_MODEL = "pyannote/speaker-diarization-3.1"
+AUDIO_EXTENSIONS = {'wav', 'mp3', 'm4a', 'ogg', 'flac', 'aac', 'wma', 'webm', 'opus'}
+OUTPUT_FORMATS = ('json', 'columnar', 'rttm', 'msgpack', 'arrow')
+DEFAULT_BATCH_FORMATS = ('rttm', 'json')
+
+# Pipeline процесса пула (загружается один раз в initializer)
+_pipeline = None
+_output_dir = None
+_formats = None
+_pipeline_kwargs = None
+_vad_min_silence = None
+_postprocess = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Speaker diarization of single files or whole archives')
+    parser.add_argument('inputs', nargs='*', help='Audio files, directories or glob patterns')
+    parser.add_argument('--manifest', help='Text file with one audio path per line')
+    parser.add_argument('--output-dir', help='Write results here (enables batch mode)')
+    parser.add_argument('--format', nargs='+', choices=OUTPUT_FORMATS, default=None,
+                        help='Output formats (batch default: rttm json; single file: legacy JSON list)')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes (default: 1)')
+    parser.add_argument('--threads-per-worker', type=int, default=None,
+                        help='torch threads per worker (default: CPU count / workers)')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='Files decoded ahead while the model is busy, per worker (default: 2, 0 - no prefetch)')
+    parser.add_argument('--decode-threads', type=int, default=2,
+                        help='Decoding threads per worker (default: 2)')
+    parser.add_argument('--recursive', action='store_true', help='Search directories recursively')
+    parser.add_argument('--overwrite', action='store_true', help='Re-process files that already have outputs')
+    parser.add_argument('--model', default=None,
+                        help='Model path or HuggingFace id (default: PYANNOTE_MODEL_PATH or pyannote hub)')
+    parser.add_argument('--device', default=None, help='cpu, cuda or cuda:N (default: auto)')
+    parser.add_argument('--vad', action='store_true', help='Cut long silences before diarization')
+    parser.add_argument('--vad-min-silence', type=float, default=2.0,
+                        help='Shortest silence to cut with --vad, seconds (default: 2.0)')
+    parser.add_argument('--num-speakers', type=int, default=None)
+    parser.add_argument('--min-speakers', type=int, default=None)
+    parser.add_argument('--max-speakers', type=int, default=None)
+    parser.add_argument('--clustering-threshold', type=float, default=None,
+                        help='Override clustering threshold from config.yaml')
+    parser.add_argument('--min-cluster-size', type=int, default=None,
+                        help='Override clustering min_cluster_size from config.yaml')
+    parser.add_argument('--min-duration-off', type=float, default=None,
+                        help='Override segmentation min_duration_off from config.yaml')
+    parser.add_argument('--clustering', choices=('agglomerative', 'fast'), default=None,
+                        help='Clustering engine (fast: blocked float32 distances with pre-grouping for long files)')
+    parser.add_argument('--merge-gap', type=float, default=None,
+                        help='Merge turns of the same speaker separated by at most this many seconds')
+    parser.add_argument('--min-duration', type=float, default=None,
+                        help='Drop turns shorter than this many seconds (after merging)')
+    parser.add_argument('--overlaps', action='store_true', help='Add overlapped speech regions to the result')
+    parser.add_argument('--speaker-stats', action='store_true', help='Add per-speaker statistics to the result')
+    return parser.parse_args()
+
+
+def resolve_model(model=None):
+    """Модель из --model, иначе из PYANNOTE_MODEL_PATH (если путь есть), иначе с hub"""
+    if model:
+        return model
+    model = os.getenv('PYANNOTE_MODEL_PATH')
+    return model if model and os.path.exists(model) else DEFAULT_MODEL
+
+
+def load_pipeline(model, device=None):
+    """Загрузка pipeline из локального пути или HuggingFace"""
+    import torch
+    from pyannote.audio import Pipeline
+
+    if os.path.exists(model):
+        # pyannote ожидает прямые слэши и в Windows путях
+        model = os.path.abspath(model).replace('\\', '/')
+    # Токен берётся из HF_TOKEN в окружении
+    pipeline = Pipeline.from_pretrained(model, use_auth_token=None)
+
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return pipeline.to(torch.device(device))
+
+
+def encode_output(result, fmt, extra=None, uri='audio'):
+    """Результат в формате fmt: строка (json, columnar, rttm) или байты"""
+    from formats import render
+
+    body, _ = render(result, fmt, extra, uri=uri)
+    if isinstance(body, dict):
+        return json.dumps(body, ensure_ascii=False)
+    return body
+
+
+def is_audio(path):
+    return os.path.isfile(path) and os.path.splitext(path)[1].lower().lstrip('.') in AUDIO_EXTENSIONS
+
+
+def expand_inputs(inputs, manifest=None, recursive=False):
+    """
+    Список (путь, имя результата без расширения)
+
+    Для файлов из каталога имя - путь относительно каталога, чтобы одинаковые
+    имена в разных подкаталогах не перезаписывали друг друга.
+    """
+    found = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            paths = glob.glob(os.path.join(pattern, '**', '*') if recursive else os.path.join(pattern, '*'),
+                              recursive=recursive)
+            found.extend((path, os.path.relpath(path, pattern)) for path in sorted(paths) if is_audio(path))
+        elif os.path.isfile(pattern):
+            found.append((pattern, os.path.basename(pattern)))
+        else:
+            found.extend((path, os.path.basename(path)) for path in sorted(glob.glob(pattern, recursive=True))
+                         if is_audio(path))
+
+    if manifest:
+        base_dir = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, 'r', encoding='utf-8') as f:
+            for line in f:
+                path = line.strip()
+                if not path or path.startswith('#'):
+                    continue
+                if not os.path.isabs(path):
+                    path = os.path.join(base_dir, path)
+                found.append((path, os.path.basename(path)))
+
+    items = []
+    seen_paths = set()
+    seen_names = set()
+    for path, name in found:
+        key = os.path.abspath(path)
+        if key in seen_paths:
+            continue
+        seen_paths.add(key)
+        name = os.path.splitext(name)[0]
+        unique, n = name, 1
+        while unique in seen_names:
+            n += 1
+            unique = f"{name}_{n}"
+        seen_names.add(unique)
+        items.append((path, unique))
+    return items
+
+
+def output_paths(output_dir, name, formats):
+    from formats import EXTENSIONS
+    return {fmt: os.path.join(output_dir, f"{name}.{EXTENSIONS[fmt]}") for fmt in formats}
+
+
+def is_finished(output_dir, name, formats):
+    return all(os.path.exists(path) for path in output_paths(output_dir, name, formats).values())
+
+
+def write_atomic(path, data):
+    """Запись через временный файл: незавершённый результат не считается готовым"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    if isinstance(data, bytes):
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+    else:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+    os.replace(tmp_path, path)
+
+
+def init_worker(model, device, threads, output_dir, formats, pipeline_kwargs, vad_min_silence=None,
+                params=None, postprocess=None):
+    """Инициализация процесса пула: pipeline загружается один раз"""
+    global _pipeline, _output_dir, _formats, _pipeline_kwargs, _vad_min_silence, _postprocess
+    import torch
+    from pipeline_params import instantiate_variant
+
+    torch.set_num_threads(threads)
+    if device is None and torch.cuda.device_count() > 1:
+        # Процессы пула распределяются по видеокартам по очереди
+        identity = multiprocessing.current_process()._identity
+        device = f"cuda:{(identity[0] - 1) % torch.cuda.device_count() if identity else 0}"
+
+    _pipeline = load_pipeline(model, device)
+    if params:
+        # Переопределения config.yaml и движок кластеризации применяются один раз на процесс
+        _pipeline = instantiate_variant(_pipeline, params)
+    _output_dir = output_dir
+    _formats = formats
+    _pipeline_kwargs = pipeline_kwargs
+    _vad_min_silence = vad_min_silence
+    _postprocess = postprocess
+
+
+def prepare_file(item):
+    """Стадия декодирования: чтение, декодирование с ресемплингом и VAD (выполняется в пуле потоков)"""
+    from audio_io import decode_audio, waveform_duration
+
+    path, name = item
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        audio = decode_audio(f.read(), path)
+    duration = waveform_duration(audio)
+
+    timeline = None
+    if _vad_min_silence is not None:
+        from vad import strip_silence
+        audio, timeline = strip_silence(audio, min_silence=_vad_min_silence)
+
+    return {'path': path, 'name': name, 'audio': audio, 'duration': duration, 'timeline': timeline,
+            'decode_seconds': time.perf_counter() - start}
+
+
+def diarize_prepared(prepared):
+    """Стадия инференса: pipeline на уже декодированном аудио"""
+    from formats import SegmentTable
+
+    timeline = prepared['timeline']
+    if timeline is not None and timeline.is_empty:
+        return SegmentTable([], [], [], [])
+    diarization = _pipeline(prepared.pop('audio'), **_pipeline_kwargs)
+    if timeline is not None:
+        diarization = timeline.restore(diarization)
+    return SegmentTable.from_annotation(diarization)
+
+
+def write_outputs(prepared, segments, inference_seconds):
+    """Стадия сериализации: постобработка и запись результатов во всех форматах"""
+    from postprocess import apply_postprocess
+
+    path, name = prepared['path'], prepared['name']
+    elapsed = prepared['decode_seconds'] + inference_seconds
+    result = {
+        'segments': segments,
+        'total_segments': len(segments),
+        'audio_duration_seconds': round(prepared['duration'], 2),
+        'processing_time_seconds': round(elapsed, 2),
+    }
+    apply_postprocess(result, _postprocess)
+    for fmt, output_path in output_paths(_output_dir, name, _formats).items():
+        write_atomic(output_path, encode_output(result, fmt, {'file': path}, uri=os.path.basename(name)))
+    return {'path': path, 'segments': result['total_segments'], 'duration': prepared['duration'], 'elapsed': elapsed}
+
+
+def write_stage(outputs, report):
+    """Поток записи: сериализует результаты, пока pipeline занят следующими файлами"""
+    while True:
+        entry = outputs.get()
+        if entry is None:
+            return
+        if 'error' in entry:
+            report(entry)
+            continue
+        try:
+            report(write_outputs(entry['prepared'], entry['segments'], entry['inference_seconds']))
+        except Exception as e:
+            report({'path': entry['prepared']['path'], 'error': str(e), 'elapsed': 0.0})
+
+
+def run_staged(items, report, prefetch=2, decode_threads=2):
+    """
+    Конвейер обработки файлов в процессе пула
+
+    Пока pipeline обрабатывает текущий файл, пул потоков декодирует и
+    ресемплирует следующие (не больше prefetch файлов впрок), а отдельный
+    поток записывает готовые результаты. Модель не простаивает на
+    декодировании и записи. report(result) вызывается из потока записи
+    для каждого файла в порядке items.
+    """
+    import collections
+    import queue
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    items = iter(items)
+    prefetch = max(0, prefetch)
+    decoding = collections.deque()
+    # Ограниченная очередь записи: если диск не успевает, инференс ждёт
+    outputs = queue.Queue(maxsize=max(1, prefetch))
+    writer = threading.Thread(target=write_stage, args=(outputs, report), name='batch-writer', daemon=True)
+    writer.start()
+
+    with ThreadPoolExecutor(max_workers=max(1, decode_threads), thread_name_prefix='batch-decode') as decoders:
+        def fill(limit):
+            while len(decoding) < limit:
+                item = next(items, None)
+                if item is None:
+                    return
+                decoding.append((item, decoders.submit(prepare_file, item)))
+
+        while True:
+            # Следующий файл (с prefetch=0 он начинает декодироваться только здесь)
+            fill(1)
+            if not decoding:
+                break
+            item, future = decoding.popleft()
+            # Пока обрабатывается текущий файл, декодируются до prefetch следующих
+            fill(prefetch)
+            start = time.perf_counter()
+            try:
+                prepared = future.result()
+                start = time.perf_counter()
+                segments = diarize_prepared(prepared)
+            except Exception as e:
+                outputs.put({'path': item[0], 'error': str(e), 'elapsed': time.perf_counter() - start})
+                continue
+            outputs.put({'prepared': prepared, 'segments': segments,
+                         'inference_seconds': time.perf_counter() - start})
+
+    outputs.put(None)
+    writer.join()
+
+
+def worker_main(initargs, tasks, results, prefetch, decode_threads):
+    """Процесс пула: файлы берутся из общей очереди tasks, итоги уходят в results"""
+    init_worker(*initargs)
+    run_staged(iter(tasks.get, None), results.put, prefetch, decode_threads)
+
+
+def run_single(audio_file, model, fmt=None, postprocess=None, pipeline_kwargs=None, params=None,
+               vad_min_silence=None):
+    """
+    Исходный режим: один файл, JSON со списком сегментов в stdout
+
+    С fmt результат выводится в stdout в этом формате (msgpack и arrow - байтами).
+    Без fmt из постобработки применяются только склейка и отсев реплик.
+    pipeline_kwargs и params - гиперпараметры из parse_params, как в пакетном режиме;
+    vad_min_silence - вырезать паузы не короче этого (--vad).
+    """
+    try:
+        # stdout отдан под JSON результата, диагностика уходит в stderr
+        with contextlib.redirect_stdout(sys.stderr):
+            # Инициализация pipeline для диаризации
+            # Получите токен на https://huggingface.co/settings/tokens
+            # и установите переменную окружения HF_TOKEN
+            pipeline = load_pipeline(resolve_model(model))
+            if params:
+                from pipeline_params import instantiate_variant
+                pipeline = instantiate_variant(pipeline, params)
+
+            # Выполнение диаризации (аудио декодируется так же, как в сервисе)
+            from audio_io import decode_audio
+            with open(audio_file, 'rb') as f:
+                audio = decode_audio(f.read(), audio_file)
+
+            # Вырезание пауз и перенос разметки на исходную шкалу - как в prepare_file
+            timeline = None
+            if vad_min_silence is not None:
+                from vad import strip_silence
+                audio, timeline = strip_silence(audio, min_silence=vad_min_silence)
+
+            from formats import SegmentTable
+            from postprocess import apply_postprocess
+            if timeline is not None and timeline.is_empty:
+                segments = SegmentTable([], [], [], [])
+            else:
+                diarization = pipeline(audio, **(pipeline_kwargs or {}))
+                if timeline is not None:
+                    diarization = timeline.restore(diarization)
+                segments = SegmentTable.from_annotation(diarization)
+            result = apply_postprocess({'segments': segments, 'total_segments': len(segments)}, postprocess)
+            if fmt is not None:
+                uri = os.path.splitext(os.path.basename(audio_file))[0]
+                output = encode_output(result, fmt, uri=uri)
+
+        if fmt is None:
+            print(json.dumps(result['segments'].to_segments()))
+        elif isinstance(output, bytes):
+            sys.stdout.buffer.write(output)
+            sys.stdout.flush()
+        else:
+            sys.stdout.write(output if fmt == 'rttm' else output + '\n')
+
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
+
+
+def run_processes(pending, workers, initargs, report, prefetch, decode_threads):
+    """
+    Пул процессов с общей очередью файлов
+
+    Каждый процесс сам берёт следующий файл, когда его стадия декодирования
+    готова принять новый, поэтому предвыборка работает и в пуле.
+    """
+    import queue
+
+    # spawn: CUDA и потоки torch не переживают fork
+    context = multiprocessing.get_context('spawn')
+    tasks, results = context.Queue(), context.Queue()
+    for item in pending:
+        tasks.put(item)
+    for _ in range(workers):
+        tasks.put(None)
+
+    processes = [
+        context.Process(target=worker_main, args=(initargs, tasks, results, prefetch, decode_threads), daemon=True)
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        received = 0
+        while received < len(pending):
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    print(f"✗ All worker processes exited, {len(pending) - received} file(s) not processed")
+                    break
+                continue
+            received += 1
+            report(result)
+    finally:
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+
+def run_batch(args):
+    from pipeline_params import parse_params
+    from postprocess import parse_postprocess
+    try:
+        pipeline_kwargs, params = parse_params(vars(args))
+        postprocess = parse_postprocess(vars(args))
+    except ValueError as e:
+        print(f"✗ {e}")
+        sys.exit(1)
+
+    formats = list(dict.fromkeys(args.format or DEFAULT_BATCH_FORMATS))
+    items = expand_inputs(args.inputs, args.manifest, args.recursive)
+    if not items:
+        print("✗ No audio files found")
+        sys.exit(1)
+
+    pending = items if args.overwrite else [
+        item for item in items if not is_finished(args.output_dir, item[1], formats)
+    ]
+    skipped = len(items) - len(pending)
+    if skipped:
+        print(f"⏭ Skipping {skipped} already finished file(s)")
+    if not pending:
+        print("✓ Nothing to do")
+        return
+
+    model = resolve_model(args.model)
+    workers = max(1, min(args.workers, len(pending)))
+    threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    initargs = (model, args.device, threads, args.output_dir, formats, pipeline_kwargs,
+                args.vad_min_silence if args.vad else None, params, postprocess)
+
+    print(f"🎵 {len(pending)} file(s), {workers} worker(s) x {threads} torch thread(s), "
+          f"prefetch {args.prefetch} with {args.decode_threads} decode thread(s), model: {model}")
+
+    started = time.perf_counter()
+    failed = []
+    totals = {'done': 0, 'audio_seconds': 0.0}
+
+    def report(result):
+        totals['done'] += 1
+        done = totals['done']
+        if 'error' in result:
+            failed.append(result)
+            print(f"✗ [{done}/{len(pending)}] {result['path']}: {result['error']}")
+        else:
+            totals['audio_seconds'] += result['duration']
+            print(f"✓ [{done}/{len(pending)}] {result['path']}: {result['segments']} segments, "
+                  f"{result['duration']:.1f}s audio in {result['elapsed']:.2f}s")
+
+    if workers == 1:
+        init_worker(*initargs)
+        run_staged(pending, report, args.prefetch, args.decode_threads)
+    else:
+        run_processes(pending, workers, initargs, report, args.prefetch, args.decode_threads)
+
+    # Файлы, взятые процессом, который завершился аварийно
+    failed.extend({'path': None, 'error': 'worker exited'} for _ in range(len(pending) - totals['done']))
+    audio_seconds = totals['audio_seconds']
+
+    elapsed = time.perf_counter() - started
+    print(f"\n{'='*60}")
+    print(f"Processed: {len(pending) - len(failed)}, failed: {len(failed)}, skipped: {skipped}")
+    print(f"Audio: {audio_seconds:.1f}s in {elapsed:.1f}s (RTF {elapsed / max(audio_seconds, 1e-6):.3f})")
+    print(f"{'='*60}")
+
+    if failed:
+        sys.exit(1)
+
 
 def main():
-    if len(sys.argv) < 2:
+    args = parse_args()
+
+    if args.output_dir:
+        run_batch(args)
+        return
+
+    if not args.inputs:
         print(json.dumps({"error": "No audio file provided"}))
         sys.exit(1)
-    
-    audio_file = sys.argv[1]
-    
+    if len(args.inputs) > 1 or args.manifest or os.path.isdir(args.inputs[0]):
+        print(json.dumps({"error": "Batch mode requires --output-dir"}))
+        sys.exit(1)
+
+    if args.format and len(args.format) > 1:
+        print(json.dumps({"error": "Single file mode supports one --format"}))
+        sys.exit(1)
+
+    from pipeline_params import parse_params
+    from postprocess import parse_postprocess
     try:
-        # Инициализация pipeline для диаризации
-        # Получите токен на https://huggingface.co/settings/tokens
-        # и установите переменную окружения HF_TOKEN
-        pipeline = Pipeline.from_pretrained(
-            "pyannote/speaker-diarization-3.1",
-            use_auth_token=None  # Будет использован HF_TOKEN из окружения
-        )
-        
-        # Выполнение диаризации
-        diarization = pipeline(audio_file)
-        
-        # Формирование результата
-        result = []
-        for turn, _, speaker in diarization.itertracks(yield_label=True):
-            result.append({
-                "start": float(turn.start),
-                "end": float(turn.end),
-                "speaker": speaker
-            })
-        
-        print(json.dumps(result))
-    
-    except Exception as e:
+        pipeline_kwargs, params = parse_params(vars(args))
+        postprocess = parse_postprocess(vars(args))
+    except ValueError as e:
         print(json.dumps({"error": str(e)}))
         sys.exit(1)
 
+    run_single(args.inputs[0], args.model, args.format[0] if args.format else None, postprocess,
+               pipeline_kwargs, params, args.vad_min_silence if args.vad else None)
+
+
 if __name__ == "__main__":
     main()
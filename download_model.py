@@ -49,12 +49,46 @@ def setup_proxy():
     
     return proxies
     
+def create_snapshot(pipeline, model_path):
+    """Сохранение снимка pipeline (см. snapshot.py) рядом с моделью"""
+    from snapshot import SNAPSHOT_FILE, save_snapshot
+
+    snapshot_path = os.getenv('PYANNOTE_SNAPSHOT_PATH') or os.path.join(model_path, SNAPSHOT_FILE)
+    try:
+        size = save_snapshot(pipeline, snapshot_path)
+        print(f"✓ Pipeline snapshot saved to {snapshot_path} ({size / 1024 / 1024:.1f} MB)")
+    except Exception as e:
+        print(f"⚠ Warning: Could not save pipeline snapshot: {e}")
+        print("The service will load the model from config.yaml instead")
+
+
+def snapshot_local_model(model_path):
+    """Создание снимка из уже скачанной модели (без обращения к сети)"""
+    os.environ['HF_HUB_OFFLINE'] = '1'
+    from pyannote.audio import Pipeline
+
+    if not os.path.exists(model_path):
+        print(f"ERROR: Model not found at {model_path}")
+        sys.exit(1)
+
+    print(f"Loading local model from {model_path}...")
+    pipeline = Pipeline.from_pretrained(os.path.abspath(model_path).replace('\\', '/'))
+    create_snapshot(pipeline, model_path)
+
+
 def main():
+    # Путь для сохранения модели
+    model_path = os.getenv('PYANNOTE_MODEL_PATH', './models/pyannote-speaker-diarization-3.1')
+
+    # Только пересоздать снимок для уже скачанной модели
+    # (например, после обновления torch или pyannote.audio)
+    if '--snapshot-only' in sys.argv:
+        snapshot_local_model(model_path)
+        return
+
     # Настройка прокси ПЕРЕД импортом pyannote
     proxies = setup_proxy()
     
-    # Путь для сохранения модели
-    model_path = os.getenv('PYANNOTE_MODEL_PATH', './models/pyannote-speaker-diarization-3.1')
     hf_token = os.getenv('HF_TOKEN')
 
     if not hf_token:
@@ -114,6 +148,9 @@ def main():
         print("Saving model locally...")
         pipeline.save_pretrained(model_path)
 
+        # Снимок уже собранного pipeline для быстрого старта сервиса
+        create_snapshot(pipeline, model_path)
+
         print(f"\n✓ Model successfully downloaded to {model_path}")
         print("You can now run the diarization service without internet connection!")
 
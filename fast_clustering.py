@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+Быстрая кластеризация эмбеддингов спикеров для длинных записей
+
+AgglomerativeClustering из pyannote (method: centroid в config.yaml) строит
+матрицу попарных расстояний float64 всех эмбеддингов - по одному на
+локального спикера в каждом окне сегментации - и иерархию по ней. На
+многочасовых записях это десятки тысяч эмбеддингов: память растёт
+квадратично, а linkage занимает основную долю времени pipeline.
+
+FastAgglomerativeClustering - тот же алгоритм с теми же гиперпараметрами
+(threshold, min_cluster_size, подбор числа кластеров), но:
+- эмбеддинги нормируются и обрабатываются в float32, расстояния считаются
+  блоками по BLOCK_SIZE строк матричным умножением;
+- если эмбеддингов больше max_groups, они сначала приближённо группируются
+  сферическим k-means (начальные центры - равномерно по времени записи),
+  и иерархия строится по центроидам групп с весами - числом эмбеддингов
+  в группе;
+- centroid linkage с весами выполняется векторно: матрица квадратов
+  расстояний между кластерами хранится и обновляется формулой
+  Ланса-Уильямса за O(n) на слияние, минимумы пересчитываются только для
+  затронутых строк.
+
+До max_groups эмбеддингов (веса единичные) иерархию строит linkage из scipy,
+и разбиение совпадает с исходным; с группировкой - приближение, точность на
+эталонных RTTM сравнивает benchmark.py --clustering fast. Другие методы linkage и
+метрики выполняются исходным кодом pyannote.
+"""
+
+import numpy as np
+from pyannote.audio.pipelines.clustering import AgglomerativeClustering
+from scipy.cluster.hierarchy import fcluster, linkage
+
+from pipeline_params import CLUSTERING_ENGINES
+
+# Больше эмбеддингов - предварительная группировка
+MAX_GROUPS = 2000
+# Строк в блоке при вычислении расстояний (память блока - BLOCK_SIZE x n x 4 байта)
+BLOCK_SIZE = 4096
+KMEANS_ITERATIONS = 5
+
+
+def normalize(embeddings):
+    """Единичная норма строк, float32"""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return embeddings / np.linalg.norm(embeddings, axis=-1, keepdims=True)
+
+
+def nearest_centers(points, centers, block_size=BLOCK_SIZE):
+    """Индекс ближайшего (по косинусу) центра для каждой точки, блоками"""
+    nearest = np.empty(len(points), dtype=np.int64)
+    for start in range(0, len(points), block_size):
+        nearest[start:start + block_size] = np.argmax(points[start:start + block_size] @ centers.T, axis=1)
+    return nearest
+
+
+def group_sums(points, labels, count):
+    """Суммы точек по меткам (count, dimension)"""
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+    sums = np.zeros((count, points.shape[1]), dtype=np.float64)
+    sums[sorted_labels[starts]] = np.add.reduceat(points[order], starts, axis=0)
+    return sums
+
+
+def pregroup(points, max_groups, iterations=KMEANS_ITERATIONS, block_size=BLOCK_SIZE):
+    """
+    Приближённая группировка сферическим k-means
+
+    Эмбеддинги идут в порядке окон записи, поэтому центры, выбранные
+    равномерно по индексу, покрывают всю запись - в том числе спикеров,
+    которые говорят только в одной её части. Возвращает (метка группы для
+    каждой точки, центроиды групп, размеры групп).
+    """
+    centers = points[np.linspace(0, len(points) - 1, max_groups).astype(np.int64)]
+    for _ in range(iterations):
+        labels = nearest_centers(points, centers, block_size)
+        counts = np.bincount(labels, minlength=len(centers))
+        filled = counts > 0
+        # Пустые группы сохраняют прежний центр
+        centers[filled] = normalize(group_sums(points, labels, len(centers))[filled])
+
+    labels = nearest_centers(points, centers, block_size)
+    used, labels = np.unique(labels, return_inverse=True)
+    counts = np.bincount(labels, minlength=len(used))
+    # Центроид группы - среднее эмбеддингов, как у centroid linkage
+    means = (group_sums(points, labels, len(used)) / counts[:, None]).astype(np.float32)
+    return labels, means, counts
+
+
+def squared_distances(points, block_size=BLOCK_SIZE):
+    """Матрица квадратов евклидовых расстояний float32, блоками"""
+    squared_norms = np.einsum('ij,ij->i', points, points)
+    distances = np.empty((len(points), len(points)), dtype=np.float32)
+    for start in range(0, len(points), block_size):
+        block = points[start:start + block_size]
+        distances[start:start + block_size] = (
+            squared_norms[start:start + block_size, None] + squared_norms[None, :] - 2 * (block @ points.T)
+        )
+    np.maximum(distances, 0, out=distances)
+    return distances
+
+
+def centroid_linkage(points, weights=None, block_size=BLOCK_SIZE):
+    """
+    Centroid linkage с весами точек
+
+    Возвращает (dendrogram, merged_weights): матрицу в формате
+    scipy.cluster.hierarchy.linkage (n - 1, 4) - номера объединяемых
+    кластеров, расстояние и число точек - и суммарный вес кластера,
+    созданного на каждом шаге. Точка с весом w ведёт себя как w
+    совпадающих эмбеддингов.
+    """
+    n = len(points)
+    sizes = np.ones(n) if weights is None else np.asarray(weights, dtype=np.float64).copy()
+    counts = np.ones(n)
+    merged_weights = np.empty(n - 1)
+    distances = squared_distances(points, block_size)
+    np.fill_diagonal(distances, np.inf)
+
+    cluster_ids = np.arange(n)
+    nearest = np.argmin(distances, axis=1)
+    nearest_distance = distances[np.arange(n), nearest]
+    dendrogram = np.empty((n - 1, 4))
+
+    for step in range(n - 1):
+        i = int(np.argmin(nearest_distance))
+        j = int(nearest[i])
+        distance = float(nearest_distance[i])
+        size_i, size_j = sizes[i], sizes[j]
+        merged_size = size_i + size_j
+        dendrogram[step] = (min(cluster_ids[i], cluster_ids[j]), max(cluster_ids[i], cluster_ids[j]),
+                            np.sqrt(max(distance, 0.0)), counts[i] + counts[j])
+        merged_weights[step] = merged_size
+        counts[i] += counts[j]
+
+        # Ланс-Уильямс для centroid linkage: расстояния до центроида i+j
+        # из уже известных расстояний до i и до j
+        merged = (size_i * distances[i] + size_j * distances[j]) / merged_size
+        merged -= size_i * size_j * distance / (merged_size * merged_size)
+        np.maximum(merged, 0, out=merged)
+        merged[i] = merged[j] = np.inf
+
+        # Кластер i+j занимает строку i, строка j выбывает
+        distances[i] = merged
+        distances[:, i] = merged
+        distances[j] = np.inf
+        distances[:, j] = np.inf
+        sizes[i] = merged_size
+        cluster_ids[i] = n + step
+        nearest_distance[j] = np.inf
+
+        stale = (nearest == i) | (nearest == j)
+        closer = merged < nearest_distance
+        nearest[closer] = i
+        nearest_distance[closer] = merged[closer]
+        # Строки, чей ближайший кластер исчез и не заменён новым, пересчитываются
+        stale &= ~closer
+        stale[[i, j]] = False
+        rows = np.flatnonzero(stale)
+        if len(rows):
+            nearest[rows] = np.argmin(distances[rows], axis=1)
+            nearest_distance[rows] = distances[rows, nearest[rows]]
+        nearest[i] = np.argmin(distances[i])
+        nearest_distance[i] = distances[i, nearest[i]]
+
+    return dendrogram, merged_weights
+
+
+class FastAgglomerativeClustering(AgglomerativeClustering):
+    """AgglomerativeClustering с блочными float32 расстояниями и предварительной группировкой"""
+
+    def __init__(self, metric='cosine', max_num_embeddings=np.inf, constrained_assignment=False,
+                 max_groups=MAX_GROUPS, block_size=BLOCK_SIZE):
+        super().__init__(metric=metric, max_num_embeddings=max_num_embeddings,
+                         constrained_assignment=constrained_assignment)
+        self.max_groups = max(2, int(max_groups))
+        self.block_size = max(1, int(block_size))
+
+    def supported(self):
+        return self.method == 'centroid' and self.metric in ('cosine', 'euclidean')
+
+    def cluster(self, embeddings, min_clusters, max_clusters, num_clusters=None):
+        if not self.supported():
+            return super().cluster(embeddings, min_clusters, max_clusters, num_clusters=num_clusters)
+
+        num_embeddings = len(embeddings)
+        # Та же эвристика, что в pyannote: min_cluster_size меньше для коротких записей
+        min_cluster_size = min(self.min_cluster_size, max(1, round(0.1 * num_embeddings)))
+        if num_embeddings == 1:
+            return np.zeros((1,), dtype=np.uint8)
+
+        if self.metric == 'cosine':
+            points = normalize(embeddings)
+        else:
+            points = np.asarray(embeddings, dtype=np.float32)
+
+        if num_embeddings > self.max_groups:
+            groups, points, weights = pregroup(points, self.max_groups, block_size=self.block_size)
+            if len(points) == 1:
+                return np.zeros((num_embeddings,), dtype=np.int64)
+            dendrogram, merged_weights = centroid_linkage(points, weights, self.block_size)
+        else:
+            # Без группировки веса единичные: linkage из scipy (на C) даёт ту же иерархию быстрее
+            groups, weights = np.arange(num_embeddings), np.ones(num_embeddings)
+            dendrogram = linkage(points, method='centroid', metric='euclidean')
+            merged_weights = dendrogram[:, 3]
+        labels = self.cut(dendrogram, merged_weights, points, weights, min_cluster_size,
+                          min_clusters, max_clusters, num_clusters)
+        return labels[groups]
+
+    def cut(self, dendrogram, merged_weights, points, weights, min_cluster_size, min_clusters, max_clusters,
+            num_clusters):
+        """Плоские кластеры по дендрограмме - как AgglomerativeClustering.cluster, но с весами точек"""
+
+        def large_clusters(labels):
+            sizes = np.bincount(labels, weights=weights)
+            return np.flatnonzero(sizes >= min_cluster_size), sizes
+
+        clusters = fcluster(dendrogram, self.threshold, criterion='distance') - 1
+        large, sizes = large_clusters(clusters)
+        num_large_clusters = len(large)
+
+        if num_large_clusters < min_clusters:
+            num_clusters = min_clusters
+        elif num_large_clusters > max_clusters:
+            num_clusters = max_clusters
+
+        if num_clusters is not None and num_large_clusters != num_clusters:
+            # Критерий остановки - номер шага слияния вместо расстояния
+            steps = np.copy(dendrogram)
+            steps[:, 2] = np.arange(len(dendrogram))
+
+            best_iteration = len(dendrogram)
+            best_num_large_clusters = 1
+            for iteration in np.argsort(np.abs(dendrogram[:, 2] - self.threshold)):
+                if merged_weights[iteration] < min_cluster_size:
+                    continue
+                clusters = fcluster(steps, iteration, criterion='distance') - 1
+                num_large_clusters = len(large_clusters(clusters)[0])
+                if abs(num_large_clusters - num_clusters) < abs(best_num_large_clusters - num_clusters):
+                    best_iteration = iteration
+                    best_num_large_clusters = num_large_clusters
+                if num_large_clusters == num_clusters:
+                    break
+
+            if best_num_large_clusters != num_clusters:
+                clusters = fcluster(steps, best_iteration, criterion='distance') - 1
+                print(f"⚠ Found only {len(large_clusters(clusters)[0])} clusters, "
+                      f"a smaller min_cluster_size than {min_cluster_size} might help")
+            large, sizes = large_clusters(clusters)
+
+        if len(large) == 0:
+            return np.zeros_like(clusters)
+
+        small = np.flatnonzero((sizes > 0) & (sizes < min_cluster_size))
+        if len(small) == 0:
+            return np.unique(clusters, return_inverse=True)[1]
+
+        # Малые кластеры присоединяются к ближайшему по центроиду большому
+        centroids = group_sums(points * weights[:, None], clusters, len(sizes))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            centroids /= sizes[:, None]
+        if self.metric == 'cosine':
+            centroids = normalize(centroids)
+            closest = np.argmax(centroids[small] @ centroids[large].T, axis=1)
+        else:
+            closest = np.argmin(
+                ((centroids[small][:, None, :] - centroids[large][None, :, :]) ** 2).sum(axis=-1), axis=1
+            )
+        mapping = np.arange(len(sizes))
+        mapping[small] = large[closest]
+        return np.unique(mapping[clusters], return_inverse=True)[1]
+
+    def assign_embeddings(self, embeddings, train_chunk_idx, train_speaker_idx, train_clusters,
+                          constrained=False):
+        """Отнесение всех эмбеддингов к ближайшему центроиду: центроиды и косинусы - векторно, блоками"""
+        if self.metric != 'cosine':
+            return super().assign_embeddings(embeddings, train_chunk_idx, train_speaker_idx, train_clusters,
+                                             constrained=constrained)
+
+        num_clusters = int(np.max(train_clusters)) + 1
+        num_chunks, num_speakers, dimension = embeddings.shape
+        train_embeddings = embeddings[train_chunk_idx, train_speaker_idx]
+        counts = np.bincount(train_clusters, minlength=num_clusters)
+        centroids = group_sums(train_embeddings, np.asarray(train_clusters), num_clusters) / counts[:, None]
+
+        flat = normalize(embeddings.reshape(-1, dimension))
+        unit_centroids = normalize(centroids)
+        similarity = np.empty((len(flat), num_clusters), dtype=np.float32)
+        for start in range(0, len(flat), self.block_size):
+            similarity[start:start + self.block_size] = flat[start:start + self.block_size] @ unit_centroids.T
+        # soft = 2 - косинусное расстояние = 1 + косинус, как в pyannote
+        soft_clusters = (1.0 + similarity).reshape(num_chunks, num_speakers, num_clusters)
+
+        if constrained:
+            hard_clusters = self.constrained_argmax(soft_clusters)
+        else:
+            hard_clusters = np.argmax(soft_clusters, axis=2)
+        return hard_clusters, soft_clusters, centroids.astype(embeddings.dtype)
+
+
+def clustering_engine(pipeline):
+    """Движок кластеризации pipeline: agglomerative или fast"""
+    return 'fast' if isinstance(pipeline._pipelines.get('clustering'), FastAgglomerativeClustering) \
+        else 'agglomerative'
+
+
+def set_clustering_engine(pipeline, engine, **options):
+    """
+    Замена под-pipeline кластеризации на движок engine
+
+    Гиперпараметры (method, threshold, min_cluster_size) переносятся в новый
+    экземпляр. Для движка, который уже установлен, ничего не делает.
+    options - параметры FastAgglomerativeClustering (max_groups, block_size).
+    """
+    if engine not in CLUSTERING_ENGINES:
+        raise ValueError(f"clustering must be one of: {', '.join(CLUSTERING_ENGINES)}")
+    current = pipeline._pipelines.get('clustering')
+    if current is None or not isinstance(current, AgglomerativeClustering) or clustering_engine(pipeline) == engine:
+        return pipeline
+
+    kwargs = {
+        'metric': current.metric,
+        'max_num_embeddings': current.max_num_embeddings,
+        'constrained_assignment': current.constrained_assignment,
+    }
+    replacement = FastAgglomerativeClustering(**kwargs, **options) if engine == 'fast' \
+        else AgglomerativeClustering(**kwargs)
+    params = current.parameters(instantiated=True)
+    if params:
+        replacement.instantiate(params)
+    # Pipeline.__setattr__ регистрирует под-pipeline в _pipelines
+    pipeline.__dict__['_pipelines']['clustering'] = replacement
+    return pipeline
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Форматы результата диаризации
+
+SegmentTable - колоночное представление разметки: массивы начал и концов
+сегментов, массив индексов спикеров и таблица меток. Строится напрямую из
+Annotation и хранится в кэше и результатах задач; словарь на каждый
+сегмент создаётся только для JSON-ответа в исходном формате.
+
+Форматы ответа:
+- json: {"segments": [{"start", "end", "speaker"}, ...], ...} (по умолчанию)
+- columnar: JSON, в котором segments = {"start": [...], "end": [...],
+  "speaker": [индексы], "labels": [...]}
+- rttm: текст RTTM (одна строка SPEAKER на сегмент)
+- msgpack: колоночный ответ в msgpack (нужен пакет msgpack)
+- arrow: Arrow IPC stream, столбцы start, end, speaker (dictionary);
+  остальные поля ответа - в метаданных схемы (нужен пакет pyarrow)
+"""
+
+import itertools
+import json
+
+import numpy as np
+
+FORMATS = ('json', 'columnar', 'rttm', 'msgpack', 'arrow')
+
+MIMETYPES = {
+    'json': 'application/json',
+    'columnar': 'application/vnd.diarization.columnar+json',
+    'rttm': 'text/x-rttm',
+    'msgpack': 'application/msgpack',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+# Альтернативные MIME-типы, которые принимаются в заголовке Accept
+ACCEPT_ALIASES = {
+    'application/x-msgpack': 'msgpack',
+    'application/vnd.msgpack': 'msgpack',
+    'text/rttm': 'rttm',
+    'application/vnd.apache.arrow.file': 'arrow',
+}
+
+# Расширения файлов для diarize.py
+EXTENSIONS = {
+    'json': 'json',
+    'columnar': 'columns.json',
+    'rttm': 'rttm',
+    'msgpack': 'msgpack',
+    'arrow': 'arrow',
+}
+
+
+class FormatUnavailable(Exception):
+    """Формат требует необязательной зависимости, которая не установлена"""
+
+
+class SegmentTable:
+    """Сегменты диаризации в виде параллельных массивов"""
+
+    def __init__(self, start, end, speaker, labels):
+        self.start = np.asarray(start, dtype=np.float64)
+        self.end = np.asarray(end, dtype=np.float64)
+        self.speaker = np.asarray(speaker, dtype=np.int32)
+        self.labels = list(labels)
+
+    def __len__(self):
+        return len(self.start)
+
+    @classmethod
+    def from_annotation(cls, annotation):
+        labels = annotation.labels()
+        index = {label: i for i, label in enumerate(labels)}
+        count = len(annotation)
+        tracks = annotation.itertracks(yield_label=True)
+        # Плоский массив и reshape: fromiter с dtype-подмассивом требует numpy >= 1.23
+        rows = np.fromiter(
+            itertools.chain.from_iterable(
+                (segment.start, segment.end, index[label]) for segment, _, label in tracks
+            ),
+            dtype=np.float64, count=3 * count
+        ).reshape(-1, 3)
+        return cls(rows[:, 0], rows[:, 1], rows[:, 2].astype(np.int32), labels)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Из колоночного словаря (to_dict) или списка сегментов-словарей"""
+        if isinstance(data, dict):
+            return cls(data['start'], data['end'], data['speaker'], data['labels'])
+        labels = sorted({segment['speaker'] for segment in data})
+        index = {label: i for i, label in enumerate(labels)}
+        return cls(
+            [segment['start'] for segment in data],
+            [segment['end'] for segment in data],
+            [index[segment['speaker']] for segment in data],
+            labels,
+        )
+
+    def to_dict(self):
+        """Колоночное представление, пригодное для JSON"""
+        return {
+            'start': self.start.tolist(),
+            'end': self.end.tolist(),
+            'speaker': self.speaker.tolist(),
+            'labels': list(self.labels),
+        }
+
+    def to_segments(self, identities=None):
+        """Список сегментов-словарей (исходный JSON-формат ответа)"""
+        labels = self.labels
+        rows = zip(self.start.tolist(), self.end.tolist(), self.speaker.tolist())
+        if identities is None:
+            return [{'start': s, 'end': e, 'speaker': labels[k]} for s, e, k in rows]
+        return [
+            {'start': s, 'end': e, 'speaker': labels[k], 'identity': identities.get(labels[k])}
+            for s, e, k in rows
+        ]
+
+    def talk_time(self):
+        """Суммарная длительность речи каждого спикера {метка: секунды}"""
+        totals = np.bincount(self.speaker, weights=self.end - self.start, minlength=len(self.labels))
+        return dict(zip(self.labels, totals.tolist()))
+
+    def to_rttm(self, uri='audio'):
+        # В RTTM идентификатор записи не может содержать пробелов
+        uri = (uri or 'audio').replace(' ', '_')
+        labels = self.labels
+        lines = [
+            f"SPEAKER {uri} 1 {s:.3f} {d:.3f} <NA> <NA> {labels[k]} <NA> <NA>\n"
+            for s, d, k in zip(self.start.tolist(), (self.end - self.start).tolist(), self.speaker.tolist())
+        ]
+        return ''.join(lines)
+
+
+def columnar_response(result, extra=None, identities=None):
+    """Ответ с колоночными сегментами (для columnar и msgpack)"""
+    table = result['segments']
+    segments = table.to_dict()
+    if identities is not None:
+        segments['identities'] = [identities.get(label) for label in table.labels]
+    return {**(extra or {}), **{k: v for k, v in result.items() if k != 'identities'}, 'segments': segments}
+
+
+def json_response(result, extra=None):
+    """Ответ в исходном JSON-формате"""
+    data = {**(extra or {}), **{k: v for k, v in result.items() if k != 'identities'}}
+    data['segments'] = result['segments'].to_segments(result.get('identities'))
+    return data
+
+
+def encode_msgpack(data):
+    try:
+        import msgpack
+    except ImportError:
+        raise FormatUnavailable('msgpack output requires the msgpack package (pip install msgpack)')
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def encode_arrow(table, metadata=None):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise FormatUnavailable('Arrow output requires the pyarrow package (pip install pyarrow)')
+
+    speaker = pa.DictionaryArray.from_arrays(
+        pa.array(table.speaker, type=pa.int32()), pa.array(table.labels, type=pa.string())
+    )
+    batch = pa.record_batch(
+        [pa.array(table.start, type=pa.float64()), pa.array(table.end, type=pa.float64()), speaker],
+        names=['start', 'end', 'speaker'],
+    )
+    schema = batch.schema.with_metadata({'diarization': json.dumps(metadata or {}, ensure_ascii=False)})
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        writer.write_batch(batch.replace_schema_metadata(schema.metadata))
+    return sink.getvalue().to_pybytes()
+
+
+def render(result, fmt, extra=None, uri='audio'):
+    """
+    Результат в выбранном формате: (тело, MIME-тип)
+
+    Для json/columnar тело - словарь (сериализуется вызывающим кодом),
+    для остальных - строка или байты.
+    """
+    identities = result.get('identities')
+    if fmt == 'json':
+        return json_response(result, extra), MIMETYPES['json']
+    if fmt == 'columnar':
+        return columnar_response(result, extra, identities), MIMETYPES['columnar']
+    if fmt == 'rttm':
+        return result['segments'].to_rttm(uri), MIMETYPES['rttm']
+    if fmt == 'msgpack':
+        return encode_msgpack(columnar_response(result, extra, identities)), MIMETYPES['msgpack']
+    if fmt == 'arrow':
+        metadata = columnar_response(result, extra, identities)
+        metadata.pop('segments')
+        if identities is not None:
+            metadata['identities'] = identities
+        return encode_arrow(result['segments'], metadata), MIMETYPES['arrow']
+    raise ValueError(f"Unknown output format '{fmt}', expected one of {', '.join(FORMATS)}")
+
+
+def negotiate(requested, accept_mimetypes):
+    """
+    Выбор формата: явный параметр format или заголовок Accept
+
+    requested - значение параметра format (или None), accept_mimetypes -
+    werkzeug MIMEAccept. Возвращает имя формата или None, если ни один
+    из запрошенных форматов не поддерживается.
+    """
+    if requested:
+        requested = requested.lower()
+        return requested if requested in FORMATS else None
+
+    offers = list(MIMETYPES.values()) + list(ACCEPT_ALIASES)
+    best = accept_mimetypes.best_match(offers)
+    if best is None:
+        # Без заголовка Accept - JSON, с заголовком без подходящих типов - 406
+        return None if accept_mimetypes else 'json'
+    for fmt, mimetype in MIMETYPES.items():
+        if mimetype == best:
+            return fmt
+    return ACCEPT_ALIASES.get(best)
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+Очередь задач диаризации с ограниченным пулом воркеров
+
+Каждый воркер - отдельный поток, который один раз получает свой pipeline
+(через worker_init) и дальше обрабатывает задачи из общей ограниченной очереди.
+Так модель не вызывается из потоков Flask напрямую и не перегружается
+параллельными запросами.
+
+При нескольких репликах (например, по pipeline на каждую видеокарту) у
+каждой реплики свои воркеры и своя очередь, а новая задача направляется
+в наименее загруженную реплику: по числу задач в её очереди и в работе
+на воркер плюс внешняя оценка загрузки (доля занятой памяти устройства).
+
+С prepare и prefetch > 0 подготовка задач (например, декодирование аудио)
+выполняется заранее в отдельном пуле потоков: пока воркеры заняты
+инференсом, до prefetch задач из очереди уже готовятся, и воркер, взяв
+задачу, сразу передаёт её модели.
+"""
+
+import collections
+import math
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Статусы задач
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+FINISHED_STATUSES = {JOB_DONE, JOB_FAILED, JOB_CANCELLED}
+
+
+class QueueFullError(Exception):
+    """Очередь задач заполнена, новую задачу принять нельзя"""
+
+    def __init__(self, retry_after):
+        super().__init__('Job queue is full')
+        self.retry_after = retry_after
+
+
+class Job:
+    """Задача диаризации и её тайминги"""
+
+    def __init__(self, payload, filename=None):
+        self.id = uuid.uuid4().hex
+        self.payload = payload
+        self.filename = filename
+        self.status = JOB_QUEUED
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.worker = None
+        self.replica = None
+        self.prepared = None  # Future подготовки задачи (prefetch)
+        self.done_event = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    def to_dict(self, include_result=True):
+        """Представление задачи для JSON-ответа"""
+        now = time.time()
+        queue_wait = (self.started_at or self.finished_at or now) - self.created_at
+        data = {
+            'job_id': self.id,
+            'status': self.status,
+            'filename': self.filename,
+            'worker': self.worker,
+            'replica': self.replica,
+            'created_at': round(self.created_at, 3),
+            'started_at': round(self.started_at, 3) if self.started_at else None,
+            'finished_at': round(self.finished_at, 3) if self.finished_at else None,
+            'queue_wait_seconds': round(queue_wait, 2),
+            'processing_time_seconds': None,
+            'total_time_seconds': round((self.finished_at or now) - self.created_at, 2),
+        }
+        if self.started_at:
+            data['processing_time_seconds'] = round((self.finished_at or now) - self.started_at, 2)
+        if self.error:
+            data['error'] = self.error
+        if include_result and self.result is not None:
+            data['result'] = self.result
+        return data
+
+
+class JobQueue:
+    """
+    Ограниченная очередь задач с пулом воркеров
+
+    runner(payload, context) выполняет задачу и возвращает результат,
+    worker_init(index) вызывается один раз в каждом воркере и возвращает его
+    context (например, pipeline), discard(payload) освобождает ресурсы задачи,
+    которая была отменена до начала обработки.
+
+    replicas - число реплик (или функция, возвращающая его при запуске),
+    workers - число воркеров на реплику; воркер index обслуживает реплику
+    index // workers. replica_load(replica) - дополнительная загрузка
+    реплики (0..1), учитывается при выборе реплики для задачи.
+
+    prepare(payload) подготавливает задачу в пуле потоков до того, как её
+    возьмёт воркер (результат prepare сохраняет в payload сам); одновременно
+    подготовлено или готовится не больше prefetch ожидающих задач. Ошибка
+    prepare становится ошибкой задачи.
+    """
+
+    def __init__(self, runner, workers=1, max_queue_size=16, result_ttl=3600,
+                 worker_init=None, discard=None, replicas=1, replica_load=None,
+                 prepare=None, prefetch=0):
+        self.runner = runner
+        self.workers = max(1, int(workers))
+        self.max_queue_size = max(1, int(max_queue_size))
+        self.result_ttl = result_ttl
+        self.worker_init = worker_init
+        self.discard = discard
+        self.replicas = replicas
+        self.replica_load = replica_load
+        self.prepare = prepare
+        self.prefetch = max(0, int(prefetch)) if prepare is not None else 0
+
+        self._queues = []
+        self._queued = []
+        self._running_by_replica = []
+        self._completed_by_replica = []
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._running = 0
+        self._avg_processing_time = None
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._unprepared = collections.deque()
+        self._prefetched = 0
+        self._preparer = None
+
+    def start(self):
+        """Запуск воркеров (повторный вызов ничего не делает)"""
+        with self._lock:
+            if self._threads:
+                return
+            if callable(self.replicas):
+                self.replicas = self.replicas()
+            self.replicas = max(1, int(self.replicas))
+            self._queues = [queue.Queue() for _ in range(self.replicas)]
+            self._queued = [0] * self.replicas
+            self._running_by_replica = [0] * self.replicas
+            self._completed_by_replica = [0] * self.replicas
+            for index in range(self.workers * self.replicas):
+                thread = threading.Thread(
+                    target=self._worker, args=(index,),
+                    name=f'diarization-worker-{index}', daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            if self.prefetch:
+                self._preparer = ThreadPoolExecutor(max_workers=self.prefetch, thread_name_prefix='job-prepare')
+        if self.replicas > 1:
+            print(f"✓ Job queue started: {self.replicas} replica(s) x {self.workers} worker(s), "
+                  f"queue size {self.max_queue_size}")
+        else:
+            print(f"✓ Job queue started: {self.workers} worker(s), queue size {self.max_queue_size}")
+
+    def submit(self, payload, filename=None, accept=None):
+        """
+        Постановка задачи в очередь, при переполнении - QueueFullError
+
+        accept() вызывается, только если задача принята, до того как её
+        увидят воркеры (например, дописывание аудио в сессию: отклонённая
+        порция не должна остаться в записи). Исключение из accept()
+        отменяет постановку.
+        """
+        self.start()
+        self._purge_expired()
+
+        job = Job(payload, filename=filename)
+        loads = [self._external_load(replica) for replica in range(self.replicas)]
+        with self._lock:
+            if sum(self._queued) >= self.max_queue_size:
+                self._rejected += 1
+                rejected = True
+            else:
+                if accept is not None:
+                    accept()
+                rejected = False
+                job.replica = min(range(self.replicas), key=lambda replica: (
+                    (self._queued[replica] + self._running_by_replica[replica]) / self.workers + loads[replica]
+                ))
+                self._queued[job.replica] += 1
+                self._jobs[job.id] = job
+                if self.prefetch:
+                    self._unprepared.append(job)
+                    self._fill_prefetch()
+        if rejected:
+            raise QueueFullError(self.retry_after())
+        self._queues[job.replica].put(job)
+        return job
+
+    def complete(self, result, filename=None):
+        """Регистрация уже готового результата (например, из кэша) как завершённой задачи"""
+        self._purge_expired()
+
+        job = Job(None, filename=filename)
+        job.started_at = job.finished_at = job.created_at
+        job.status = JOB_DONE
+        job.result = result
+        job.done_event.set()
+        with self._lock:
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        self._purge_expired()
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Отмена задачи в очереди или удаление завершённой
+
+        Возвращает задачу или None, если её нет. Выполняющуюся задачу
+        прервать нельзя - она возвращается со статусом running.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+
+            cancelled = job.status == JOB_QUEUED
+            if cancelled:
+                if job.prepared is not None:
+                    job.prepared.cancel()
+                job.status = JOB_CANCELLED
+                job.finished_at = time.time()
+                job.done_event.set()
+                # Место в очереди и в буфере подготовки освобождается сразу,
+                # воркер потом только пропустит задачу
+                self._queued[job.replica] -= 1
+                self._take(job)
+            elif job.finished:
+                del self._jobs[job_id]
+
+        if cancelled and self.discard and job.payload is not None:
+            if job.prepared is not None and not job.prepared.cancelled():
+                # Подготовка уже идёт: payload освобождается после её окончания
+                job.prepared.add_done_callback(lambda _: self._discard(job))
+            else:
+                self._discard(job)
+        return job
+
+    def wait(self, job, timeout=None):
+        """Ожидание завершения задачи"""
+        return job.done_event.wait(timeout)
+
+    def forget(self, job):
+        """Удаление задачи из реестра (для синхронных запросов)"""
+        with self._lock:
+            self._jobs.pop(job.id, None)
+
+    def retry_after(self):
+        """Оценка в секундах, через сколько в очереди освободится место"""
+        avg = self._avg_processing_time or 10.0
+        workers = self.workers * (self.replicas if isinstance(self.replicas, int) else 1)
+        return max(1, int(math.ceil(avg * (sum(self._queued) + 1) / workers)))
+
+    def _external_load(self, replica):
+        if self.replica_load is None:
+            return 0.0
+        try:
+            return float(self.replica_load(replica))
+        except Exception:
+            return 0.0
+
+    def replica_stats(self):
+        """Загрузка каждой реплики"""
+        loads = [self._external_load(replica) for replica in range(len(self._queues))]
+        with self._lock:
+            return [
+                {
+                    'replica': replica,
+                    'queued': self._queued[replica],
+                    'running': self._running_by_replica[replica],
+                    'completed': self._completed_by_replica[replica],
+                    'load': round(loads[replica], 3),
+                }
+                for replica in range(len(self._queues))
+            ]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers * len(self._queues) if self._queues else self.workers,
+                'replicas': len(self._queues) or None,
+                'queue_size': self.max_queue_size,
+                'queued': sum(self._queued),
+                'running': self._running,
+                'completed': self._completed,
+                'failed': self._failed,
+                'rejected': self._rejected,
+                'prefetched': self._prefetched,
+                'avg_processing_time_seconds': round(self._avg_processing_time, 2)
+                if self._avg_processing_time is not None else None,
+            }
+
+    def _fill_prefetch(self):
+        """Запуск подготовки следующих задач в очереди (вызывается под self._lock)"""
+        while self._prefetched < self.prefetch and self._unprepared:
+            job = self._unprepared.popleft()
+            if job.status != JOB_QUEUED:
+                continue
+            job.prepared = self._preparer.submit(self.prepare, job.payload)
+            self._prefetched += 1
+
+    def _take(self, job):
+        """Задача взята воркером: её место в буфере подготовки освобождается (под self._lock)"""
+        if job.prepared is not None:
+            self._prefetched -= 1
+        else:
+            try:
+                self._unprepared.remove(job)
+            except ValueError:
+                pass
+        if self.prefetch:
+            self._fill_prefetch()
+
+    def _discard(self, job):
+        try:
+            self.discard(job.payload)
+        except Exception as e:
+            print(f"⚠ Warning: Could not discard job {job.id}: {e}")
+        job.payload = None
+
+    def _purge_expired(self):
+        if not self.result_ttl:
+            return
+        deadline = time.time() - self.result_ttl
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job.finished and job.finished_at < deadline
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def _worker(self, index):
+        replica = index // self.workers
+        context = None
+        if self.worker_init is not None:
+            try:
+                context = self.worker_init(index)
+            except Exception as e:
+                print(f"✗ Worker {index} initialization failed: {e}")
+                # Воркер всё равно обрабатывает очередь: runner сам решит,
+                # можно ли работать без контекста (например, загрузит модель лениво)
+
+        while True:
+            job = self._queues[replica].get()
+            try:
+                with self._lock:
+                    if job.status != JOB_QUEUED:
+                        # Отменённая задача уже снята со счёта в cancel()
+                        continue
+                    self._queued[replica] -= 1
+                    self._take(job)
+                    job.status = JOB_RUNNING
+                    job.started_at = time.time()
+                    job.worker = index
+                    self._running += 1
+                    self._running_by_replica[replica] += 1
+
+                status = JOB_FAILED
+                try:
+                    if job.prepared is not None:
+                        # Подготовка обычно уже закончена, пока задача ждала в очереди
+                        job.prepared.result()
+                    job.result = self.runner(job.payload, context)
+                    status = JOB_DONE
+                except Exception as e:
+                    print(f"✗ Job {job.id} failed: {e}")
+                    job.error = str(e)
+                finally:
+                    job.payload = None
+                    job.finished_at = time.time()
+                    elapsed = job.finished_at - job.started_at
+                    with self._lock:
+                        # Итоговый статус - под блокировкой и после finished_at:
+                        # _purge_expired сравнивает finished_at завершённых задач
+                        job.status = status
+                        self._running -= 1
+                        self._running_by_replica[replica] -= 1
+                        if status == JOB_DONE:
+                            self._completed += 1
+                            self._completed_by_replica[replica] += 1
+                        else:
+                            self._failed += 1
+                        if self._avg_processing_time is None:
+                            self._avg_processing_time = elapsed
+                        else:
+                            self._avg_processing_time = 0.8 * self._avg_processing_time + 0.2 * elapsed
+                    job.done_event.set()
+            finally:
+                self._queues[replica].task_done()
@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+"""
+Нагрузочное тестирование HTTP-сервиса диаризации и отчёт по SLO
+
+run - генератор нагрузки на запущенный сервис: синтетическое аудио
+нескольких длительностей (смесь задаётся весами) отправляется в /diarize
+с заданной интенсивностью (--rate, запросов в секунду, пуассоновский
+поток) или конкурентностью (--concurrency, замкнутый цикл). Записываются
+пропускная способность, латентность p50/p95/p99, доли ошибок и отказов 429,
+а также RSS сервера во времени (из /metrics или /proc/<pid> при --pid).
+Результат сохраняется в JSON.
+
+В режиме --rate латентность считается от запланированного момента
+отправки: если сервис не успевает и запросы копятся у клиента, ожидание
+входит в латентность (без coordinated omission).
+
+compare - сравнение двух прогонов: таблица метрик с изменениями и пороги
+регрессии; при превышении любого порога скрипт завершается с кодом 1,
+поэтому сравнение можно ставить в проверку перед выкладкой.
+
+Пример:
+    python loadtest.py run --concurrency 8 --duration 120 --mix 30:0.6,120:0.3,600:0.1 --output before.json
+    python loadtest.py run --rate 2 --duration 300 --pid 12345 --output after.json
+    python loadtest.py compare before.json after.json --max-latency-increase 10
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from benchmark import synthetic_speech
+
+from dotenv import load_dotenv
+load_dotenv()
+
+SAMPLE_RATE = 16000
+DEFAULT_MIX = '30:0.6,120:0.3,600:0.1'
+
+
+def parse_mix(text):
+    """'30:0.6,120:0.4' -> [(30.0, 0.6), (120.0, 0.4)] (веса нормируются)"""
+    mix = []
+    try:
+        for part in text.split(','):
+            duration, _, weight = part.partition(':')
+            mix.append((float(duration), float(weight or 1.0)))
+    except ValueError:
+        mix = []
+    if not mix or any(d <= 0 or w < 0 for d, w in mix) or not sum(w for _, w in mix):
+        raise ValueError(f"Invalid mix '{text}', expected duration:weight pairs, e.g. {DEFAULT_MIX}")
+    total = sum(w for _, w in mix)
+    return [(d, w / total) for d, w in mix]
+
+
+def synthetic_wav(duration, num_speakers=2, seed=0):
+    """
+    WAV (16 кГц, 16 бит) с чередующимися "спикерами" (benchmark.synthetic_speech)
+
+    Реплики разделены короткими паузами, без перекрытий.
+    """
+    waveform, _ = synthetic_speech(duration, num_speakers, np.random.default_rng(seed),
+                                   sample_rate=SAMPLE_RATE, gap=(0.1, 1.5))
+    pcm = (np.clip(waveform, -1.0, 1.0) * 32767).astype('<i2')
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+def unique_copy(data, rng):
+    """Копия WAV с изменёнными последними отсчётами: у каждого запроса свой хэш (мимо кэша результатов)"""
+    data = bytearray(data)
+    data[-8:] = rng.integers(-64, 64, size=4).astype('<i2').tobytes()
+    return bytes(data)
+
+
+def percentile(values, q):
+    return round(float(np.percentile(values, q)), 3) if len(values) else None
+
+
+def server_rss_bytes(session, url, pid=None):
+    """RSS сервиса: /proc/<pid> локального процесса или метрика process_resident_memory_bytes"""
+    if pid:
+        from metrics import process_rss_bytes
+        return process_rss_bytes(pid)
+    try:
+        text = session.get(f'{url}/metrics', timeout=5).text
+    except requests.RequestException:
+        return None
+    for line in text.splitlines():
+        if line.startswith('process_resident_memory_bytes '):
+            return float(line.split()[1])
+    return None
+
+
+class LoadGenerator:
+    """Отправка запросов и запись результатов"""
+
+    def __init__(self, args):
+        self.args = args
+        self.url = args.url.rstrip('/')
+        self.headers = {'Authorization': f'Bearer {args.token}'}
+        self.mix = parse_mix(args.mix)
+        self.rng = np.random.default_rng(args.seed)
+        self.rng_lock = threading.Lock()
+        self.records = []
+        self.records_lock = threading.Lock()
+        self.rss = []
+        self.stop_event = threading.Event()
+        self.local = threading.local()
+
+        print(f"🎵 Generating synthetic audio: {', '.join(f'{d:g}s' for d, _ in self.mix)}")
+        self.audio = {duration: synthetic_wav(duration, args.speakers, seed=args.seed + i)
+                      for i, (duration, _) in enumerate(self.mix)}
+
+    def session(self):
+        # requests.Session не потокобезопасен - по сессии на поток
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def pick_audio(self):
+        with self.rng_lock:
+            index = self.rng.choice(len(self.mix), p=[w for _, w in self.mix])
+            duration = self.mix[index][0]
+            data = self.audio[duration] if self.args.allow_cache else unique_copy(self.audio[duration], self.rng)
+        return duration, data
+
+    def send(self, scheduled_at):
+        duration, data = self.pick_audio()
+        record = {'t': round(scheduled_at - self.started, 3), 'audio_seconds': duration,
+                  'status': None, 'latency': None, 'error': None}
+        try:
+            response = self.session().post(
+                f'{self.url}{self.args.endpoint}', headers=self.headers,
+                files={'file': ('loadtest.wav', data, 'audio/wav')}, timeout=self.args.timeout
+            )
+            # Потоковый ответ считается завершённым после чтения тела целиком
+            response.content
+            record['status'] = response.status_code
+            if response.status_code >= 400 and response.status_code != 429:
+                record['error'] = response.text[:200]
+        except requests.RequestException as e:
+            record['error'] = str(e)[:200]
+        record['latency'] = round(time.perf_counter() - scheduled_at, 4)
+        with self.records_lock:
+            self.records.append(record)
+
+    def sample_rss(self):
+        session = requests.Session()
+        while not self.stop_event.is_set():
+            rss = server_rss_bytes(session, self.url, self.args.pid)
+            if rss is not None:
+                self.rss.append((round(time.perf_counter() - self.started, 2), round(rss / 1024 / 1024, 1)))
+            self.stop_event.wait(self.args.sample_interval)
+
+    def due(self, sent):
+        if self.args.requests and sent >= self.args.requests:
+            return False
+        return time.perf_counter() - self.started < self.args.duration
+
+    def run_closed_loop(self):
+        """--concurrency: каждый поток отправляет следующий запрос сразу после ответа"""
+        counter = {'sent': 0}
+        counter_lock = threading.Lock()
+
+        def client():
+            while True:
+                with counter_lock:
+                    if not self.due(counter['sent']):
+                        return
+                    counter['sent'] += 1
+                self.send(time.perf_counter())
+
+        threads = [threading.Thread(target=client, daemon=True) for _ in range(self.args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_open_loop(self):
+        """--rate: пуассоновский поток запросов независимо от скорости ответов"""
+        rng = np.random.default_rng(self.args.seed + 1000)
+        sent = 0
+        next_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.max_in_flight) as executor:
+            while self.due(sent):
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.send, next_at)
+                sent += 1
+                next_at += rng.exponential(1.0 / self.args.rate)
+
+    def run(self):
+        self.started = time.perf_counter()
+        sampler = threading.Thread(target=self.sample_rss, daemon=True)
+        sampler.start()
+
+        mode = f'rate {self.args.rate}/s' if self.args.rate else f'concurrency {self.args.concurrency}'
+        print(f"🚀 Load test: {self.url}{self.args.endpoint}, {mode}, "
+              f"{self.args.duration:g}s{f' / {self.args.requests} requests' if self.args.requests else ''}")
+        if self.args.rate:
+            self.run_open_loop()
+        else:
+            self.run_closed_loop()
+        elapsed = time.perf_counter() - self.started
+
+        self.stop_event.set()
+        sampler.join()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        records = sorted(self.records, key=lambda r: r['t'])
+        measured = [r for r in records if r['t'] >= self.args.warmup]
+        ok = [r for r in measured if r['status'] is not None and r['status'] < 400]
+        rejected = [r for r in measured if r['status'] == 429]
+        failed = [r for r in measured if r['error'] is not None]
+        window = max(elapsed - self.args.warmup, 1e-6)
+
+        def latency_stats(items):
+            latencies = [r['latency'] for r in items]
+            return {
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'max': round(max(latencies), 3) if latencies else None,
+            }
+
+        by_duration = {}
+        for duration, _ in self.mix:
+            items = [r for r in ok if r['audio_seconds'] == duration]
+            by_duration[f'{duration:g}'] = {'requests': len(items), **latency_stats(items)}
+
+        rss = [value for _, value in self.rss]
+        summary = {
+            'requests': len(measured),
+            'ok': len(ok),
+            'elapsed_seconds': round(elapsed, 2),
+            'throughput_rps': round(len(ok) / window, 3),
+            'audio_seconds_per_second': round(sum(r['audio_seconds'] for r in ok) / window, 2),
+            'latency_seconds': latency_stats(ok),
+            'latency_by_audio_seconds': by_duration,
+            'error_rate': round(len(failed) / len(measured), 4) if measured else None,
+            'rejected_rate': round(len(rejected) / len(measured), 4) if measured else None,
+            'rss_mb': {
+                'start': rss[0] if rss else None,
+                'peak': max(rss) if rss else None,
+                'end': rss[-1] if rss else None,
+            },
+        }
+        return {
+            'label': self.args.label,
+            'config': {
+                'url': self.url,
+                'endpoint': self.args.endpoint,
+                'rate': self.args.rate,
+                'concurrency': None if self.args.rate else self.args.concurrency,
+                'duration': self.args.duration,
+                'requests': self.args.requests,
+                'mix': self.args.mix,
+                'warmup': self.args.warmup,
+                'allow_cache': self.args.allow_cache,
+            },
+            'summary': summary,
+            'rss_series': self.rss,
+            'records': records,
+        }
+
+
+def print_summary(report):
+    summary = report['summary']
+    latency = summary['latency_seconds']
+    print(f"\n{'='*60}")
+    print(f"Load test: {report['label']}")
+    print(f"{'='*60}")
+    print(f"Requests: {summary['requests']} ({summary['ok']} ok) in {summary['elapsed_seconds']}s")
+    print(f"Throughput: {summary['throughput_rps']} req/s, {summary['audio_seconds_per_second']} audio s/s")
+    print(f"Latency p50/p95/p99: {latency['p50']} / {latency['p95']} / {latency['p99']} s")
+    for duration, stats in summary['latency_by_audio_seconds'].items():
+        print(f"  {duration}s audio: {stats['requests']} requests, p50 {stats['p50']} s, p95 {stats['p95']} s")
+    print(f"Errors: {summary['error_rate']}, rejected (429): {summary['rejected_rate']}")
+    rss = summary['rss_mb']
+    print(f"Server RSS: {rss['start']} -> peak {rss['peak']} -> {rss['end']} MB")
+    print(f"{'='*60}")
+
+
+# Метрики сравнения: (путь в summary, заголовок, что лучше)
+COMPARED_METRICS = (
+    (('throughput_rps',), 'Throughput, req/s', 'higher'),
+    (('audio_seconds_per_second',), 'Audio s/s', 'higher'),
+    (('latency_seconds', 'p50'), 'Latency p50, s', 'lower'),
+    (('latency_seconds', 'p95'), 'Latency p95, s', 'lower'),
+    (('latency_seconds', 'p99'), 'Latency p99, s', 'lower'),
+    (('error_rate',), 'Error rate', 'lower'),
+    (('rejected_rate',), '429 rate', 'lower'),
+    (('rss_mb', 'peak'), 'Peak RSS, MB', 'lower'),
+)
+
+
+def summary_value(summary, path):
+    for key in path:
+        summary = summary.get(key) if isinstance(summary, dict) else None
+    return summary
+
+
+def relative_change(baseline, candidate):
+    if baseline is None or candidate is None or not baseline:
+        return None
+    return round(100.0 * (candidate - baseline) / baseline, 1)
+
+
+def compare_reports(baseline, candidate, thresholds):
+    """Таблица изменений и проверка порогов регрессии"""
+    rows = []
+    for path, title, better in COMPARED_METRICS:
+        base = summary_value(baseline['summary'], path)
+        new = summary_value(candidate['summary'], path)
+        rows.append({'metric': '.'.join(path), 'title': title, 'baseline': base, 'candidate': new,
+                     'change_percent': relative_change(base, new), 'better': better})
+
+    def change(metric):
+        return next(row['change_percent'] for row in rows if row['metric'] == metric)
+
+    def increase(metric):
+        base = summary_value(baseline['summary'], metric.split('.'))
+        new = summary_value(candidate['summary'], metric.split('.'))
+        return None if base is None or new is None else 100.0 * (new - base)
+
+    checks = [
+        ('latency p95 increase, %', change('latency_seconds.p95'), thresholds['latency']),
+        ('latency p99 increase, %', change('latency_seconds.p99'), thresholds['latency']),
+        ('throughput decrease, %', None if change('throughput_rps') is None else -change('throughput_rps'),
+         thresholds['throughput']),
+        ('error rate increase, pp', increase('error_rate'), thresholds['errors']),
+        ('429 rate increase, pp', increase('rejected_rate'), thresholds['errors']),
+        ('peak RSS increase, %', change('rss_mb.peak'), thresholds['rss']),
+    ]
+    gates = [{'check': name, 'value': None if value is None else round(value, 2), 'limit': limit,
+              'passed': value is None or value <= limit} for name, value, limit in checks]
+    # Сравнивать имеет смысл прогоны с одинаковой нагрузкой
+    differences = sorted(
+        key for key in set(baseline['config']) | set(candidate['config'])
+        if key != 'url' and baseline['config'].get(key) != candidate['config'].get(key)
+    )
+    return {
+        'baseline': baseline['label'],
+        'candidate': candidate['label'],
+        'config_differences': differences,
+        'metrics': rows,
+        'gates': gates,
+        'passed': all(gate['passed'] for gate in gates),
+    }
+
+
+def print_comparison(comparison):
+    print(f"\n{'='*72}")
+    print(f"Comparison: {comparison['baseline']} -> {comparison['candidate']}")
+    print(f"{'='*72}")
+    if comparison['config_differences']:
+        print(f"⚠ Runs use different load settings: {', '.join(comparison['config_differences'])}")
+    print(f"{'Metric':<22}{'Baseline':>14}{'Candidate':>14}{'Change':>12}")
+    for row in comparison['metrics']:
+        change = '' if row['change_percent'] is None else f"{row['change_percent']:+.1f}%"
+        fmt = lambda v: '-' if v is None else f'{v:g}'
+        print(f"{row['title']:<22}{fmt(row['baseline']):>14}{fmt(row['candidate']):>14}{change:>12}")
+    print(f"{'-'*72}")
+    for gate in comparison['gates']:
+        mark = '✓' if gate['passed'] else '✗'
+        value = 'n/a' if gate['value'] is None else gate['value']
+        print(f"{mark} {gate['check']}: {value} (limit {gate['limit']})")
+    print(f"{'='*72}")
+    print('✓ No regressions' if comparison['passed'] else '✗ Regression detected')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test the diarization service and compare runs')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='Generate load against a running service')
+    run.add_argument('--url', default=os.getenv('DIARIZATION_URL', 'http://localhost:5000'))
+    run.add_argument('--token', default=os.getenv('DIARIZATION_TOKEN', 'your-secret-token-here'))
+    run.add_argument('--endpoint', default='/diarize', choices=('/diarize', '/diarize/stream'))
+    load = run.add_mutually_exclusive_group()
+    load.add_argument('--concurrency', type=int, default=4, help='Concurrent clients (closed loop, default: 4)')
+    load.add_argument('--rate', type=float, default=None, help='Requests per second (open loop, Poisson)')
+    run.add_argument('--duration', type=float, default=60.0, help='Test duration, seconds (default: 60)')
+    run.add_argument('--requests', type=int, default=None, help='Stop after this many requests')
+    run.add_argument('--mix', default=DEFAULT_MIX,
+                     help=f'Audio durations and weights, seconds:weight (default: {DEFAULT_MIX})')
+    run.add_argument('--speakers', type=int, default=2, help='Speakers in synthetic audio (default: 2)')
+    run.add_argument('--warmup', type=float, default=0.0,
+                     help='Exclude requests scheduled in the first N seconds from the summary')
+    run.add_argument('--allow-cache', action='store_true',
+                     help='Send identical files (result cache hits); by default every request is unique')
+    run.add_argument('--max-in-flight', type=int, default=256, help='Client threads in --rate mode')
+    run.add_argument('--timeout', type=float, default=3600.0, help='Request timeout, seconds')
+    run.add_argument('--pid', type=int, default=None,
+                     help='Sample RSS of this local process instead of /metrics')
+    run.add_argument('--sample-interval', type=float, default=1.0, help='RSS sampling interval, seconds')
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--label', default=None, help='Run label for reports (default: output file name)')
+    run.add_argument('--output', default='loadtest_report.json', help='JSON report path')
+
+    compare = commands.add_parser('compare', help='Compare two runs and check regression thresholds')
+    compare.add_argument('baseline', help='Baseline run report (JSON)')
+    compare.add_argument('candidate', help='Candidate run report (JSON)')
+    compare.add_argument('--max-latency-increase', type=float, default=10.0,
+                         help='Allowed p95/p99 latency increase, %% (default: 10)')
+    compare.add_argument('--max-throughput-decrease', type=float, default=10.0,
+                         help='Allowed throughput decrease, %% (default: 10)')
+    compare.add_argument('--max-error-increase', type=float, default=1.0,
+                         help='Allowed error/429 rate increase, percentage points (default: 1)')
+    compare.add_argument('--max-rss-increase', type=float, default=20.0,
+                         help='Allowed peak RSS increase, %% (default: 20)')
+    compare.add_argument('--output', default=None, help='Save the comparison as JSON')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.command == 'run':
+        try:
+            parse_mix(args.mix)
+        except ValueError as e:
+            print(f"✗ {e}")
+            sys.exit(2)
+        if args.rate is not None and args.rate <= 0:
+            print("✗ --rate must be positive")
+            sys.exit(2)
+        args.label = args.label or os.path.splitext(os.path.basename(args.output))[0]
+
+        report = LoadGenerator(args).run()
+        print_summary(report)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"✓ Report saved: {args.output}")
+        return
+
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.candidate, 'r', encoding='utf-8') as f:
+        candidate = json.load(f)
+    comparison = compare_reports(baseline, candidate, {
+        'latency': args.max_latency_increase,
+        'throughput': args.max_throughput_decrease,
+        'errors': args.max_error_increase,
+        'rss': args.max_rss_increase,
+    })
+    print_comparison(comparison)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(comparison, f, indent=2)
+    sys.exit(0 if comparison['passed'] else 1)
+
+
+if __name__ == "__main__":
+    main()
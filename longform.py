@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Диаризация длинных записей по перекрывающимся окнам с ограниченной памятью
+
+Аудио читается с диска окнами фиксированной длины, каждое окно обрабатывается
+pipeline целиком (сегментация + эмбеддинги + кластеризация внутри окна), а
+локальные спикеры окна сопоставляются с глобальными по центроидам эмбеддингов
+с тем же порогом, что задан для кластеризации в config.yaml.
+В памяти одновременно находится только одно окно аудио.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+import soundfile as sf
+
+from audio_io import SAMPLE_RATE, prepare_waveform
+
+
+class StreamCancelled(Exception):
+    """Клиент прервал получение результатов"""
+
+
+def open_audio(path):
+    """
+    Открытие файла для чтения окнами
+
+    Возвращает (SoundFile, путь к временному файлу или None). Форматы, которые
+    libsndfile не читает (m4a, wma), предварительно конвертируются FFmpeg в WAV.
+    """
+    try:
+        return sf.SoundFile(path), None
+    except Exception:
+        pass
+
+    if shutil.which('ffmpeg') is None:
+        raise Exception('Audio format is not supported without FFmpeg')
+
+    fd, wav_path = tempfile.mkstemp(suffix='.wav')
+    os.close(fd)
+    try:
+        subprocess.run(
+            ['ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', path,
+             '-ac', '1', '-ar', str(SAMPLE_RATE), wav_path],
+            check=True, capture_output=True
+        )
+        return sf.SoundFile(wav_path), wav_path
+    except subprocess.CalledProcessError as e:
+        os.unlink(wav_path)
+        raise Exception(f"FFmpeg could not decode audio: {e.stderr.decode(errors='ignore').strip()}")
+
+
+def read_window(audio, start, duration):
+    """Чтение окна [start, start + duration) секунд как моно-тензора 16 кГц"""
+    sr = audio.samplerate
+    audio.seek(int(round(start * sr)))
+    data = audio.read(int(round(duration * sr)), dtype='float32', always_2d=True)
+    return prepare_waveform(data, sr)
+
+
+def segment_event(segment):
+    return {'type': 'segment', **segment}
+
+
+class SpeakerLinker:
+    """
+    Сопоставление локальных спикеров окна с глобальными
+
+    Центроиды нормализуются, расстояние считается как в AgglomerativeClustering
+    pyannote для метрики cosine (евклидово между единичными векторами), и
+    сравнивается с порогом кластеризации из конфигурации pipeline.
+
+    max_speakers ограничивает число глобальных спикеров: когда лимит
+    достигнут, новый локальный спикер присоединяется к ближайшему
+    глобальному, даже если расстояние больше порога.
+    """
+
+    def __init__(self, threshold, max_speakers=None):
+        self.threshold = threshold
+        self.max_speakers = max_speakers
+        self.centroids = []
+        self.weights = []
+
+    def label(self, index):
+        return f"SPEAKER_{index:02d}"
+
+    def link(self, local_centroids, durations):
+        """Возвращает для каждого локального спикера индекс глобального"""
+        mapping = [None] * len(local_centroids)
+        used = set()
+        norms = np.linalg.norm(local_centroids, axis=1) if len(local_centroids) else np.zeros(0)
+
+        if self.centroids and len(local_centroids):
+            known = np.vstack(self.centroids)
+            known_norms = np.linalg.norm(known, axis=1)
+            known = known / np.maximum(known_norms[:, None], 1e-12)
+            local = local_centroids / np.maximum(norms[:, None], 1e-12)
+            distances = np.linalg.norm(local[:, None, :] - known[None, :, :], axis=2)
+            # Спикеры без эмбеддинга (нулевой центроид) не сопоставляются
+            distances[norms == 0] = np.inf
+            distances[:, known_norms == 0] = np.inf
+
+            # Жадное сопоставление по возрастанию расстояния: один глобальный
+            # спикер не может соответствовать двум локальным в одном окне
+            for flat in np.argsort(distances, axis=None):
+                i, j = np.unravel_index(flat, distances.shape)
+                if distances[i, j] > self.threshold:
+                    break
+                if mapping[i] is not None or j in used:
+                    continue
+                mapping[i] = int(j)
+                used.add(j)
+
+        # При ограничении числа спикеров новые глобальные спикеры создаются
+        # для самых длинных по речи локальных, остальные присоединяются
+        order = range(len(local_centroids))
+        if self.max_speakers is not None:
+            order = sorted(order, key=lambda i: -float(durations[i]))
+        for i in order:
+            centroid = local_centroids[i]
+            weight = max(float(durations[i]), 1e-3)
+            if mapping[i] is None and self.max_speakers is not None and len(self.centroids) >= self.max_speakers:
+                mapping[i] = self._closest(centroid, norms[i], used)
+            if mapping[i] is None:
+                mapping[i] = len(self.centroids)
+                self.centroids.append(np.asarray(centroid, dtype=np.float64) * weight)
+                self.weights.append(weight)
+            elif norms[i] > 0:
+                # Центроид глобального спикера - среднее, взвешенное по длительности речи
+                self.centroids[mapping[i]] = self.centroids[mapping[i]] + centroid * weight
+                self.weights[mapping[i]] += weight
+            used.add(mapping[i])
+
+        return mapping
+
+    def _closest(self, centroid, norm, used):
+        """
+        Ближайший глобальный спикер без учёта порога
+
+        Предпочитаются спикеры, ещё не занятые в этом окне; без эмбеддинга -
+        спикер с наибольшей длительностью речи.
+        """
+        candidates = [j for j in range(len(self.centroids)) if j not in used] or list(range(len(self.centroids)))
+        known = np.vstack([self.centroids[j] for j in candidates])
+        known_norms = np.linalg.norm(known, axis=1)
+        if norm == 0 or not known_norms.any():
+            return max(candidates, key=lambda j: self.weights[j])
+        distances = np.linalg.norm(centroid / norm - known / np.maximum(known_norms[:, None], 1e-12), axis=1)
+        distances[known_norms == 0] = np.inf
+        return candidates[int(np.argmin(distances))]
+
+
+class LongFormDiarizer:
+    """Оконная диаризация длинных записей с потоковой выдачей сегментов"""
+
+    def __init__(self, pipeline, window=300.0, overlap=30.0, threshold=None):
+        if overlap >= window:
+            raise ValueError('Window overlap must be shorter than the window')
+        self.pipeline = pipeline
+        self.window = float(window)
+        self.overlap = float(overlap)
+        if threshold is None:
+            threshold = pipeline.parameters(instantiated=True).get('clustering', {}).get('threshold', 0.7)
+        self.threshold = threshold
+
+    def iter_events(self, path, cancelled=None, num_speakers=None, max_speakers=None, **pipeline_kwargs):
+        """
+        Генератор событий обработки
+
+        Выдаёт словари {'type': 'segment' | 'progress', ...} по мере готовности окон.
+        cancelled() - необязательная функция, возвращающая True при отмене.
+
+        num_speakers и max_speakers относятся ко всей записи: окна получают
+        только верхнюю границу (в окне может говорить часть спикеров), а
+        число глобальных спикеров ограничивает SpeakerLinker. Нижнюю границу
+        (min_speakers, ровно num_speakers) соблюсти нельзя: сегменты уже
+        отданы клиенту к моменту, когда известна вся запись.
+        """
+        limit = num_speakers or max_speakers
+        if limit:
+            pipeline_kwargs['max_speakers'] = limit
+        audio, wav_path = open_audio(path)
+        try:
+            duration = audio.frames / audio.samplerate
+            step = self.window - self.overlap
+            linker = SpeakerLinker(self.threshold, max_speakers=limit)
+            # pending - сегменты на правой границе окна, которые может продолжить
+            # следующее окно; ready - законченные сегменты, ждущие выдачи
+            pending = {}
+            ready = []
+
+            start = 0.0
+            while start < duration:
+                if cancelled is not None and cancelled():
+                    raise StreamCancelled()
+
+                end = min(start + self.window, duration)
+                is_last = end >= duration
+                waveform = read_window(audio, start, end - start)
+
+                # Каждое окно "владеет" серединой своего перекрытия с соседями
+                owned_start = start + self.overlap / 2 if start > 0 else 0.0
+                owned_end = end if is_last else end - self.overlap / 2
+
+                diarization, centroids = self.pipeline(
+                    {'waveform': waveform, 'sample_rate': SAMPLE_RATE},
+                    return_embeddings=True,
+                    **pipeline_kwargs
+                )
+                del waveform
+
+                labels = diarization.labels()
+                durations = [diarization.label_duration(label) for label in labels]
+                if centroids is None:
+                    centroids = np.zeros((len(labels), self.pipeline._embedding.dimension))
+                mapping = linker.link(centroids, durations)
+                global_labels = {label: linker.label(mapping[i]) for i, label in enumerate(labels)}
+
+                # Сегменты, касающиеся границы с прошлым окном, продолжают отложенные
+                still_pending = {}
+                for turn, _, label in diarization.itertracks(yield_label=True):
+                    seg_start = max(start + turn.start, owned_start)
+                    seg_end = min(start + turn.end, owned_end)
+                    if seg_end <= seg_start:
+                        continue
+
+                    speaker = global_labels[label]
+                    previous = pending.pop(speaker, None)
+                    if previous is not None and abs(previous['end'] - seg_start) < 1e-6:
+                        seg_start = previous['start']
+                    elif previous is not None:
+                        ready.append(previous)
+
+                    segment = {'start': float(seg_start), 'end': float(seg_end), 'speaker': speaker}
+                    if not is_last and abs(seg_end - owned_end) < 1e-6:
+                        still_pending[speaker] = segment
+                    else:
+                        ready.append(segment)
+
+                ready.extend(pending.values())
+                pending = still_pending
+
+                # Выдача по порядку start: сегменты, начавшиеся после
+                # ещё не законченного (pending), ждут его окончания
+                ready.sort(key=lambda segment: (segment['start'], segment['end'], segment['speaker']))
+                barrier = min((segment['start'] for segment in pending.values()), default=np.inf)
+                count = next((i for i, segment in enumerate(ready) if segment['start'] >= barrier), len(ready))
+                for segment in ready[:count]:
+                    yield segment_event(segment)
+                del ready[:count]
+
+                yield {
+                    'type': 'progress',
+                    'processed_seconds': round(owned_end, 2),
+                    'duration_seconds': round(duration, 2),
+                    'speakers': len(linker.centroids),
+                }
+
+                if is_last:
+                    break
+                start += step
+
+            for segment in sorted([*ready, *pending.values()],
+                                  key=lambda segment: (segment['start'], segment['end'], segment['speaker'])):
+                yield segment_event(segment)
+
+        finally:
+            audio.close()
+            if wav_path and os.path.exists(wav_path):
+                os.unlink(wav_path)
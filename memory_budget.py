@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Допуск задач по памяти устройства (admission control)
+
+Раньше перед каждой задачей вызывался torch.cuda.empty_cache(): это
+сбрасывало пул кэширующего аллокатора (следующие выделения памяти снова
+шли через cudaMalloc), и при этом ничто не мешало двум длинным файлам
+одновременно выйти за пределы памяти GPU.
+
+DeviceMemory заменяет это бюджетом на устройство:
+- пиковая память задачи оценивается по длительности аудио и размерам
+  батчей pipeline (segmentation_batch_size, embedding_batch_size);
+- задача допускается к pipeline, только когда оценка помещается в
+  остаток бюджета; остальные ждут в порядке очереди (FIFO). Задача
+  больше всего бюджета выполняется одна;
+- при нехватке памяти (OOM) embedding_batch_size уменьшается вдвое, кэш
+  аллокатора освобождается, и вызов повторяется. Уменьшенный размер
+  запоминается для устройства и применяется к следующим задачам.
+
+Бюджет на GPU - доля памяти устройства за вычетом весов моделей. На CPU
+бюджет не ограничен, но его можно задать явно (DIARIZATION_MEMORY_BUDGET_MB):
+так допуск задач проверяется без GPU.
+
+Коэффициенты оценки - грубые значения для pyannote 3.1 (сегментация
+PyanNet и WeSpeaker ResNet34 на 10-секундных окнах); их можно уточнить
+по наблюдаемому пику памяти.
+"""
+
+import collections
+import threading
+import time
+
+MB = 1024 * 1024
+
+# Память на секунду аудио (waveform на устройстве, выходы сегментации)
+PER_AUDIO_SECOND_BYTES = 0.1 * MB
+# Память на окно в батче сегментации и на (окно, спикер) в батче эмбеддингов
+PER_SEGMENTATION_ITEM_BYTES = 8 * MB
+PER_EMBEDDING_ITEM_BYTES = 48 * MB
+
+
+def is_oom_error(exception):
+    """Нехватка памяти устройства (pyannote превращает OOM сегментации в MemoryError)"""
+    if isinstance(exception, MemoryError):
+        return True
+    try:
+        import torch
+        if isinstance(exception, torch.cuda.OutOfMemoryError):
+            return True
+    except (ImportError, AttributeError):
+        pass
+    return isinstance(exception, RuntimeError) and 'out of memory' in str(exception).lower()
+
+
+def free_device_cache(device):
+    """Освобождение кэша аллокатора - только после OOM"""
+    if getattr(device, 'type', None) == 'cuda':
+        import torch
+        torch.cuda.empty_cache()
+
+
+class DeviceMemory:
+    """Бюджет памяти одного устройства и адаптация размера батча эмбеддингов"""
+
+    def __init__(self, device, budget_bytes=None, per_audio_second=PER_AUDIO_SECOND_BYTES,
+                 per_segmentation_item=PER_SEGMENTATION_ITEM_BYTES,
+                 per_embedding_item=PER_EMBEDDING_ITEM_BYTES, max_retries=3):
+        self.device = device
+        self.budget = int(budget_bytes) if budget_bytes else None
+        self.per_audio_second = per_audio_second
+        self.per_segmentation_item = per_segmentation_item
+        self.per_embedding_item = per_embedding_item
+        self.max_retries = max_retries
+
+        self.embedding_batch_cap = None  # после OOM - не больше этого размера
+        self._condition = threading.Condition()
+        self._waiting = collections.deque()
+        self._reserved = 0
+        self._running = 0
+        self.admitted = 0
+        self.waited_seconds = 0.0
+        self.oom_retries = 0
+        self.peak_reserved = 0
+
+    def estimate(self, model, duration):
+        """Оценка пиковой памяти задачи в байтах"""
+        segmentation_batch = getattr(model, 'segmentation_batch_size', 1) or 1
+        embedding_batch = getattr(model, 'embedding_batch_size', 1) or 1
+        return int(duration * self.per_audio_second
+                   + segmentation_batch * self.per_segmentation_item
+                   + embedding_batch * self.per_embedding_item)
+
+    def apply_batch_cap(self, model):
+        if self.embedding_batch_cap is not None and getattr(model, 'embedding_batch_size', 0) > self.embedding_batch_cap:
+            model.embedding_batch_size = self.embedding_batch_cap
+
+    def shrink(self, model):
+        """Уменьшение embedding_batch_size вдвое; False, если меньше некуда"""
+        current = getattr(model, 'embedding_batch_size', 1)
+        if current <= 1:
+            return False
+        smaller = max(1, current // 2)
+        with self._condition:
+            self.embedding_batch_cap = min(self.embedding_batch_cap or smaller, smaller)
+        model.embedding_batch_size = smaller
+        return True
+
+    def acquire(self, nbytes):
+        """Ожидание, пока nbytes не поместятся в бюджет; возвращает зарезервированный объём"""
+        if self.budget is None:
+            with self._condition:
+                self._running += 1
+                self.admitted += 1
+            return 0
+
+        ticket = object()
+        started = time.perf_counter()
+        with self._condition:
+            self._waiting.append(ticket)
+            # Очередь FIFO: маленькие задачи не обходят большую бесконечно;
+            # задача больше всего бюджета допускается, когда устройство свободно
+            while self._waiting[0] is not ticket or (
+                    self._running and self._reserved + nbytes > self.budget):
+                self._condition.wait()
+            self._waiting.popleft()
+            self._reserved += nbytes
+            self._running += 1
+            self.admitted += 1
+            self.peak_reserved = max(self.peak_reserved, self._reserved)
+            self.waited_seconds += time.perf_counter() - started
+            # Следующая в очереди может тоже поместиться
+            self._condition.notify_all()
+        return nbytes
+
+    def release(self, nbytes):
+        with self._condition:
+            self._reserved -= nbytes
+            self._running -= 1
+            self._condition.notify_all()
+
+    def run(self, model, duration, fn, retry=True):
+        """
+        Выполнение fn() с допуском по памяти и повтором после OOM
+
+        retry=False - только допуск (для вызовов, которые нельзя повторить,
+        например потоковая выдача длинных записей).
+        """
+        self.apply_batch_cap(model)
+        reserved = self.acquire(self.estimate(model, duration))
+        try:
+            attempt = 0
+            while True:
+                try:
+                    return fn()
+                except Exception as e:
+                    if not retry or not is_oom_error(e) or attempt >= self.max_retries or not self.shrink(model):
+                        raise
+                    attempt += 1
+                    self.oom_retries += 1
+                    free_device_cache(self.device)
+                    print(f"⚠ Out of memory on {self.device}, retrying with "
+                          f"embedding_batch_size={model.embedding_batch_size}")
+        finally:
+            self.release(reserved)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'budget_mb': round(self.budget / MB, 1) if self.budget else None,
+                'reserved_mb': round(self._reserved / MB, 1),
+                'peak_reserved_mb': round(self.peak_reserved / MB, 1),
+                'running': self._running,
+                'waiting': len(self._waiting),
+                'admitted': self.admitted,
+                'waited_seconds': round(self.waited_seconds, 3),
+                'oom_retries': self.oom_retries,
+                'embedding_batch_cap': self.embedding_batch_cap,
+            }
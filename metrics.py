@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Метрики сервиса в текстовом формате Prometheus
+
+Небольшая реализация счётчиков, gauge и гистограмм с метками без внешних
+зависимостей, плюс StageTimer - hook pyannote, который засекает время
+отдельных стадий pipeline (сегментация, эмбеддинги, кластеризация).
+"""
+
+import math
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name}: expected labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """Счётчик; значения можно накапливать или получать функцией collect при сборе"""
+    type_name = 'counter'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self._collect = collect
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self):
+        items = self._collected_items()
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in items]
+
+    def _collected_items(self):
+        if self._collect is not None:
+            collected = self._collect()
+            if not isinstance(collected, dict):
+                collected = {(): collected}
+            return sorted(
+                (key if isinstance(key, tuple) else (key,), float(value))
+                for key, value in collected.items() if value is not None
+            )
+        with self._lock:
+            return sorted(self._values.items())
+
+
+class Gauge(Counter):
+    """Gauge; значение можно задавать явно или функцией collect, вызываемой при сборе"""
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in items:
+            for bound, count in zip(self.buckets, counts):
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                lines.append(f'{self.name}_bucket{labels} {count}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {counts[-1]}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+def process_rss_bytes(pid='self'):
+    """Текущий RSS процесса в байтах (None, если узнать нельзя)"""
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        return psutil.Process(None if pid == 'self' else int(pid)).memory_info().rss
+    except Exception:
+        return None
+
+
+class StageTimer:
+    """
+    Hook pyannote для замера стадий pipeline
+
+    Pipeline вызывает hook(step_name, artifact, file=..., [completed, total])
+    после каждой стадии (а долгие стадии - многократно по ходу работы),
+    поэтому конец стадии - время последнего вызова с её именем.
+    """
+
+    # Стадии SpeakerDiarization.apply() по порядку и их имена в метриках
+    STAGES = (
+        ('segmentation', 'segmentation'),
+        ('speaker_counting', 'speaker_counting'),
+        ('embeddings', 'embeddings'),
+        ('discrete_diarization', 'clustering'),
+    )
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.finished = None
+        self._marks = {}
+
+    def __call__(self, step_name, step_artifact, file=None, total=None, completed=None):
+        self._marks[step_name] = time.perf_counter()
+
+    def stop(self):
+        self.finished = time.perf_counter()
+
+    def durations(self):
+        """Длительность каждой пройденной стадии в секундах"""
+        result = {}
+        previous = self.started
+        for step_name, stage in self.STAGES:
+            if step_name in self._marks:
+                result[stage] = self._marks[step_name] - previous
+                previous = self._marks[step_name]
+        if self.finished is not None:
+            # Построение Annotation и переименование спикеров
+            result['postprocessing'] = self.finished - previous
+        return result
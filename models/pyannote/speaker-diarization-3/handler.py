@@ -21,9 +21,79 @@
 # SOFTWARE.
 
 
+import copy
+from collections import OrderedDict
+
 from pyannote.audio import Pipeline, Audio
 import torch
 
+# supported "parameters": name -> (type, min, max)
+CALL_PARAMETERS = {
+    "num_speakers": (int, 1, 100),
+    "min_speakers": (int, 1, 100),
+    "max_speakers": (int, 1, 100),
+}
+# config.yaml overrides: name -> (type, min, max, (sub-pipeline, parameter))
+CONFIG_PARAMETERS = {
+    "clustering_threshold": (float, 0.0, 2.0, ("clustering", "threshold")),
+    "min_cluster_size": (int, 1, 1000, ("clustering", "min_cluster_size")),
+    "min_duration_off": (float, 0.0, 10.0, ("segmentation", "min_duration_off")),
+}
+
+
+def parse_parameters(parameters):
+    """Validate "parameters" and split them into call kwargs and config.yaml overrides
+
+    Unknown keys and out-of-range values raise ValueError.
+    """
+    if not isinstance(parameters, dict):
+        raise ValueError("parameters must be an object")
+    unknown = sorted(set(parameters) - set(CALL_PARAMETERS) - set(CONFIG_PARAMETERS))
+    if unknown:
+        raise ValueError(f"unknown parameters: {', '.join(unknown)}")
+
+    call_kwargs, overrides = dict(), dict()
+    for name, value in parameters.items():
+        if value is None:
+            continue
+        if name in CALL_PARAMETERS:
+            kind, low, high = CALL_PARAMETERS[name]
+        else:
+            kind, low, high, _ = CONFIG_PARAMETERS[name]
+        try:
+            parsed = kind(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{name} must be {'an integer' if kind is int else 'a number'}")
+        if parsed != parsed or not low <= parsed <= high:
+            raise ValueError(f"{name} must be between {low} and {high}")
+        (call_kwargs if name in CALL_PARAMETERS else overrides)[name] = parsed
+
+    if "num_speakers" in call_kwargs and ("min_speakers" in call_kwargs or "max_speakers" in call_kwargs):
+        raise ValueError("num_speakers cannot be combined with min_speakers/max_speakers")
+    if call_kwargs.get("min_speakers", 1) > call_kwargs.get("max_speakers", 100):
+        raise ValueError("min_speakers must not exceed max_speakers")
+    return call_kwargs, overrides
+
+
+def with_overrides(pipeline, overrides):
+    """Copy of pipeline with config.yaml overrides applied
+
+    Segmentation and embedding models are shared with the original pipeline,
+    only the lightweight sub-pipelines (clustering, segmentation
+    post-processing) are copied so that instantiate() leaves it untouched.
+    """
+    variant = copy.copy(pipeline)
+    variant.__dict__["_instantiated"] = OrderedDict(pipeline._instantiated)
+    variant.__dict__["_pipelines"] = OrderedDict(
+        (name, copy.deepcopy(sub)) for name, sub in pipeline._pipelines.items()
+    )
+    params = pipeline.parameters(instantiated=True)
+    for name, value in overrides.items():
+        group, key = CONFIG_PARAMETERS[name][3]
+        params.setdefault(group, dict())[key] = value
+    variant.instantiate(params)
+    return variant
+
 
 class EndpointHandler:
     def __init__(self, path=""):
@@ -42,8 +112,15 @@ class EndpointHandler:
         waveform, sample_rate = self._io(inputs)
 
         parameters = data.pop("parameters", dict())
-        diarization = self.pipeline(
-            {"waveform": waveform, "sample_rate": sample_rate}, **parameters
+        try:
+            call_kwargs, overrides = parse_parameters(parameters)
+        except ValueError as e:
+            return {"error": str(e)}
+
+        # config.yaml overrides run on a lightweight copy sharing the models
+        pipeline = with_overrides(self._pipeline, overrides) if overrides else self._pipeline
+        diarization = pipeline(
+            {"waveform": waveform, "sample_rate": sample_rate}, **call_kwargs
         )
 
         processed_diarization = [
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Гиперпараметры pipeline, задаваемые в запросе
+
+Два вида параметров:
+- num_speakers, min_speakers, max_speakers - аргументы вызова pipeline,
+  модель не меняют. Известное число спикеров избавляет кластеризацию от
+  подбора числа кластеров.
+- clustering_threshold, min_cluster_size, min_duration_off - параметры
+  config.yaml. Для них создаётся копия pipeline с другими значениями:
+  копируются только лёгкие под-pipeline (кластеризация, постобработка
+  сегментации), модели сегментации и эмбеддингов остаются общими.
+  Копии хранятся в LRU, поэтому частые наборы параметров не
+  инстанцируются заново.
+- clustering - движок кластеризации (agglomerative из pyannote или fast
+  из fast_clustering.py); копия pipeline получает другой под-pipeline
+  кластеризации с теми же гиперпараметрами.
+"""
+
+import copy
+import threading
+from collections import OrderedDict
+
+# Имя поля запроса -> (тип, минимум, максимум)
+CALL_PARAMS = {
+    'num_speakers': (int, 1, 100),
+    'min_speakers': (int, 1, 100),
+    'max_speakers': (int, 1, 100),
+}
+INSTANTIATE_PARAMS = {
+    'clustering_threshold': (float, 0.0, 2.0),
+    'min_cluster_size': (int, 1, 1000),
+    'min_duration_off': (float, 0.0, 10.0),
+}
+
+CLUSTERING_ENGINES = ('agglomerative', 'fast')
+# Поле запроса -> допустимые значения
+CHOICE_PARAMS = {
+    'clustering': CLUSTERING_ENGINES,
+}
+
+# Поле запроса -> путь параметра в pipeline.parameters()
+PARAM_PATHS = {
+    'clustering_threshold': ('clustering', 'threshold'),
+    'min_cluster_size': ('clustering', 'min_cluster_size'),
+    'min_duration_off': ('segmentation', 'min_duration_off'),
+}
+
+
+def _parse_value(name, value, spec):
+    kind, low, high = spec
+    try:
+        parsed = kind(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be {'an integer' if kind is int else 'a number'}")
+    if kind is float and parsed != parsed:
+        raise ValueError(f"{name} must be a number")
+    if not low <= parsed <= high:
+        raise ValueError(f"{name} must be between {low} and {high}")
+    return parsed
+
+
+def parse_params(values):
+    """
+    Проверка параметров запроса (values - dict-подобный объект, например request.form)
+
+    Возвращает (call_kwargs, overrides): аргументы вызова pipeline и
+    переопределения параметров config.yaml. Ошибки - ValueError.
+    """
+    call_kwargs = {}
+    overrides = {}
+    for params, target in ((CALL_PARAMS, call_kwargs), (INSTANTIATE_PARAMS, overrides)):
+        for name, spec in params.items():
+            value = values.get(name)
+            if value is None or value == '':
+                continue
+            target[name] = _parse_value(name, value, spec)
+    for name, choices in CHOICE_PARAMS.items():
+        value = values.get(name)
+        if value is None or value == '':
+            continue
+        value = str(value).lower()
+        if value not in choices:
+            raise ValueError(f"{name} must be one of: {', '.join(choices)}")
+        overrides[name] = value
+
+    if 'num_speakers' in call_kwargs and ('min_speakers' in call_kwargs or 'max_speakers' in call_kwargs):
+        raise ValueError("num_speakers cannot be combined with min_speakers/max_speakers")
+    if call_kwargs.get('min_speakers', 1) > call_kwargs.get('max_speakers', CALL_PARAMS['max_speakers'][2]):
+        raise ValueError("min_speakers must not exceed max_speakers")
+    return call_kwargs, overrides
+
+
+def nested_params(overrides):
+    """{'clustering_threshold': 0.6} -> {'clustering': {'threshold': 0.6}}"""
+    params = {}
+    for name, value in overrides.items():
+        if name not in PARAM_PATHS:
+            continue
+        group, key = PARAM_PATHS[name]
+        params.setdefault(group, {})[key] = value
+    return params
+
+
+def instantiate_variant(base, overrides, clustering_options=None):
+    """
+    Копия pipeline base с другими значениями параметров
+
+    copy.copy разделяет с base модели (_segmentation, _embedding) и всё
+    остальное состояние; словарь инстанцированных значений и под-pipeline
+    копируются, чтобы instantiate не изменил base. clustering_options -
+    параметры движка fast (max_groups), если запрошена смена движка.
+    """
+    variant = copy.copy(base)
+    variant.__dict__['_instantiated'] = OrderedDict(base._instantiated)
+    variant.__dict__['_pipelines'] = OrderedDict(
+        (name, copy.deepcopy(pipeline)) for name, pipeline in base._pipelines.items()
+    )
+    if 'clustering' in overrides:
+        from fast_clustering import set_clustering_engine
+        set_clustering_engine(variant, overrides['clustering'], **(clustering_options or {}))
+    params = base.parameters(instantiated=True)
+    for group, values in nested_params(overrides).items():
+        params.setdefault(group, {}).update(values)
+    variant.instantiate(params)
+    return variant
+
+
+class PipelineVariants:
+    """LRU инстанцированных копий pipeline по набору переопределений"""
+
+    def __init__(self, max_items=8, clustering_options=None):
+        self.max_items = max(1, int(max_items))
+        self.clustering_options = clustering_options
+        self._variants = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, base, overrides):
+        """Pipeline для overrides (без переопределений - сам base)"""
+        if not overrides:
+            return base
+
+        # Воркеры могут работать с разными копиями базового pipeline
+        key = (id(base), tuple(sorted(overrides.items())))
+        with self._lock:
+            variant = self._variants.get(key)
+            if variant is not None:
+                self._variants.move_to_end(key)
+                self.hits += 1
+                return variant
+            self.misses += 1
+
+        variant = instantiate_variant(base, overrides, self.clustering_options)
+        with self._lock:
+            self._variants[key] = variant
+            self._variants.move_to_end(key)
+            while len(self._variants) > self.max_items:
+                self._variants.popitem(last=False)
+        return variant
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._variants), 'max_size': self.max_items,
+                    'hits': self.hits, 'misses': self.misses}
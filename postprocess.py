@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Постобработка сегментов диаризации на массивах SegmentTable
+
+Клиентам обычно нужны не сырые реплики itertracks(), а склеенные реплики
+одного спикера, без коротких (< 200 мс) вставок, с областями перекрытия
+речи и статистикой по спикерам. Всё это считается здесь за один проход по
+массивам start/end/speaker, без цикла по сегментам:
+
+- merge_gaps - соседние реплики одного спикера с паузой не больше max_gap
+  объединяются (сортировка по спикеру и нарастающий максимум концов);
+- drop_short - реплики короче min_duration отбрасываются (после склейки,
+  чтобы короткие куски длинной реплики сначала склеились);
+- sweep - проход по событиям начала/конца реплик: число и состав
+  говорящих на каждом элементарном интервале, из него - области
+  перекрытия (overlaps) и время перекрытия по спикерам;
+- speaker_stats - время речи, доля, число реплик, средняя и самая длинная
+  реплика, первое и последнее появление, время в перекрытии.
+"""
+
+import numpy as np
+
+from formats import SegmentTable
+
+# Поле запроса -> (минимум, максимум), секунды
+DURATION_OPTIONS = {
+    'merge_gap': (0.0, 60.0),
+    'min_duration': (0.0, 60.0),
+}
+FLAG_OPTIONS = ('overlaps', 'speaker_stats')
+
+
+def parse_postprocess(values):
+    """
+    Параметры постобработки из запроса (dict-подобный объект)
+
+    Возвращает словарь только с заданными параметрами; ошибки - ValueError.
+    """
+    options = {}
+    for name, (low, high) in DURATION_OPTIONS.items():
+        value = values.get(name)
+        if value is None or value == '':
+            continue
+        try:
+            parsed = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{name} must be a number")
+        if not low <= parsed <= high:
+            raise ValueError(f"{name} must be between {low} and {high}")
+        options[name] = parsed
+    for name in FLAG_OPTIONS:
+        value = values.get(name)
+        if value is not None and str(value).lower() in ('1', 'true', 'yes'):
+            options[name] = True
+    return options
+
+
+def sort_table(table):
+    """Сегменты в порядке itertracks(): по началу, концу и спикеру"""
+    order = np.lexsort((table.speaker, table.end, table.start))
+    return SegmentTable(table.start[order], table.end[order], table.speaker[order], table.labels)
+
+
+def merge_gaps(table, max_gap):
+    """Склейка реплик одного спикера, между которыми пауза не больше max_gap секунд"""
+    if len(table) < 2:
+        return table
+    order = np.lexsort((table.start, table.speaker))
+    start, end, speaker = table.start[order], table.end[order], table.speaker[order]
+
+    # Докуда дошла речь спикера к каждой реплике: нарастающий максимум концов.
+    # Сдвиг на номер спикера делает его монотонным через границы спикеров,
+    # поэтому хватает одного np.maximum.accumulate
+    shift = speaker * (float(end.max()) + max_gap + 1.0)
+    reach = np.maximum.accumulate(end + shift) - shift
+    first = np.flatnonzero(np.r_[True, (speaker[1:] != speaker[:-1]) | (start[1:] - reach[:-1] > max_gap)])
+
+    return sort_table(SegmentTable(start[first], np.maximum.reduceat(end, first), speaker[first], table.labels))
+
+
+def drop_short(table, min_duration):
+    """Удаление реплик короче min_duration секунд"""
+    keep = table.end - table.start >= min_duration
+    return SegmentTable(table.start[keep], table.end[keep], table.speaker[keep], table.labels)
+
+
+def sweep(table):
+    """
+    Состав говорящих на элементарных интервалах между границами реплик
+
+    Возвращает (начала, концы, active): active[i, k] - число реплик спикера
+    k, звучащих на интервале i. В одной точке конец реплики учитывается
+    раньше начала следующей, поэтому стык реплик - не перекрытие.
+    """
+    count = len(table)
+    times = np.concatenate([table.start, table.end])
+    deltas = np.concatenate([np.ones(count, dtype=np.int16), -np.ones(count, dtype=np.int16)])
+    speakers = np.concatenate([table.speaker, table.speaker])
+    order = np.lexsort((deltas, times))
+
+    active = np.zeros((2 * count, len(table.labels)), dtype=np.int16)
+    active[np.arange(2 * count), speakers[order]] = deltas[order]
+    np.cumsum(active, axis=0, out=active)
+
+    times = times[order]
+    return times[:-1], times[1:], active[:-1]
+
+
+def overlap_regions(table, swept=None):
+    """Области, где говорят двое и больше: [{'start', 'end', 'speakers'}]"""
+    if len(table) < 2:
+        return []
+    starts, ends, active = swept or sweep(table)
+    speaking = active > 0
+    overlapped = (speaking.sum(axis=1) >= 2) & (ends > starts)
+    index = np.flatnonzero(overlapped)
+    if not len(index):
+        return []
+
+    # Соседние интервалы с тем же составом говорящих - одна область
+    contiguous = np.r_[False, (index[1:] == index[:-1] + 1)
+                       & np.all(speaking[index[1:]] == speaking[index[:-1]], axis=1)]
+    first = index[~contiguous]
+    last = index[np.r_[~contiguous[1:], True]]
+    labels = table.labels
+    return [
+        {'start': start, 'end': end, 'speakers': [labels[k] for k in np.flatnonzero(row)]}
+        for start, end, row in zip(starts[first].tolist(), ends[last].tolist(), speaking[first])
+    ]
+
+
+def speaker_stats(table, swept=None):
+    """Статистика по спикерам, у которых есть хотя бы одна реплика"""
+    speakers = len(table.labels)
+    durations = table.end - table.start
+    segments = np.bincount(table.speaker, minlength=speakers)
+    talk = np.bincount(table.speaker, weights=durations, minlength=speakers)
+    longest = np.zeros(speakers)
+    np.maximum.at(longest, table.speaker, durations)
+    first = np.full(speakers, np.inf)
+    np.minimum.at(first, table.speaker, table.start)
+    last = np.zeros(speakers)
+    np.maximum.at(last, table.speaker, table.end)
+
+    overlap = np.zeros(speakers)
+    if len(table) > 1:
+        starts, ends, active = swept or sweep(table)
+        speaking = active > 0
+        overlapped = speaking.sum(axis=1) >= 2
+        overlap = (ends - starts)[overlapped] @ speaking[overlapped]
+
+    total = float(talk.sum())
+    talk, segments, longest = talk.tolist(), segments.tolist(), longest.tolist()
+    first, last, overlap = first.tolist(), last.tolist(), np.asarray(overlap, dtype=np.float64).tolist()
+    return [
+        {
+            'speaker': table.labels[k],
+            'talk_time_seconds': round(talk[k], 3),
+            'share': round(talk[k] / total, 4) if total else 0.0,
+            'segments': segments[k],
+            'mean_segment_seconds': round(talk[k] / segments[k], 3),
+            'longest_segment_seconds': round(longest[k], 3),
+            'first_seconds': round(first[k], 3),
+            'last_seconds': round(last[k], 3),
+            'overlap_seconds': round(overlap[k], 3),
+        }
+        for k in range(speakers) if segments[k]
+    ]
+
+
+def apply_postprocess(result, options):
+    """
+    Постобработка результата диаризации (словарь с SegmentTable в 'segments')
+
+    Сегменты заменяются обработанными, overlaps и speaker_stats
+    добавляются в результат, если запрошены.
+    """
+    if not options:
+        return result
+    table = result['segments']
+    if options.get('merge_gap') is not None:
+        table = merge_gaps(table, options['merge_gap'])
+    if options.get('min_duration'):
+        table = drop_short(table, options['min_duration'])
+    result['segments'] = table
+    result['total_segments'] = len(table)
+
+    swept = sweep(table) if len(table) > 1 and (options.get('overlaps') or options.get('speaker_stats')) else None
+    if options.get('overlaps'):
+        result['overlaps'] = overlap_regions(table, swept)
+    if options.get('speaker_stats'):
+        result['speaker_stats'] = speaker_stats(table, swept)
+    return result
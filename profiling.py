@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Профилирование отдельного запроса в production
+
+Запрос /diarize с profile=1 выполняется внутри capture(): одновременно
+работают torch profiler (операторы модели, на GPU - ядра CUDA) и
+семплирующий профайлер Python (стеки потока задачи и потоков динамического
+батчинга раз в несколько миллисекунд). Результат - каталог профиля:
+
+- trace.json - трасса torch profiler (chrome://tracing, Perfetto);
+- stacks.folded - свёрнутые стеки Python (flamegraph.pl, speedscope);
+- summary.txt - самые тяжёлые операторы torch и функции Python;
+- meta.json - файл, длительность, число семплов.
+
+ProfileStore хранит не больше max_profiles каталогов и не дольше ttl
+секунд, старые удаляются при создании новых. Каталог общий для процессов
+serve.py, поэтому профиль можно скачать через любой процесс.
+
+torch profiler записывает операторы потока задачи; при динамическом
+батчинге (DIARIZATION_BATCHING) модели вызываются из потоков батчинга,
+и их видно только в стеках Python.
+
+Без profile=1 ничего из этого не запускается: обычные запросы не платят
+за профилирование.
+"""
+
+import collections
+import contextlib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import uuid
+import zipfile
+
+TRACE_FILE = 'trace.json'
+STACKS_FILE = 'stacks.folded'
+SUMMARY_FILE = 'summary.txt'
+META_FILE = 'meta.json'
+
+SAMPLE_INTERVAL = 0.005  # секунды между семплами стеков
+SUMMARY_ROWS = 30
+# Модель при динамическом батчинге вызывается из потоков *-batcher
+SAMPLED_THREAD_SUFFIX = 'batcher'
+
+PROFILE_ID = re.compile(r'[0-9a-f]{32}')
+
+# torch profiler не допускает двух одновременных сессий в процессе
+_capture_lock = threading.Lock()
+
+
+def frame_label(code):
+    """Функция в стеке: имя и место определения (два последних компонента пути)"""
+    path = code.co_filename.replace('\\', '/').rsplit('/', 2)
+    return f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Семплирующий профайлер Python
+
+    Раз в interval секунд снимает стеки потока target и потоков батчинга
+    и считает одинаковые стеки (корень стека - имя потока).
+    """
+
+    def __init__(self, target, interval=SAMPLE_INTERVAL):
+        self.target = target
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            names = {
+                thread.ident: thread.name for thread in threading.enumerate()
+                if thread.ident == self.target or thread.name.endswith(SAMPLED_THREAD_SUFFIX)
+            }
+            for ident, frame in sys._current_frames().items():
+                if ident not in names:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names[ident])
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self):
+        """Свёрнутые стеки: 'поток;внешняя;...;внутренняя число'"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top(self, limit=SUMMARY_ROWS):
+        """Самые частые функции: (собственные семплы, включая вызванные)"""
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')[1:]
+            if not frames:
+                continue
+            own[frames[-1]] += count
+            for label in set(frames):
+                total[label] += count
+        return own.most_common(limit), total.most_common(limit)
+
+
+def format_summary(meta, table, sampler):
+    """Текстовая сводка профиля"""
+    lines = [
+        f"Profile {meta['id']}: {meta['filename']}, {meta['seconds']:.2f}s, "
+        f"{meta['samples']} samples every {meta['interval_ms']:g} ms",
+        '',
+        '== torch operators ==',
+        table,
+    ]
+    own, total = sampler.top()
+    # Доля от всех снятых стеков (за семпл - по стеку на каждый поток)
+    samples = max(sum(sampler.stacks.values()), 1)
+    for title, rows in (('== Python: own samples ==', own), ('== Python: cumulative samples ==', total)):
+        lines += ['', title]
+        lines += [f"{count:8d} {100.0 * count / samples:6.1f}%  {label}" for label, count in rows]
+    return '\n'.join(lines) + '\n'
+
+
+@contextlib.contextmanager
+def capture(directory, profile_id, filename, interval=SAMPLE_INTERVAL):
+    """
+    Профилирование блока кода с записью профиля в directory
+
+    Параллельные профили выполняются по очереди (ограничение torch
+    profiler). Возвращает словарь meta, заполняемый после выхода из блока;
+    при исключении в блоке файлы профиля не пишутся.
+    """
+    import torch
+    from torch.profiler import ProfilerActivity, profile
+
+    cuda = torch.cuda.is_available()
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if cuda else [])
+    meta = {'id': profile_id, 'filename': filename, 'interval_ms': interval * 1000}
+
+    with _capture_lock:
+        sampler = StackSampler(threading.get_ident(), interval)
+        started = time.perf_counter()
+        with profile(activities=activities, record_shapes=True) as prof:
+            sampler.start()
+            try:
+                yield meta
+            finally:
+                sampler.stop()
+        meta.update(seconds=time.perf_counter() - started, samples=sampler.samples,
+                    created=time.time(), device='cuda' if cuda else 'cpu')
+
+        prof.export_chrome_trace(os.path.join(directory, TRACE_FILE))
+        table = prof.key_averages().table(
+            sort_by='self_cuda_time_total' if cuda else 'self_cpu_time_total', row_limit=SUMMARY_ROWS
+        )
+        with open(os.path.join(directory, STACKS_FILE), 'w', encoding='utf-8') as f:
+            f.write(sampler.folded())
+        with open(os.path.join(directory, SUMMARY_FILE), 'w', encoding='utf-8') as f:
+            f.write(format_summary(meta, table, sampler))
+        with open(os.path.join(directory, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+
+
+class ProfileStore:
+    """Каталог профилей с ограниченным хранением (по числу и возрасту)"""
+
+    def __init__(self, directory, max_profiles=20, ttl=86400):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_profiles > 0
+
+    def create(self):
+        """Новый пустой каталог профиля: (profile_id, путь)"""
+        profile_id = uuid.uuid4().hex
+        path = os.path.join(self.directory, profile_id)
+        with self._lock:
+            self._prune(reserve=1)
+            os.makedirs(path)
+        return profile_id, path
+
+    def path(self, profile_id):
+        """Каталог готового профиля или None (профиль старше ttl удаляется)"""
+        if not PROFILE_ID.fullmatch(profile_id or ''):
+            return None
+        path = os.path.join(self.directory, profile_id)
+        try:
+            written = os.path.getmtime(os.path.join(path, META_FILE))
+        except OSError:
+            return None
+        if written < time.time() - self.ttl:
+            self.discard(profile_id)
+            return None
+        return path
+
+    def discard(self, profile_id):
+        shutil.rmtree(os.path.join(self.directory, profile_id), ignore_errors=True)
+
+    def archive(self, profile_id):
+        """Профиль одним zip-архивом (BytesIO) или None"""
+        path = self.path(profile_id)
+        if path is None:
+            return None
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name in sorted(os.listdir(path)):
+                archive.write(os.path.join(path, name), name)
+        buffer.seek(0)
+        return buffer
+
+    def count(self):
+        return len(self._entries())
+
+    def _entries(self):
+        """(время изменения, profile_id) всех профилей, от старых к новым"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        entries = []
+        for name in names:
+            if PROFILE_ID.fullmatch(name):
+                try:
+                    entries.append((os.path.getmtime(os.path.join(self.directory, name)), name))
+                except OSError:
+                    continue
+        return sorted(entries)
+
+    def _prune(self, reserve=0):
+        """Удаление профилей старше ttl и сверх max_profiles (с местом под reserve новых)"""
+        entries = self._entries()
+        expired = time.time() - self.ttl
+        excess = len(entries) + reserve - self.max_profiles
+        for index, (mtime, name) in enumerate(entries):
+            if index < excess or mtime < expired:
+                self.discard(name)
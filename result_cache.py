@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Кэш результатов диаризации, адресуемый по содержимому аудио
+
+Ключ - SHA-256 от байтов аудио и конфигурации pipeline (параметры из
+config.yaml и переопределения запроса). Два уровня: LRU в памяти и
+необязательный каталог на диске с вытеснением по суммарному размеру.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+HASH_CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+
+def config_fingerprint(config):
+    """Стабильное строковое представление конфигурации для ключа кэша"""
+    return json.dumps(config, sort_keys=True, default=str, separators=(',', ':'))
+
+
+def cache_key(audio_hash, config=None, overrides=None):
+    """Ключ кэша: хэш аудио + конфигурация pipeline + параметры запроса"""
+    digest = hashlib.sha256()
+    digest.update(audio_hash.encode('ascii'))
+    digest.update(b'\0')
+    digest.update(config_fingerprint(config or {}).encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(config_fingerprint(overrides or {}).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def hash_bytes(data):
+    """SHA-256 содержимого аудио"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def copy_and_hash(src, dst):
+    """Копирование потока src в файловый объект dst с подсчётом SHA-256"""
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = src.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        dst.write(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+
+class ResultCache:
+    """
+    Двухуровневый кэш результатов
+
+    max_items - размер LRU в памяти (0 отключает кэш в памяти),
+    disk_dir - каталог дискового уровня (None отключает его),
+    disk_max_bytes - предельный суммарный размер файлов на диске.
+    """
+
+    def __init__(self, max_items=256, disk_dir=None, disk_max_bytes=1024 ** 3):
+        self.max_items = max(0, int(max_items))
+        self.disk_dir = disk_dir or None
+        self.disk_max_bytes = int(disk_max_bytes)
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+        }
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_items > 0 or self.disk_dir is not None
+
+    def get(self, key):
+        """Результат по ключу или None"""
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._counters['memory_hits'] += 1
+                return self._memory[key]
+
+        value = self._disk_get(key)
+        with self._lock:
+            if value is None:
+                self._counters['misses'] += 1
+                return None
+            self._counters['disk_hits'] += 1
+            self._memory_put(key, value)
+        return value
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._memory_put(key, value)
+            self._counters['stores'] += 1
+        self._disk_put(key, value)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            memory_items = len(self._memory)
+        lookups = counters['memory_hits'] + counters['disk_hits'] + counters['misses']
+        hits = counters['memory_hits'] + counters['disk_hits']
+        return {
+            'enabled': self.enabled,
+            'memory_items': memory_items,
+            'memory_max_items': self.max_items,
+            'disk_enabled': self.disk_dir is not None,
+            'hits': hits,
+            'hit_rate': round(hits / lookups, 3) if lookups else None,
+            **counters,
+        }
+
+    def _memory_put(self, key, value):
+        # Вызывается под self._lock
+        if self.max_items <= 0:
+            return
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+            self._counters['evictions'] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f'{key}.json')
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+            # Обновляем mtime, чтобы вытеснение работало как LRU
+            os.utime(path, None)
+            return value
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"⚠ Warning: Could not read cache entry {key}: {e}")
+            return None
+
+    def _disk_put(self, key, value):
+        if not self.disk_dir:
+            return
+        tmp_path = None
+        try:
+            # Атомарная запись: временный файл + переименование
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(value, f, separators=(',', ':'))
+            os.replace(tmp_path, self._disk_path(key))
+        except Exception as e:
+            print(f"⚠ Warning: Could not write cache entry {key}: {e}")
+            # Недописанный временный файл вытеснение не видит - удаляем сразу
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+            return
+        self._disk_evict()
+
+    def _disk_evict(self):
+        """Удаление самых старых файлов, пока размер каталога выше предела"""
+        with self._disk_lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.disk_dir):
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+            if total <= self.disk_max_bytes:
+                return
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.disk_max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                    with self._lock:
+                        self._counters['evictions'] += 1
+                except FileNotFoundError:
+                    pass
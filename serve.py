@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Многопроцессный запуск сервиса диаризации с общими весами модели
+
+Pipeline загружается один раз в родительском процессе Gunicorn (preload),
+тензоры весов переносятся в разделяемую память, после чего воркеры
+создаются через fork и используют одну копию весов. Каждый воркер получает
+свою долю CPU: torch.set_num_threads и, на Linux, привязку к ядрам.
+
+С --asgi воркеры обслуживают асинхронный фронтенд asgi.py (Uvicorn):
+медленные клиенты не занимают потоки, запросы передаются приложению
+только после приёма тела.
+
+Задачи /jobs и сессии /sessions живут в памяти своего воркера: их опрос
+должен попадать в тот же процесс (sticky routing, см. README).
+
+Пример:
+    python serve.py --workers 4 --port 5000
+    python serve.py --workers 2 --asgi
+"""
+
+import argparse
+import gc
+import os
+import sys
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# torch.cuda.is_available() в арбитре должен определять видеокарты через
+# NVML, не инициализируя CUDA: иначе воркеры после fork не смогут её
+# использовать. Переменная читается torch, поэтому задаётся до его импорта
+os.environ.setdefault('PYTORCH_NVML_BASED_CUDA_CHECK', '1')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Diarization service with pre-forked workers')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('DIARIZATION_PROCESSES', 2)),
+                        help='Number of worker processes (default: DIARIZATION_PROCESSES or 2)')
+    parser.add_argument('--threads-per-worker', type=int, default=None,
+                        help='torch threads per worker (default: CPU count / workers)')
+    parser.add_argument('--http-threads', type=int, default=8,
+                        help='HTTP handler threads per worker (default: 8)')
+    parser.add_argument('--host', default=os.getenv('DIARIZATION_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('DIARIZATION_PORT', 5000)))
+    parser.add_argument('--timeout', type=int, default=300, help='Worker timeout, seconds')
+    parser.add_argument('--no-pin', action='store_true', help='Do not pin workers to CPU cores')
+    parser.add_argument('--asgi', action='store_true',
+                        help='Serve the asyncio front end (asgi.py) with Uvicorn workers')
+    return parser.parse_args()
+
+
+def available_cpus():
+    """Список ядер, доступных процессу"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_slice(worker_index, workers, cpus):
+    """Ядра для воркера: непересекающиеся равные части доступных ядер"""
+    per_worker = max(1, len(cpus) // workers)
+    start = (worker_index % workers) * per_worker
+    return cpus[start:start + per_worker] or cpus
+
+
+def share_pipeline_weights(pipeline):
+    """Перенос весов всех моделей pipeline в разделяемую память"""
+    import torch
+
+    shared = 0
+    modules = [inference.model for inference in pipeline._inferences.values() if hasattr(inference, 'model')]
+    modules += [inference.model_ for inference in pipeline._inferences.values() if hasattr(inference, 'model_')]
+    modules += list(pipeline._models.values())
+
+    for module in modules:
+        if not isinstance(module, torch.nn.Module):
+            continue
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            tensor.share_memory_()
+            shared += tensor.numel() * tensor.element_size()
+
+    return shared
+
+
+def main():
+    args = parse_args()
+
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        print("✗ gunicorn is not installed (it is not available on Windows)")
+        print("Use: python diarization_service.py")
+        sys.exit(1)
+
+    if args.asgi:
+        try:
+            import uvicorn.workers  # noqa: F401
+        except ImportError:
+            print("✗ --asgi requires uvicorn (pip install uvicorn)")
+            sys.exit(1)
+
+    import torch
+
+    cpus = available_cpus()
+    workers = max(1, args.workers)
+    threads_per_worker = args.threads_per_worker or max(1, len(cpus) // workers)
+
+    # После инициализации CUDA fork небезопасен: на GPU каждый воркер
+    # загружает модель сам, общие веса возможны только на CPU. Проверка
+    # идёт через NVML (PYTORCH_NVML_BASED_CUDA_CHECK) и CUDA в арбитре
+    # не инициализирует
+    preload = not torch.cuda.is_available()
+
+    if preload:
+        import diarization_service
+
+        # Загрузка один раз в родителе, воркеры получат веса через fork
+        diarization_service.load_pipeline()
+        shared = share_pipeline_weights(diarization_service.pipeline)
+        print(f"✓ Pipeline weights shared between workers: {shared / 1024 / 1024:.1f} MB")
+        # Объекты, созданные до fork, исключаем из сборки мусора, чтобы
+        # GC не трогал их страницы памяти и не вызывал копирование при записи
+        gc.collect()
+        gc.freeze()
+    else:
+        print("⚠ CUDA detected: each worker loads its own pipeline after fork")
+
+    # Номер доли CPU у каждого живого воркера (ключ - age, порядковый номер
+    # воркера у арбитра). Заполняется в арбитре: pre_fork и child_exit
+    # выполняются в нём, post_fork - уже в воркере
+    cpu_slots = {}
+
+    def pre_fork(server, worker):
+        # Перезапущенный воркер занимает освободившуюся долю, а не следующую
+        # по счёту; при перезагрузке (HUP) старые и новые воркеры живут
+        # одновременно, тогда берётся наименее занятая доля
+        busy = list(cpu_slots.values())
+        worker.cpu_slot = min(range(workers), key=lambda slot: (busy.count(slot), slot))
+        cpu_slots[worker.age] = worker.cpu_slot
+
+    def child_exit(server, worker):
+        cpu_slots.pop(worker.age, None)
+
+    def post_fork(server, worker):
+        torch.set_num_threads(threads_per_worker)
+        pinned = None
+        if not args.no_pin and hasattr(os, 'sched_setaffinity'):
+            pinned = cpu_slice(worker.cpu_slot, workers, cpus)
+            try:
+                os.sched_setaffinity(0, pinned)
+            except OSError as e:
+                print(f"⚠ Warning: Could not pin worker to CPUs {pinned}: {e}")
+                pinned = None
+        print(f"✓ Worker {worker.pid} (slot {worker.cpu_slot}): {threads_per_worker} torch thread(s), CPUs: {pinned or 'any'}")
+
+    def post_worker_init(worker):
+        import diarization_service
+        # Загрузка (на GPU) и прогрев в фоне воркера; прогрев не делается
+        # в родителе, так как пулы потоков torch не переживают fork
+        diarization_service.start_warmup()
+        diarization_service.job_queue.start()
+
+    class DiarizationApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{args.host}:{args.port}')
+            self.cfg.set('workers', workers)
+            if args.asgi:
+                self.cfg.set('worker_class', 'uvicorn.workers.UvicornWorker')
+            else:
+                self.cfg.set('worker_class', 'gthread')
+                self.cfg.set('threads', args.http_threads)
+            self.cfg.set('timeout', args.timeout)
+            # На GPU сервис (и CUDA) импортируется только в воркерах
+            self.cfg.set('preload_app', preload)
+            self.cfg.set('pre_fork', pre_fork)
+            self.cfg.set('post_fork', post_fork)
+            self.cfg.set('child_exit', child_exit)
+            self.cfg.set('post_worker_init', post_worker_init)
+
+        def load(self):
+            import diarization_service
+            if args.asgi:
+                from asgi import AsyncFrontend
+                # Модель и очередь запускает post_worker_init
+                return AsyncFrontend(diarization_service.app, startup=False)
+            return diarization_service.app
+
+    print(f"\n{'='*60}")
+    print(f"Diarization Service (pre-forked)")
+    print(f"{'='*60}")
+    print(f"Bind: {args.host}:{args.port}")
+    print(f"Workers: {workers} x {threads_per_worker} torch thread(s)")
+    print(f"Shared weights: {'yes' if preload else 'no (CUDA)'}")
+    print(f"Front end: {'asyncio (ASGI)' if args.asgi else f'{args.http_threads} HTTP thread(s) per worker'}")
+    print(f"{'='*60}\n")
+
+    DiarizationApplication().run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Инкрементальная диаризация растущих записей (сессии)
+
+Клиент дописывает аудио в сессию, и после каждой порции нужна разметка
+всей записи. Полный перезапуск pipeline на каждой порции обходится в
+O(n^2) по длине встречи, поэтому сессия хранит результаты дорогих шагов:
+
+- сегментацию каждого полного окна (чанка) pipeline;
+- эмбеддинги (чанк, локальный спикер) для этих окон.
+
+Окна pipeline идут с фиксированным шагом от начала записи, и окно,
+целиком лежащее в уже полученном аудио, при дописывании не меняется.
+Поэтому на новой порции модели запускаются только на хвосте, начиная с
+первого неполного окна (оно и даёт перекрытие с уже обработанным
+контекстом), а кластеризация, реконструкция и постобработка заново
+выполняются по всем сохранённым эмбеддингам. Результат совпадает с
+диаризацией всей записи целиком.
+
+Шаги кластеризации и далее выполняет сам pipeline: для вызова создаётся
+поверхностная копия, у которой get_segmentations и get_embeddings
+подменены на версии с сохранёнными данными.
+
+Метки спикеров между обновлениями стабилизируются: новые центроиды
+сопоставляются с центроидами предыдущего результата (венгерский
+алгоритм по косинусному сходству), и совпавшие спикеры сохраняют метки.
+"""
+
+import copy
+import threading
+import time
+import uuid
+
+import numpy as np
+
+# Минимальное косинусное сходство центроидов, при котором спикер
+# нового результата получает метку спикера из предыдущего
+LABEL_MATCH_THRESHOLD = 0.5
+
+
+class DiarizationSession:
+    """Состояние одной сессии: хвост аудио и результаты полных окон"""
+
+    def __init__(self, session_id, sample_rate=16000):
+        self.session_id = session_id
+        self.sample_rate = sample_rate
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        # Порядок: добавление аудио (append) и обработка (update) под одной
+        # блокировкой, обработка целиком - под process_lock
+        self.lock = threading.Lock()
+        self.process_lock = threading.Lock()
+
+        self.total_samples = 0      # всего получено отсчётов
+        self.offset_samples = 0     # начало первого неполного окна
+        self.tail = []              # аудио с offset_samples (список тензоров (1, n))
+        self.pending_samples = 0    # ещё не обработанные отсчёты
+        self.segmentations = None   # (полные окна, кадры, локальные спикеры)
+        self.embeddings = None      # (полные окна, локальные спикеры, размерность)
+        self.sliding_window = None
+
+        self.labels = {}            # метка -> центроид предыдущего результата
+        self.result = None          # последний результат (Annotation, centroids)
+        self.result_key = None      # pipeline и аргументы, с которыми он получен
+        self.updates = 0
+
+    @property
+    def duration(self):
+        return self.total_samples / self.sample_rate
+
+    @property
+    def num_chunks(self):
+        return 0 if self.segmentations is None else len(self.segmentations)
+
+    def append(self, waveform, full_recording=False):
+        """
+        Дописывание аудио (1, samples) 16 кГц
+
+        full_recording - клиент присылает всю запись целиком (растущий файл):
+        берутся только отсчёты после уже полученных.
+        Возвращает число добавленных отсчётов.
+        """
+        with self.lock:
+            if full_recording:
+                waveform = waveform[:, self.total_samples:]
+            added = waveform.shape[1]
+            if added:
+                self.tail.append(waveform)
+                self.total_samples += added
+                self.pending_samples += added
+                self.updated_at = time.time()
+            return added
+
+    def info(self):
+        return {
+            'session_id': self.session_id,
+            'duration_seconds': round(self.duration, 2),
+            'processed_chunks': self.num_chunks,
+            'pending_seconds': round(self.pending_samples / self.sample_rate, 2),
+            'updates': self.updates,
+            'created_at': round(self.created_at, 3),
+            'updated_at': round(self.updated_at, 3),
+        }
+
+    def _take_tail(self):
+        import torch
+
+        with self.lock:
+            if len(self.tail) > 1:
+                self.tail = [torch.cat(self.tail, dim=1)]
+            pending, self.pending_samples = self.pending_samples, 0
+            return (self.tail[0] if self.tail else None), pending
+
+    def _commit(self, pipeline, new_segmentations, new_embeddings, tail_samples):
+        """Сохранение полных окон хвоста и отбрасывание аудио, которое больше не нужно"""
+        inference = pipeline._segmentation
+        window_size = inference.model.audio.get_num_samples(inference.duration)
+        step_size = round(inference.step * self.sample_rate)
+        complete = 0 if tail_samples < window_size else 1 + (tail_samples - window_size) // step_size
+
+        if self.segmentations is None:
+            self.segmentations = new_segmentations[:complete]
+            self.embeddings = new_embeddings[:complete]
+        else:
+            self.segmentations = np.concatenate([self.segmentations, new_segmentations[:complete]])
+            self.embeddings = np.concatenate([self.embeddings, new_embeddings[:complete]])
+
+        with self.lock:
+            # Аудио до начала следующего окна уже не понадобится
+            self.offset_samples += complete * step_size
+            self.tail = [self.tail[0][:, complete * step_size:]] + self.tail[1:]
+
+    def update(self, pipeline, hook=None, **kwargs):
+        """
+        Диаризация всей записи с учётом новых порций
+
+        Возвращает (Annotation, centroids) в формате вызова pipeline с
+        return_embeddings=True. Если нового аудио нет, возвращает
+        предыдущий результат, если он получен с теми же pipeline и аргументами.
+        """
+        result_key = (id(pipeline), tuple(sorted(kwargs.items())))
+        with self.process_lock:
+            if self.result is not None and not self.pending_samples and self.result_key == result_key:
+                return self.result
+
+            tail, pending = self._take_tail()
+            if tail is None or not tail.shape[1]:
+                from pyannote.core import Annotation
+                return Annotation(uri=self.session_id), None
+            try:
+                return self._update(pipeline, tail, hook, result_key, **kwargs)
+            except BaseException:
+                # Хвост не обработан (например, OOM): порция остаётся
+                # необработанной, и повторный вызов обработает её снова
+                with self.lock:
+                    self.pending_samples += pending
+                raise
+
+    def _update(self, pipeline, tail, hook, result_key, **kwargs):
+        """Обработка хвоста tail и кластеризация всей записи"""
+        from pyannote.core import SlidingWindow, SlidingWindowFeature
+
+        tail_file = {'waveform': tail, 'sample_rate': self.sample_rate, 'uri': self.session_id}
+        stored = self.num_chunks
+        computed = {}
+
+        def get_segmentations(file, hook=None):
+            new = pipeline.get_segmentations(tail_file, hook=hook)
+            computed['segmentations'] = new.data
+            window = new.sliding_window
+            self.sliding_window = SlidingWindow(start=0.0, duration=window.duration, step=window.step)
+            data = new.data if self.segmentations is None else np.concatenate([self.segmentations, new.data])
+            return SlidingWindowFeature(data, self.sliding_window)
+
+        def get_embeddings(file, binary_segmentations, exclude_overlap=False, hook=None):
+            # Эмбеддинги считаются только для окон хвоста (время - от его начала)
+            window = binary_segmentations.sliding_window
+            tail_segmentations = SlidingWindowFeature(
+                binary_segmentations.data[stored:],
+                SlidingWindow(start=0.0, duration=window.duration, step=window.step),
+            )
+            new = pipeline.get_embeddings(tail_file, tail_segmentations,
+                                          exclude_overlap=exclude_overlap, hook=hook)
+            computed['embeddings'] = new
+            return new if self.embeddings is None else np.concatenate([self.embeddings, new])
+
+        # Копия pipeline для одного вызова: модели, параметры и
+        # кластеризация общие, подменены только два шага
+        session_pipeline = copy.copy(pipeline)
+        session_pipeline.get_segmentations = get_segmentations
+        session_pipeline.get_embeddings = get_embeddings
+
+        full_file = {'waveform': tail, 'sample_rate': self.sample_rate, 'uri': self.session_id}
+        diarization, centroids = session_pipeline(full_file, hook=hook, return_embeddings=True, **kwargs)
+
+        if 'segmentations' in computed:
+            if 'embeddings' not in computed:
+                # Речи не найдено: эмбеддинги хвоста не считались
+                computed['embeddings'] = np.zeros(
+                    computed['segmentations'].shape[:2] + (pipeline._embedding.dimension,),
+                    dtype=np.float32,
+                )
+            self._commit(pipeline, computed['segmentations'], computed['embeddings'], tail.shape[1])
+
+        diarization, centroids = self._stable_labels(diarization, centroids)
+        self.result = (diarization, centroids)
+        self.result_key = result_key
+        self.updates += 1
+        return self.result
+
+    def _stable_labels(self, diarization, centroids):
+        """Сохранение меток спикеров предыдущего результата"""
+        labels = diarization.labels()
+        if centroids is None or not len(labels):
+            return diarization, centroids
+
+        mapping = {}
+        previous = list(self.labels)
+        if previous:
+            from scipy.optimize import linear_sum_assignment
+
+            def normalize(x):
+                return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+            similarity = normalize(centroids) @ normalize(np.stack([self.labels[p] for p in previous])).T
+            for i, j in zip(*linear_sum_assignment(-similarity)):
+                if similarity[i, j] >= LABEL_MATCH_THRESHOLD:
+                    mapping[labels[i]] = previous[j]
+
+        used = set(mapping.values())
+        next_index = 0
+        for label in labels:
+            if label in mapping:
+                continue
+            while f'SPEAKER_{next_index:02d}' in used or f'SPEAKER_{next_index:02d}' in self.labels:
+                next_index += 1
+            mapping[label] = f'SPEAKER_{next_index:02d}'
+            used.add(mapping[label])
+
+        diarization = diarization.rename_labels(mapping=mapping)
+        # Центроиды - в порядке новых labels()
+        rows = {mapping[label]: centroids[i] for i, label in enumerate(labels)}
+        centroids = np.stack([rows[label] for label in diarization.labels()])
+        self.labels.update(rows)
+        return diarization, centroids
+
+
+class SessionStore:
+    """Сессии в памяти процесса с вытеснением неактивных по TTL"""
+
+    def __init__(self, ttl=3600, max_sessions=64):
+        self.ttl = ttl
+        self.max_sessions = max(1, int(max_sessions))
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        now = time.time()
+        for session_id in [sid for sid, s in self._sessions.items() if now - s.updated_at > self.ttl]:
+            del self._sessions[session_id]
+
+    def create(self, sample_rate=16000):
+        """Новая сессия или None, если достигнут лимит"""
+        with self._lock:
+            self._expire()
+            if len(self._sessions) >= self.max_sessions:
+                return None
+            session = DiarizationSession(uuid.uuid4().hex, sample_rate)
+            self._sessions[session.session_id] = session
+            return session
+
+    def get(self, session_id):
+        with self._lock:
+            self._expire()
+            return self._sessions.get(session_id)
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def stats(self):
+        with self._lock:
+            self._expire()
+            return {'active': len(self._sessions), 'max_sessions': self.max_sessions, 'ttl_seconds': self.ttl}
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Снимок pipeline для быстрого холодного старта
+
+Обычная загрузка разбирает config.yaml и восстанавливает обе модели из
+Lightning-чекпойнтов pytorch_model.bin. Снимок - это уже собранный и
+инстанцированный pipeline, сохранённый torch.save одним файлом. Загрузка
+идёт через mmap: веса не копируются в память процесса, а подгружаются
+страницами по мере обращения, и не требует сети.
+
+Снимок привязан к версиям torch и pyannote.audio, на которых он создан;
+при несовпадении load_snapshot отказывается его читать, и сервис
+загружает модель обычным способом.
+"""
+
+import os
+
+SNAPSHOT_FILE = 'pipeline_snapshot.pt'
+SNAPSHOT_FORMAT = 1
+
+
+def runtime_versions():
+    import torch
+    from pyannote.audio import __version__ as pyannote_version
+    return {'torch': torch.__version__, 'pyannote.audio': pyannote_version}
+
+
+def save_snapshot(pipeline, path):
+    """Сохранение pipeline (на CPU) в файл снимка, возвращает размер в байтах"""
+    import torch
+
+    tmp_path = path + '.tmp'
+    torch.save({
+        'format': SNAPSHOT_FORMAT,
+        'versions': runtime_versions(),
+        'pipeline': pipeline,
+    }, tmp_path)
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def load_snapshot(path, device=None):
+    """Загрузка pipeline из снимка и перенос на device"""
+    import torch
+
+    try:
+        snapshot = torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+    except TypeError:
+        # torch < 2.1 не поддерживает mmap
+        snapshot = torch.load(path, map_location='cpu')
+
+    if snapshot.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError(f"Unsupported snapshot format: {snapshot.get('format')}")
+    versions = runtime_versions()
+    if snapshot.get('versions') != versions:
+        raise ValueError(f"Snapshot was created with {snapshot.get('versions')}, running {versions}")
+
+    pipeline = snapshot['pipeline']
+    return pipeline.to(device) if device is not None else pipeline
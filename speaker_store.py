@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Хранилище эмбеддингов известных спикеров
+
+Эмбеддинги (L2-нормированные, float32) лежат в memory-mapped матрице
+embeddings.npy, метки строк - в speakers.json. У одного спикера может быть
+несколько записей. Сопоставление анонимных спикеров (SPEAKER_00, ...) с
+известными - одно матричное умножение центроидов на матрицу хранилища.
+
+Хранилище общее для процессов serve.py: изменения выполняются под файловой
+блокировкой (.lock в каталоге хранилища), а перед каждой операцией индекс
+перечитывается, если его изменил другой процесс.
+"""
+
+import contextlib
+import json
+import os
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: serve.py (gunicorn) там недоступен, сервис - один процесс
+    fcntl = None
+
+INITIAL_CAPACITY = 256
+
+
+def file_stamp(path):
+    """Признак изменения файла: индекс заменяется через os.replace, inode меняется"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def normalize(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class SpeakerStore:
+    """Memory-mapped матрица эмбеддингов и индекс меток"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._matrix_path = os.path.join(directory, 'embeddings.npy')
+        self._index_path = os.path.join(directory, 'speakers.json')
+        self._lock_path = os.path.join(directory, '.lock')
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._labels = []
+        self._dimension = None
+        self._index_stamp = None
+
+        with self._locked(exclusive=False):
+            pass
+
+    @property
+    def count(self):
+        with self._locked(exclusive=False):
+            return len(self._labels)
+
+    def speakers(self):
+        """Список известных спикеров и количество записей каждого"""
+        with self._locked(exclusive=False):
+            counts = {}
+            for label in self._labels:
+                counts[label] = counts.get(label, 0) + 1
+        return [{'label': label, 'enrollments': n} for label, n in sorted(counts.items())]
+
+    def enroll(self, label, embedding):
+        """Добавление эмбеддинга спикера, возвращает общее число его записей"""
+        vector = normalize(embedding)[0]
+        if not np.any(vector):
+            raise ValueError('Embedding must be non-zero')
+
+        with self._locked():
+            if self._dimension is None:
+                self._dimension = int(vector.shape[0])
+            elif vector.shape[0] != self._dimension:
+                raise ValueError(f'Embedding dimension must be {self._dimension}, got {vector.shape[0]}')
+
+            count = len(self._labels)
+            self._ensure_capacity(count + 1)
+            self._matrix[count] = vector
+            self._matrix.flush()
+            self._labels.append(label)
+            self._save_index()
+            return self._labels.count(label)
+
+    def remove(self, label):
+        """Удаление всех записей спикера, возвращает число удалённых"""
+        with self._locked():
+            keep = [i for i, existing in enumerate(self._labels) if existing != label]
+            removed = len(self._labels) - len(keep)
+            if removed:
+                rows = np.array(self._matrix[keep]) if keep else None
+                if rows is not None:
+                    self._matrix[:len(keep)] = rows
+                self._matrix.flush()
+                self._labels = [self._labels[i] for i in keep]
+                self._save_index()
+            return removed
+
+    def identify(self, centroids, threshold):
+        """
+        Сопоставление центроидов с известными спикерами
+
+        Возвращает для каждой строки centroids пару (метка или None, сходство).
+        Сходство - косинусное, совпадение засчитывается при similarity >= threshold.
+        """
+        centroids = np.atleast_2d(np.asarray(centroids, dtype=np.float32))
+        with self._locked(exclusive=False):
+            count = len(self._labels)
+            if not count or not len(centroids):
+                return [(None, None)] * len(centroids)
+            if centroids.shape[1] != self._dimension:
+                raise ValueError(f'Embedding dimension must be {self._dimension}, got {centroids.shape[1]}')
+            # (num_centroids, dim) @ (dim, num_enrolled) -> косинусные сходства
+            similarities = normalize(centroids) @ np.asarray(self._matrix[:count]).T
+            labels = list(self._labels)
+
+        # Нулевые центроиды (спикер без эмбеддинга) ни с кем не совпадают
+        similarities[~np.any(centroids, axis=1)] = -1.0
+        best = np.argmax(similarities, axis=1)
+        best_similarity = similarities[np.arange(len(centroids)), best]
+        return [
+            (labels[j] if s >= threshold else None, round(float(s), 4))
+            for j, s in zip(best, best_similarity)
+        ]
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive=True):
+        """
+        Блокировка хранилища в процессе и между процессами
+
+        Изменения - под эксклюзивной файловой блокировкой, чтение - под
+        разделяемой. Внутри блокировки индекс и матрица актуальны.
+        """
+        with self._lock:
+            if fcntl is None or (not exclusive and not os.path.isdir(self.directory)):
+                self._refresh()
+                yield
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    self._refresh()
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Перечитывание индекса и матрицы, если их изменил другой процесс (под блокировкой)"""
+        stamp = file_stamp(self._index_path)
+        if stamp == self._index_stamp:
+            return
+        self._index_stamp = stamp
+        if stamp is None or not os.path.exists(self._matrix_path):
+            self._matrix, self._labels, self._dimension = None, [], None
+            return
+        with open(self._index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self._labels = index['labels']
+        self._dimension = index['dimension']
+        # Матрицу другой процесс мог заменить (рост ёмкости) - открывается заново
+        self._matrix = np.load(self._matrix_path, mmap_mode='r+')
+
+    def _ensure_capacity(self, rows):
+        # Вызывается под self._locked()
+        capacity = 0 if self._matrix is None else self._matrix.shape[0]
+        if rows <= capacity:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        new_capacity = max(INITIAL_CAPACITY, capacity * 2)
+        tmp_path = self._matrix_path + '.tmp'
+        matrix = np.lib.format.open_memmap(
+            tmp_path, mode='w+', dtype=np.float32, shape=(new_capacity, self._dimension)
+        )
+        if self._matrix is not None:
+            matrix[:capacity] = self._matrix
+        matrix.flush()
+        del matrix
+        self._matrix = None
+        os.replace(tmp_path, self._matrix_path)
+        self._matrix = np.load(self._matrix_path, mmap_mode='r+')
+
+    def _save_index(self):
+        tmp_path = self._index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'dimension': self._dimension, 'labels': self._labels}, f, ensure_ascii=False)
+        os.replace(tmp_path, self._index_path)
+        # Своя запись не требует перечитывания
+        self._index_stamp = file_stamp(self._index_path)